@@ -0,0 +1,217 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from config import settings
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT, routeTemplate, setCode
+from serialization import FastResponse
+
+"""
+admission.py: Control de admision delante de las rutas que usan Mongo: limite de peticiones a la vez por grupo de rutas con colas
+de espera acotadas y prioridad para las lecturas interactivas, 503 con Retry-After al llenarse, y limite por cliente (token bucket)
+"""
+
+PREFIX = "/BlaBlaETSIINF"
+
+# Grupos de rutas de mas a menos prioritario: (peticiones a la vez, peticiones esperando) como parte de ADMISSION_MAX_CONCURRENCY
+# y ADMISSION_QUEUE_SIZE. Un hueco libre se da siempre al grupo mas prioritario que tenga peticiones esperando
+GROUPS = {
+    # Lecturas por id y detalle: lo que ve el usuario al navegar
+    "read": (1.0, 1.0),
+    # Reservas, mensajes, reseñas y cambios
+    "write": (0.5, 1.0),
+    # Listados y busquedas (paginas de hasta MAX_LIMIT documentos)
+    "list": (0.5, 0.5),
+    # Importacion y exportacion masivas
+    "bulk": (0.05, 0.05),
+}
+
+# Rutas que no pasan por el control: salud y metricas (no deben fallar en un pico) y el flujo de eventos,
+# que dura lo que la conexion y no ocupa el pool de Mongo mientras espera
+EXEMPT = {PREFIX + "/health/live", PREFIX + "/health/ready", PREFIX + "/metrics", PREFIX + "/users/{user_id}/events"}
+
+# Rutas de importacion y exportacion masivas (grupo "bulk")
+BULK_ROUTES = {PREFIX + "/import/{collection}", PREFIX + "/export/{collection}"}
+
+# Lecturas paginadas o de busqueda (grupo "list"), por plantilla de ruta; el resto de GET son lecturas por id ("read").
+# Una ruta de listado nueva se añade aqui
+LIST_ROUTES = {PREFIX + route for route in (
+    "/trips/", "/trips/search", "/trips/near", "/users/",
+    "/users/{user_id}/bookings/", "/users/{user_id}/messages/", "/users/{user_id}/reviews/",
+    "/users/{user_id}/conversations/", "/users/{user_id}/conversations/{peer_id}",
+)}
+
+# Clientes distintos que se recuerdan para el limite por cliente; se olvida el que lleva mas tiempo sin peticiones
+MAX_CLIENTS = 100000
+
+# routeGroup(method: str, route: str): grupo de la plantilla de ruta, o None si no pasa por el control de admision
+def routeGroup(method: str, route: str):
+    if route in EXEMPT or route == "unmatched":
+        return None
+    if route in BULK_ROUTES:
+        return "bulk"
+    if method != "GET":
+        return "write"
+    if route in LIST_ROUTES:
+        return "list"
+    return "read"
+
+class Group():
+    def __init__(self, name: str, priority: int, limit: int, queue_size: int):
+        self.name, self.priority, self.limit, self.queue_size = name, priority, limit, queue_size
+        self.running = 0
+        self.waiters = deque()
+
+class Limiter():
+    # Peticiones a la vez en total (capacity) y por grupo. Las que no caben esperan en la cola de su grupo hasta timeout segundos;
+    # con la cola llena se rechazan en el momento. Una peticion nueva no se adelanta a las que ya esperan en su grupo o en uno
+    # mas prioritario
+    def __init__(self, capacity: int, queue_size: int, timeout: float):
+        self.capacity, self.timeout = capacity, timeout
+        self.running = 0
+        self.groups = {name: Group(name, priority, max(1, int(capacity * limit)), max(1, int(queue_size * queue)))
+                       for priority, (name, (limit, queue)) in enumerate(GROUPS.items())}
+
+    def _blocked(self, group: Group):
+        return any(other.waiters and other.running < other.limit for other in self.groups.values() if other.priority <= group.priority)
+
+    def _admit(self, group: Group):
+        group.running += 1
+        self.running += 1
+        ADMISSION_IN_FLIGHT.inc(group.name)
+
+    # acquire(name: str): None si la peticion puede seguir; si no, el motivo del rechazo ("queue_full" o "timeout")
+    async def acquire(self, name: str):
+        group = self.groups[name]
+        if self.running < self.capacity and group.running < group.limit and not self._blocked(group):
+            self._admit(group)
+            return None
+        if len(group.waiters) >= group.queue_size:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        group.waiters.append(waiter)
+        ADMISSION_QUEUE_DEPTH.inc(name)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            # Si se ha admitido a la vez que vencia la espera, sigue adelante
+            if not waiter.done() or waiter.cancelled():
+                self._leave(group, waiter)
+                return "timeout"
+        except asyncio.CancelledError:
+            # El cliente se ha ido mientras esperaba: si ya tenia hueco lo devuelve
+            if waiter.done() and not waiter.cancelled():
+                self.release(name)
+            else:
+                self._leave(group, waiter)
+            raise
+        finally:
+            ADMISSION_WAIT.observe(time.perf_counter() - start, name)
+        return None
+
+    def _leave(self, group: Group, waiter):
+        if waiter in group.waiters:
+            group.waiters.remove(waiter)
+            ADMISSION_QUEUE_DEPTH.dec(group.name)
+        # Las peticiones de grupos menos prioritarios que esta bloqueaba pueden tener hueco
+        self._wake()
+
+    # release(name: str): libera el hueco de una peticion admitida y se lo da a la siguiente por prioridad
+    def release(self, name: str):
+        group = self.groups[name]
+        group.running -= 1
+        self.running -= 1
+        ADMISSION_IN_FLIGHT.dec(name)
+        self._wake()
+
+    def _wake(self):
+        # GROUPS esta en orden de prioridad
+        for group in self.groups.values():
+            while group.waiters and group.running < group.limit and self.running < self.capacity:
+                waiter = group.waiters.popleft()
+                ADMISSION_QUEUE_DEPTH.dec(group.name)
+                if waiter.done():
+                    continue
+                # El hueco se reserva aqui, al despertarla: nadie puede ocuparlo antes de que la peticion vuelva a ejecutarse
+                self._admit(group)
+                waiter.set_result(None)
+
+class TokenBuckets():
+    # Un cubo por cliente con hasta burst fichas que se rellena a rate fichas por segundo; cada peticion gasta una
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.burst = rate, burst
+        self._buckets = OrderedDict()
+
+    # take(client: str): 0 si el cliente tenia ficha; si no, segundos hasta que tenga una
+    def take(self, client: str):
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        self._buckets[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+        if len(self._buckets) > MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        return wait
+
+# Limitador y cubos en uso; configure() los sustituye (None desactiva cada parte)
+limiter = None
+buckets = None
+
+# configure(capacity: int, queue_size: int, timeout_ms: int, rate: float, burst: int): crea el limitador y los cubos
+# (capacity 0 desactiva los limites de concurrencia y rate 0 el limite por cliente)
+def configure(capacity: int = None, queue_size: int = None, timeout_ms: int = None, rate: float = None, burst: int = None):
+    global limiter, buckets
+    capacity = settings.admission_max_concurrency if capacity is None else capacity
+    queue_size = settings.admission_queue_size if queue_size is None else queue_size
+    timeout_ms = settings.admission_queue_timeout_ms if timeout_ms is None else timeout_ms
+    rate = settings.rate_limit_per_second if rate is None else rate
+    burst = settings.rate_limit_burst if burst is None else burst
+    limiter = Limiter(capacity, queue_size, timeout_ms / 1000) if capacity > 0 else None
+    buckets = TokenBuckets(rate, max(1, burst)) if rate > 0 else None
+
+configure()
+
+# client(scope): direccion del cliente; detras de un proxy de confianza (RATE_LIMIT_TRUST_PROXY), la primera de X-Forwarded-For
+def client(scope):
+    if settings.rate_limit_trust_proxy:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    return scope["client"][0] if scope.get("client") else "unknown"
+
+def _rejection(code: int, status: str, message: str, retry_after: float):
+    setCode(str(code))
+    # Codigo HTTP real (no solo en el sobre) para que clientes y balanceadores reintenten mas tarde
+    return FastResponse({"code": str(code), "status": status, "message": message}, status_code=code,
+                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+class AdmissionMiddleware():
+    # Middleware ASGI puro: decide antes de llamar a la aplicacion y devuelve el hueco cuando termina la respuesta
+    # (en streaming, cuando se ha enviado el ultimo documento)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (limiter is None and buckets is None):
+            return await self.app(scope, receive, send)
+        name = routeGroup(scope["method"], routeTemplate(scope))
+        if name is None:
+            return await self.app(scope, receive, send)
+        if buckets is not None:
+            wait = buckets.take(client(scope))
+            if wait:
+                ADMISSION_REJECTED.inc(name, "rate_limited")
+                return await _rejection(429, "Too Many Requests", "Rate limit exceeded", wait)(scope, receive, send)
+        _limiter = limiter
+        if _limiter is None:
+            return await self.app(scope, receive, send)
+        reason = await _limiter.acquire(name)
+        if reason is not None:
+            ADMISSION_REJECTED.inc(name, reason)
+            return await _rejection(503, "Service Unavailable", "Server busy, retry later",
+                                    settings.admission_retry_after_seconds)(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _limiter.release(name)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import sys
+from datetime import datetime, time
+from config import connect, database, settings
+from cascade import supportsTransactions
+from metrics import labelled
+from repository import ArchiveRepo
+
+"""
+archive.py: Archivado periodico de los viajes terminados y sus reservas en trips_archive y bookings_archive, por lotes
+"""
+
+logger = logging.getLogger(__name__)
+
+# Tarea del archivado periodico iniciada por start(); None si no esta en marcha
+_task = None
+
+# today(): medianoche UTC de hoy; un viaje ha terminado si su end_date es anterior
+def today():
+    return datetime.combine(datetime.utcnow().date(), time())
+
+async def _archiveBatch(before: datetime, batch_size: int):
+    # Cada lote en su propia transaccion si el despliegue lo admite: los bloqueos duran poco
+    if await supportsTransactions():
+        async with await database.client.start_session() as session:
+            return await session.with_transaction(lambda session: ArchiveRepo.archiveTrips(before, batch_size, session))
+    return await ArchiveRepo.archiveTrips(before, batch_size)
+
+# archiveEndedTrips(before: datetime, batch_size: int, pause_ms: int): archiva por lotes los viajes terminados antes de before
+# (por defecto, hoy) con una pausa entre lotes; devuelve el numero de documentos movidos por coleccion
+@labelled("archive.archiveEndedTrips")
+async def archiveEndedTrips(before: datetime = None, batch_size: int = None, pause_ms: int = None):
+    before = before or today()
+    batch_size = batch_size or settings.archive_batch_size
+    pause_ms = settings.archive_pause_ms if pause_ms is None else pause_ms
+    _moved = {"trips": 0, "bookings": 0}
+    while True:
+        _batch = await _archiveBatch(before, batch_size)
+        for collection, count in _batch.items():
+            _moved[collection] += count
+        if _batch["trips"] < batch_size:
+            return _moved
+        await asyncio.sleep(pause_ms / 1000)
+
+async def _loop(interval: int):
+    # Varios workers pueden archivar a la vez: mover un viaje ya movido no hace nada
+    while True:
+        try:
+            _moved = await archiveEndedTrips()
+            if _moved["trips"]:
+                logger.info("Archived %d trips and %d bookings", _moved["trips"], _moved["bookings"])
+        except Exception:
+            logger.exception("Trip archival failed")
+        await asyncio.sleep(interval)
+
+# start(): lanza el archivado periodico cada ARCHIVE_INTERVAL_SECONDS segundos (si es 0 no hace nada)
+def start():
+    global _task
+    if settings.archive_interval_seconds > 0 and _task is None:
+        _task = asyncio.create_task(_loop(settings.archive_interval_seconds))
+
+# stop(): detiene el archivado periodico; un lote a medias se repite entero en la siguiente ejecucion
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "run":
+        print("usage: python archive.py run [--batch-size N]", file=sys.stderr)
+        return 2
+    batch_size = int(argv[argv.index("--batch-size") + 1]) if "--batch-size" in argv else None
+    _moved = await archiveEndedTrips(batch_size=batch_size, pause_ms=0)
+    print(f"archived trips {_moved['trips']}  bookings {_moved['bookings']}", file=sys.stderr)
+    return 0
+
+# python archive.py run [--batch-size N]: archiva ahora todos los viajes terminados sin esperar al proceso periodico
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
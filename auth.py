@@ -0,0 +1,150 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from fastapi import Depends, Header, Request
+from config import settings
+from metrics import CACHE_HITS, CACHE_MISSES
+from passwords import hashPassword, verifyPassword
+from repository import ReviewRepo, TripRepo, UserRepo
+
+"""
+auth.py: Inicio de sesion con tokens de acceso firmados (HMAC-SHA256) que se comprueban en el proceso, sin consultar la base de
+datos, con una cache de los ya verificados; y dependencias de FastAPI para exigirlos con AUTH_REQUIRED
+"""
+
+logger = logging.getLogger(__name__)
+
+# Clave con la que se firman los tokens; sin AUTH_SECRET, una aleatoria (los tokens solo valen en este proceso)
+if settings.auth_secret:
+    _secret = settings.auth_secret.encode()
+else:
+    _secret = os.urandom(32)
+    logger.warning("AUTH_SECRET is not set: tokens are signed with a random key and only valid in this process")
+
+# Tokens ya verificados -> (usuario, caducidad), del menos al mas usado recientemente
+_verified = OrderedDict()
+
+# Con la que se compara la contraseña cuando el email no existe, para que tarde lo mismo que un usuario real
+_missing = None
+
+class InvalidCredentials(ValueError):
+    pass
+
+class Forbidden(ValueError):
+    pass
+
+def _b64(value: bytes):
+    return base64.urlsafe_b64encode(value).decode().rstrip("=")
+
+def _unb64(value: str):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+def _sign(body: str):
+    return hmac.new(_secret, body.encode(), hashlib.sha256).digest()
+
+# issueToken(user_id: str): token de acceso del usuario: payload JSON en base64 y su firma, separados por un punto
+def issueToken(user_id: str):
+    body = _b64(json.dumps({"sub": user_id, "exp": int(time.time()) + settings.auth_token_ttl_seconds}).encode())
+    return {"access_token": f"{body}.{_b64(_sign(body))}", "token_type": "bearer", "expires_in": settings.auth_token_ttl_seconds}
+
+# verifyToken(token: str): usuario del token; InvalidCredentials si la firma no es valida o ha caducado
+def verifyToken(token: str):
+    now = time.time()
+    cached = _verified.get(token)
+    if cached is not None:
+        user_id, expires = cached
+        if expires > now:
+            _verified.move_to_end(token)
+            CACHE_HITS.inc("tokens")
+            return user_id
+        del _verified[token]
+        raise InvalidCredentials("Expired token")
+    CACHE_MISSES.inc("tokens")
+    body, _, signature = token.partition(".")
+    try:
+        valid = hmac.compare_digest(_sign(body), _unb64(signature))
+        payload = json.loads(_unb64(body)) if valid else None
+        user_id, expires = payload["sub"], payload["exp"]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCredentials("Invalid token")
+    if expires <= now:
+        raise InvalidCredentials("Expired token")
+    _verified[token] = (user_id, expires)
+    if len(_verified) > settings.auth_token_cache_size:
+        _verified.popitem(last=False)
+    return user_id
+
+# login(email_address: str, password: str): token del usuario si la contraseña es correcta, None si no
+# Las contraseñas en claro o con otro coste se guardan derivadas de nuevo (solo si nadie la ha cambiado entretanto)
+async def login(email_address: str, password: str):
+    global _missing
+    _user = await UserRepo.getCredentials(email_address)
+    # Los usuarios importados sin contraseña tampoco pueden iniciar sesion
+    if _user is None or not _user.get("password"):
+        if _missing is None:
+            _missing = await hashPassword(_b64(os.urandom(16)))
+        await verifyPassword(password, _missing)
+        return None
+    valid, rehash = await verifyPassword(password, _user["password"])
+    if not valid:
+        return None
+    if rehash:
+        await UserRepo.setPassword(_user["_id"], await hashPassword(password), _user["password"])
+    return issueToken(_user["_id"])
+
+# authenticate(authorization): usuario del token de la cabecera Authorization: Bearer, o None si no se envia y no es obligatorio
+async def authenticate(authorization: Optional[str] = Header(None)):
+    if authorization is None:
+        if settings.auth_required:
+            raise InvalidCredentials("Missing bearer token")
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise InvalidCredentials("Authorization must be a bearer token")
+    return verifyToken(token.strip())
+
+# authorize(caller: str, *owners): con AUTH_REQUIRED, el usuario que llama debe ser cada uno de los dueños indicados
+# (los None, documentos que no existen, no cuentan: la ruta responde 404)
+def authorize(caller: Optional[str], *owners):
+    if settings.auth_required and any(owner != caller for owner in owners if owner is not None):
+        raise Forbidden("Not allowed for this user")
+
+# isOwner(caller: str, owner: str): si el usuario que llama puede ver los datos privados de owner (siempre sin AUTH_REQUIRED)
+def isOwner(caller: Optional[str], owner: str):
+    return not settings.auth_required or caller == owner
+
+# operator(authorization): dependencia de la importacion y exportacion masivas: con AUTH_REQUIRED solo con la credencial de
+# operador (AUTH_OPERATOR_TOKEN) y, si no esta configurada, nunca. Un token de usuario no basta: ven y escriben todos los datos
+async def operator(authorization: Optional[str] = Header(None)):
+    if not settings.auth_required:
+        return
+    if not settings.auth_operator_token:
+        raise Forbidden("Bulk import and export are disabled")
+    if authorization is None:
+        raise InvalidCredentials("Missing bearer token")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), settings.auth_operator_token.encode()):
+        raise Forbidden("Operator credentials required")
+
+# owner(request, caller): dependencia de las rutas de un usuario (/users/{user_id}/... y /users/{id}): solo el propio usuario
+async def owner(request: Request, caller: Optional[str] = Depends(authenticate)):
+    authorize(caller, request.path_params.get("user_id", request.path_params.get("id")))
+    return caller
+
+# authorizeTrip(caller: str, id: str): con AUTH_REQUIRED, solo el conductor cambia o borra su viaje
+async def authorizeTrip(caller: Optional[str], id: str):
+    if settings.auth_required:
+        _trip = await TripRepo.getTripById(id, {"driver_id": 1})
+        authorize(caller, _trip and _trip["driver_id"])
+
+# authorizeReview(caller: str, id: str): con AUTH_REQUIRED, solo el autor cambia o borra su reseña
+async def authorizeReview(caller: Optional[str], id: str):
+    if settings.auth_required:
+        _review = await ReviewRepo.getReviewById(id, {"reviewer_id": 1})
+        authorize(caller, _review and _review["reviewer_id"])
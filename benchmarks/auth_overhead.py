@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/auth_overhead.py: Coste de la autenticacion: inicios de sesion por segundo y retraso del event loop con scrypt en el pool
+de hilos (con varios tamaños) frente a scrypt en el propio loop; verificacion de tokens sin y con cache; y latencia de
+GET /users/{id} sin token y con token. Necesita un mongod accesible en MONGODB_URL (--backend mock solo para probar el script)
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import auth
+import main
+import passwords
+from dataset import Scale, seed
+from indexes import ensureIndexes
+from suite import _connect
+
+PASSWORD = "bench"
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def _lag(stop: asyncio.Event, samples: list):
+    # Cuanto tarda en volver un sleep de 1 ms: lo que el loop ha estado ocupado sin atender otras peticiones
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append((time.perf_counter() - start - 0.001) * 1000)
+
+async def _inline(password, salt, n, r, p):
+    return passwords._derive(password, salt, n, r, p)
+
+async def _logins(emails: list, clients: int):
+    pending = iter(emails)
+    failed = 0
+    async def worker():
+        nonlocal failed
+        for email_address in pending:
+            if await auth.login(email_address, PASSWORD) is None:
+                failed += 1
+    stop, samples = asyncio.Event(), []
+    ticker = asyncio.ensure_future(_lag(stop, samples))
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    return elapsed, failed, samples
+
+async def _benchLogins(emails: list, clients: int, workers_list: list):
+    print(f"logins: {len(emails)} with {clients} clients, scrypt N={config.settings.auth_scrypt_n}; loop lag in ms")
+    print(f"{'mode':>10} {'logins/s':>9} {'lag p50':>8} {'lag p99':>8} {'lag max':>8} {'failed':>6}")
+    modes = [("inline", None)] + [(f"pool {workers}", workers) for workers in workers_list]
+    for mode, workers in modes:
+        off_loop = passwords._deriveOffLoop
+        if workers is None:
+            passwords._deriveOffLoop = _inline
+        else:
+            config.settings.auth_hash_workers = workers
+            passwords._executor = None
+        try:
+            elapsed, failed, samples = await _logins(emails, clients)
+        finally:
+            passwords._deriveOffLoop = off_loop
+            if passwords._executor is not None:
+                passwords._executor.shutdown()
+                passwords._executor = None
+        print(f"{mode:>10} {len(emails) / elapsed:9.1f} {_percentile(samples, 0.5):8.2f} {_percentile(samples, 0.99):8.2f} "
+              f"{max(samples, default=0):8.2f} {failed:6}")
+
+def _benchTokens(user_ids: list, rounds: int):
+    tokens = [auth.issueToken(user_id)["access_token"] for user_id in user_ids]
+    print(f"verifyToken: {len(tokens)} tokens x {rounds}; microseconds per call")
+    for mode in ("cold", "cached"):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            if mode == "cold":
+                auth._verified.clear()
+            for token in tokens:
+                auth.verifyToken(token)
+        print(f"{mode:>10} {(time.perf_counter() - start) / (rounds * len(tokens)) * 1e6:9.2f}")
+
+async def _benchRequests(user_ids: list, rounds: int):
+    tokens = {user_id: auth.issueToken(user_id)["access_token"] for user_id in user_ids}
+    transport = httpx.ASGITransport(app=main.app)
+    print(f"GET /users/{{id}}: {len(user_ids)} users x {rounds}; latencies in ms")
+    print(f"{'mode':>10} {'p50':>8} {'p99':>8}")
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for mode in ("anonymous", "token", "required"):
+            config.settings.auth_required = mode == "required"
+            samples = []
+            for _ in range(rounds):
+                for user_id in user_ids:
+                    headers = {} if mode == "anonymous" else {"Authorization": "Bearer " + tokens[user_id]}
+                    start = time.perf_counter()
+                    response = await client.get(f"/BlaBlaETSIINF/users/{user_id}", headers=headers)
+                    samples.append((time.perf_counter() - start) * 1000)
+                    assert response.json()["code"] == "200", response.text
+            print(f"{mode:>10} {_percentile(samples, 0.5):8.3f} {_percentile(samples, 0.99):8.3f}")
+    config.settings.auth_required = False
+
+async def run(backend, users, logins, clients, workers_list, rounds, seed_value):
+    _connect(backend)
+    await ensureIndexes(config.database)
+    dataset, _ = await seed(config.database, Scale(users=users), seed_value)
+    # Todos con la misma contraseña ya derivada: el primer inicio de sesion no la rehace
+    await config.database.get_collection("users").update_many({}, {"$set": {"password": await passwords.hashPassword(PASSWORD)}})
+    user_ids = dataset.users
+    # dataset.py da a cada usuario el email user{i}@bench
+    emails = [f"user{i % users}@bench" for i in range(logins)]
+    await _benchLogins(emails, clients, workers_list)
+    _benchTokens(user_ids[:1000], rounds)
+    await _benchRequests(user_ids[:200], rounds)
+
+# python benchmarks/auth_overhead.py --logins 400 --clients 32 --workers 1 2 4 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=("mongod", "mock"), default="mongod")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--logins", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.users, args.logins, args.clients, args.workers, args.rounds, args.seed))
@@ -0,0 +1,123 @@
+import random
+import uuid
+from datetime import date, datetime, timedelta
+from model import Booking, Message, Review, Trip, User
+from repository import BookingRepo, MessageRepo, RatingRepo, ReviewRepo, TripRepo, UserRepo
+
+"""
+benchmarks/dataset.py: Datos sinteticos reproducibles (misma semilla, mismos ids) de usuarios, viajes de los conductores,
+reservas, conversaciones y reseñas, con las plazas ocupadas coherentes con las reservas aceptadas
+"""
+
+NAMES = ["María", "José", "Antonio", "Carmen", "Manuel", "Ana", "Francisco", "Laura", "David", "Lucía", "Javier", "Marta",
+         "Íñigo", "Inés", "Álvaro", "Sofía", "Pablo", "Elena", "Sergio", "Paula", "Raúl", "Nuria", "Óscar", "Irene"]
+LAST_NAMES = ["García", "Fernández", "González", "Rodríguez", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Martín",
+              "Jiménez", "Ruiz", "Hernández", "Díaz", "Moreno", "Muñoz", "Álvarez", "Romero", "Alonso", "Gutiérrez",
+              "Navarro", "Torres", "Domínguez", "Vázquez", "Ramos", "Gil", "Ramírez", "Serrano", "Blanco", "Molina"]
+LOCATIONS = ["Madrid", "Boadilla del Monte", "Majadahonda", "Pozuelo de Alarcón", "Las Rozas", "Alcorcón", "Móstoles",
+             "Villaviciosa de Odón", "Getafe", "Leganés", "Aravaca", "Moncloa"]
+CAMPUS = "ETSIINF"
+DEPARTURES = ["07:30", "08:00", "08:15", "08:30", "09:00", "14:00", "15:30", "18:00"]
+TRIP_TYPES = ["daily", "weekly", "once"]
+
+# Primer dia de los viajes generados; hay viajes durante DAYS dias
+START_DAY = date(2024, 3, 4)
+DAYS = 20
+
+BATCH_SIZE = 5000
+
+class Scale():
+    # Tamaño del conjunto de datos; todo lo demas se deriva del numero de usuarios
+    def __init__(self, users: int = 2000, driver_ratio: float = 0.2, trips_per_driver: int = 5, bookings_per_user: int = 3,
+                 messages_per_thread: int = 4, review_ratio: float = 0.5):
+        self.users = users
+        self.driver_ratio = driver_ratio
+        self.trips_per_driver = trips_per_driver
+        self.bookings_per_user = bookings_per_user
+        self.messages_per_thread = messages_per_thread
+        self.review_ratio = review_ratio
+
+    def dict(self):
+        return dict(vars(self))
+
+class Dataset():
+    # Ids generados, para construir peticiones que apuntan a documentos que existen
+    def __init__(self):
+        self.users = []
+        self.drivers = []
+        self.trips = []
+        self.bookings = []
+        self.threads = []
+        self.prefixes = []
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def _document(rng, repo, model):
+    document = repo.toDocument(model)
+    document["_id"] = _uuid(rng)
+    return document
+
+def _day(rng):
+    return (START_DAY + timedelta(days=rng.randrange(DAYS))).isoformat()
+
+def _timestamp(rng):
+    moment = datetime.combine(START_DAY, datetime.min.time()) + timedelta(minutes=rng.randrange(DAYS * 24 * 60))
+    return moment.isoformat()
+
+# build(scale: Scale, seed: int): genera en memoria los documentos de cada coleccion y los ids que usan las peticiones
+def build(scale: Scale, seed: int = 1):
+    rng = random.Random(seed)
+    dataset = Dataset()
+    _documents = {"users": [], "trips": [], "bookings": [], "messages": [], "reviews": []}
+    for i in range(scale.users):
+        name, last_name = rng.choice(NAMES), f"{rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+        user = _document(rng, UserRepo, User(name=name, last_name=last_name, bio="", password="bench",
+                                             email_address=f"user{i}@bench", municipality=rng.choice(LOCATIONS), zip_code="28660"))
+        _documents["users"].append(user)
+        dataset.users.append(user["_id"])
+        dataset.prefixes.append(user["search_words"][0][:rng.randint(2, 5)])
+    dataset.drivers = dataset.users[:max(1, int(scale.users * scale.driver_ratio))]
+    for driver in dataset.drivers:
+        for _ in range(scale.trips_per_driver):
+            start, arrival = (rng.choice(LOCATIONS), CAMPUS) if rng.random() < 0.7 else (CAMPUS, rng.choice(LOCATIONS))
+            trip = _document(rng, TripRepo, Trip(driver_id=driver, start_location=start, departure_time=rng.choice(DEPARTURES),
+                                                 available_places=rng.randint(1, 4), price=rng.randint(1, 6),
+                                                 trip_type=rng.choice(TRIP_TYPES), day=_day(rng), end_date=_day(rng),
+                                                 arrival_location=arrival))
+            _documents["trips"].append(trip)
+            dataset.trips.append(trip)
+    for user in dataset.users:
+        for trip in rng.sample(dataset.trips, min(scale.bookings_per_user, len(dataset.trips))):
+            if trip["driver_id"] == user:
+                continue
+            # Aceptada mientras queden plazas, como haria addBooking
+            status = "accepted" if trip["available_places"] > 0 and rng.random() < 0.7 else "pending"
+            booking = _document(rng, BookingRepo, Booking(user_id=user, trip_id=trip["_id"], status=status))
+            if status == "accepted":
+                trip["available_places"] -= 1
+                trip["accepted_bookings"].append(booking["_id"])
+            _documents["bookings"].append(booking)
+            dataset.bookings.append((user, booking["_id"]))
+            dataset.threads.append((user, trip["driver_id"]))
+            # Conversacion entre pasajero y conductor sobre la reserva
+            for turn in range(scale.messages_per_thread):
+                sender, recipient = (user, trip["driver_id"]) if turn % 2 == 0 else (trip["driver_id"], user)
+                _documents["messages"].append(_document(rng, MessageRepo, Message(sender_id=sender, recipient_id=recipient,
+                                                                                  content=f"Mensaje {turn}", date=_timestamp(rng))))
+            if status == "accepted" and rng.random() < scale.review_ratio:
+                rating = rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 6, 9])[0]
+                _documents["reviews"].append(_document(rng, ReviewRepo, Review(reviewer_id=user, driver_id=trip["driver_id"],
+                                                                               rating=rating, comment="", date=trip["day"])))
+    return dataset, _documents
+
+# seed(db, scale: Scale, seed: int): borra las colecciones, inserta el conjunto de datos y recalcula las valoraciones
+async def seed(db, scale: Scale, seed: int = 1):
+    dataset, _documents = build(scale, seed)
+    for collection, documents in _documents.items():
+        await db.get_collection(collection).drop()
+        for start in range(0, len(documents), BATCH_SIZE):
+            await db.get_collection(collection).insert_many(documents[start:start + BATCH_SIZE], ordered=False)
+    await db.get_collection("driver_stats").drop()
+    await RatingRepo.rebuild()
+    return dataset, {collection: len(documents) for collection, documents in _documents.items()}
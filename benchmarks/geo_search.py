@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/geo_search.py: Compara TripRepo.searchNear ($geoNear y $geoWithin con indices 2dsphere) con un filtro por distancia
+en Python sobre todos los viajes, con 10k y 100k viajes. Necesita un mongod accesible en MONGODB_URL; usa una base de datos aparte
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+from dataset import CAMPUS, DEPARTURES, LOCATIONS, START_DAY
+from geo import EARTH_RADIUS, point, resolve
+from indexes import ensureIndexes
+from model import Trip
+from repository import TripRepo
+
+# Busquedas de un pasajero: (origen, radio del origen, destino, radio del destino) en metros
+QUERIES = [("Majadahonda", 2000, CAMPUS, 1000), ("Pozuelo de Alarcón", 5000, CAMPUS, 1000), ("Madrid", 3000, CAMPUS, 2000),
+           ("Móstoles", 10000, CAMPUS, 5000), (CAMPUS, 1000, "Moncloa", 3000), ("Aravaca", 500, "Getafe", 500)]
+
+# Los viajes salen y llegan a una distancia aleatoria (hasta JITTER metros) del punto de su lugar
+JITTER = 4000
+
+BATCH_SIZE = 10000
+
+def _jitter(rng, place):
+    lon, lat = resolve(place)["coordinates"]
+    distance, bearing = rng.uniform(0, JITTER) / EARTH_RADIUS, rng.uniform(0, 2 * math.pi)
+    return point(lon + math.degrees(distance * math.sin(bearing) / math.cos(math.radians(lat))),
+                 lat + math.degrees(distance * math.cos(bearing)))
+
+def _trip(rng, i):
+    start, arrival = (rng.choice(LOCATIONS), CAMPUS) if rng.random() < 0.7 else (CAMPUS, rng.choice(LOCATIONS))
+    document = TripRepo.toDocument(Trip(driver_id=f"driver{i % 1000}", start_location=start, departure_time=rng.choice(DEPARTURES),
+                                        available_places=rng.randint(1, 4), price=rng.randint(1, 6), trip_type="daily",
+                                        day=START_DAY.isoformat(), end_date=START_DAY.isoformat(), arrival_location=arrival))
+    document["start_point"], document["arrival_point"] = _jitter(rng, start), _jitter(rng, arrival)
+    return document
+
+async def _seed(count):
+    trips = config.database.get_collection("trips")
+    if await trips.estimated_document_count() == count:
+        return
+    await trips.drop()
+    rng = random.Random(count)
+    for start in range(0, count, BATCH_SIZE):
+        await trips.insert_many([_trip(rng, i) for i in range(start, min(start + BATCH_SIZE, count))], ordered=False)
+    await ensureIndexes(config.database)
+
+def _haversine(a, b):
+    (lon1, lat1), (lon2, lat2) = a["coordinates"], b["coordinates"]
+    h = math.sin(math.radians(lat2 - lat1) / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+# Lo que haria la aplicacion sin indices geograficos: leer todos los viajes y filtrar y ordenar por distancia en Python
+async def _naive(origin, origin_radius, destination, destination_radius, limit):
+    _found = []
+    async for trip in config.database.get_collection("trips").find({}, {"start_point": 1, "arrival_point": 1}):
+        distance = _haversine(origin, trip["start_point"])
+        if distance <= origin_radius and _haversine(destination, trip["arrival_point"]) <= destination_radius:
+            _found.append((distance, trip["_id"]))
+    return sorted(_found)[:limit + 1]
+
+async def _search(origin, origin_radius, destination, destination_radius, limit):
+    return await TripRepo.searchNear(origin, origin_radius, destination, destination_radius, limit=limit, projection={"_id": 1})
+
+async def _measure(method, query, limit, repeat):
+    _times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _result = await method(*query, limit)
+        _times.append((time.perf_counter() - start) * 1000)
+    _times.sort()
+    return len(_result), statistics.median(_times), _times[int(len(_times) * 0.95) - 1]
+
+async def run(counts, limit, repeat):
+    config.connect()
+    for count in counts:
+        await _seed(count)
+        print(f"{count} trips, limit {limit}, {repeat} runs per query (p50 / p95 ms)")
+        for origin, origin_radius, destination, destination_radius in QUERIES:
+            query = (resolve(origin), origin_radius, resolve(destination), destination_radius)
+            found_naive, p50_naive, p95_naive = await _measure(_naive, query, limit, repeat)
+            found_geo, p50_geo, p95_geo = await _measure(_search, query, limit, repeat)
+            print(f"  {origin[:12]:>12} {origin_radius:5}m -> {destination[:10]:10} {destination_radius:5}m"
+                  f"   python {p50_naive:8.2f} / {p95_naive:8.2f} ({found_naive:3})   geo {p50_geo:8.2f} / {p95_geo:8.2f} ({found_geo:3})")
+
+# python benchmarks/geo_search.py --trips 10000 100000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trips", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.trips, args.limit, args.repeat))
@@ -0,0 +1,29 @@
+import functools
+import inspect
+
+"""
+benchmarks/mockdb.py: Base de datos en memoria con mongomock-motor para --backend mock de los benchmarks y para las pruebas (tests/),
+sin mongod. Solo la usan ellos: la aplicacion siempre se conecta con Motor
+"""
+
+def _withoutSort(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return wrapper
+
+# _bulkCompat(): desde pymongo 4.11 UpdateOne, UpdateMany y ReplaceOne pasan sort= al bulk_write y el BulkOperationBuilder
+# de mongomock no lo admite. Se adapta el de mongomock (no el driver) y solo si hace falta: ninguna operacion de la
+# aplicacion usa sort en un bulk_write
+def _bulkCompat():
+    from mongomock.collection import BulkOperationBuilder
+    for name in ("add_update", "add_replace"):
+        method = getattr(BulkOperationBuilder, name)
+        if "sort" not in inspect.signature(method).parameters:
+            setattr(BulkOperationBuilder, name, _withoutSort(method))
+
+# client(): cliente de mongomock-motor listo para la aplicacion; ImportError si mongomock-motor no esta instalado
+def client():
+    from mongomock_motor import AsyncMongoMockClient
+    _bulkCompat()
+    return AsyncMongoMockClient()
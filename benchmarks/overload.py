@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/overload.py: Prueba de sobrecarga del control de admision: reproduce la mezcla de suite.py con cada vez mas clientes
+simultaneos frente a un pool de Mongo pequeño, sin y con ADMISSION_MAX_CONCURRENCY, y compara la latencia de las peticiones atendidas
+(p50/p99) y las rechazadas con 503. Necesita un mongod accesible en MONGODB_URL (--backend mock solo para probar el script)
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import admission
+import main
+from dataset import Scale, seed
+from indexes import ensureIndexes
+from suite import _connect, generate
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def _run(requests: list, clients: int):
+    _served, _shed, _errors = [], [], 0
+    pending = iter(requests)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def worker():
+            nonlocal _errors
+            for request in pending:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(request["method"], request["path"], json=request.get("body"))
+                except Exception:
+                    _errors += 1
+                    continue
+                elapsed = (time.perf_counter() - start) * 1000
+                if response.status_code == 503:
+                    _shed.append(elapsed)
+                elif response.status_code >= 500 or response.json().get("code", "200").startswith("5"):
+                    _errors += 1
+                else:
+                    _served.append(elapsed)
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(clients)])
+        elapsed = time.perf_counter() - start
+    return _served, _shed, _errors, elapsed
+
+async def run(backend, users, pool, clients_list, per_client, queue_size, timeout_ms, seed_value):
+    # Un pool pequeño para que Mongo sea el cuello de botella con pocos clientes
+    config.settings.mongodb_max_pool_size = pool
+    _connect(backend)
+    await ensureIndexes(config.database)
+    dataset, _ = await seed(config.database, Scale(users=users), seed_value)
+    print(f"pool {pool}, admission queue {queue_size}, timeout {timeout_ms} ms; latencies in ms")
+    print(f"{'mode':>9} {'clients':>7} {'served':>7} {'req/s':>8} {'p50':>8} {'p99':>8} {'shed':>6} {'shed p99':>8} {'errors':>6}")
+    for clients in clients_list:
+        requests = generate(dataset, clients * per_client, seed_value)
+        for mode, capacity in (("off", 0), ("admission", pool)):
+            admission.configure(capacity=capacity, queue_size=queue_size, timeout_ms=timeout_ms, rate=0)
+            served, shed, errors, elapsed = await _run(requests, clients)
+            print(f"{mode:>9} {clients:7} {len(served):7} {len(served) / elapsed:8.1f} {_percentile(served, 0.5):8.1f} "
+                  f"{_percentile(served, 0.99):8.1f} {len(shed):6} {_percentile(shed, 0.99):8.1f} {errors:6}")
+
+# python benchmarks/overload.py --pool 10 --clients 10 40 160 640
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=("mongod", "mock"), default="mongod")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--pool", type=int, default=10)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 40, 160, 640])
+    parser.add_argument("--per-client", type=int, default=25)
+    parser.add_argument("--queue-size", type=int, default=20)
+    parser.add_argument("--timeout-ms", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.users, args.pool, args.clients, args.per_client, args.queue_size, args.timeout_ms, args.seed))
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+import sys
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/read_cache.py: Comandos de Mongo por peticion y latencias de la mezcla de suite.py con la cache de usuarios y viajes
+desactivada y activada. Necesita un mongod accesible en MONGODB_URL (los comandos se cuentan con un listener de pymongo)
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import cache
+from dataset import Scale, seed
+from indexes import ensureIndexes
+from metrics import CACHE_EVICTIONS, CACHE_HITS, CACHE_MISSES
+from suite import generate, replay
+
+class Commands(monitoring.CommandListener):
+    # Comandos enviados al servidor por nombre
+    def __init__(self):
+        self.counts = {}
+
+    def started(self, event):
+        self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def _cacheCounters():
+    return {name: (CACHE_HITS.value(name), CACHE_MISSES.value(name), CACHE_EVICTIONS.value(name)) for name in cache.CACHED}
+
+async def run(users, count, concurrency, max_size, ttl, seed_value):
+    commands = Commands()
+    # Se registra antes de crear el cliente para que lo reciba
+    monitoring.register(commands)
+    config.connect()
+    await ensureIndexes(config.database)
+    for label, size in (("cache off", 0), (f"cache on ({max_size} entries, {ttl} s)", max_size)):
+        # Mismos datos y misma mezcla en las dos pasadas: las escrituras de la primera no cuentan en la segunda
+        dataset, _ = await seed(config.database, Scale(users=users), seed_value)
+        requests = generate(dataset, count, seed_value)
+        cache.configure(size, ttl)
+        before = _cacheCounters()
+        commands.counts = {}
+        _result = await replay(requests, concurrency)
+        total = _result["total"]
+        _commands = sum(commands.counts.values())
+        print(f"{label}: {_commands} commands ({_commands / total['count']:.2f} per request), {total['throughput']} req/s, "
+              f"p50 {total['p50_ms']} ms, p95 {total['p95_ms']} ms, p99 {total['p99_ms']} ms, errors {total['errors']}")
+        print("  " + ", ".join(f"{name} {number}" for name, number in sorted(commands.counts.items(), key=lambda item: -item[1])))
+        for name, (hits, misses, evictions) in _cacheCounters().items():
+            hits, misses, evictions = hits - before[name][0], misses - before[name][1], evictions - before[name][2]
+            if hits or misses:
+                print(f"  {name}: hits {hits}, misses {misses} ({hits / (hits + misses):.0%} hit ratio), evictions {evictions}")
+
+# python benchmarks/read_cache.py --users 2000 --count 20000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-size", type=int, default=10000)
+    parser.add_argument("--ttl", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.count, args.concurrency, args.max_size, args.ttl, args.seed))
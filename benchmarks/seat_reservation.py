@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/seat_reservation.py: Lanza muchas reservas simultaneas contra un mismo viaje y comprueba que no hay
+sobreventa ni actualizaciones perdidas. Necesita un mongod accesible en MONGODB_URL; usa una base de datos aparte
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import main
+
+PREFIX = "/BlaBlaETSIINF"
+
+def _user(name):
+    return {"name": name, "last_name": "Bench", "bio": "", "password": "bench", "email_address": f"{name}@bench",
+            "municipality": "Boadilla del Monte", "zip_code": "28660"}
+
+async def _seed(client, riders, places):
+    await config.database.client.drop_database(config.database.name)
+    await client.put(f"{PREFIX}/users/", json=_user("driver"))
+    for i in range(riders):
+        await client.put(f"{PREFIX}/users/", json=_user(f"rider{i}"))
+    _users = [user async for user in config.database.get_collection("users").find({}, {"_id": 1, "name": 1})]
+    driver = next(user["_id"] for user in _users if user["name"] == "driver")
+    await client.put(f"{PREFIX}/trips/", json={"driver_id": driver, "start_location": "Madrid", "departure_time": "08:00",
+                                               "available_places": places, "price": 3, "trip_type": "daily",
+                                               "day": "2024-03-01", "end_date": "2024-06-30", "arrival_location": "ETSIINF"})
+    trip = await config.database.get_collection("trips").find_one({}, {"_id": 1})
+    return trip["_id"], [user["_id"] for user in _users if user["name"] != "driver"]
+
+async def _book(client, trip_id, user_id):
+    response = await client.put(f"{PREFIX}/users/{user_id}/bookings/", json={"user_id": user_id, "trip_id": trip_id, "status": "accepted"})
+    return response.json()["code"]
+
+async def _check(trip_id, places):
+    trip = await config.database.get_collection("trips").find_one({"_id": trip_id})
+    accepted = await config.database.get_collection("bookings").count_documents({"trip_id": trip_id, "status": "accepted"})
+    # Invariantes: plazas libres + ocupadas = capacidad, y cada reserva aceptada ocupa exactamente una plaza
+    ok = (trip["available_places"] >= 0 and trip["available_places"] + len(trip["accepted_bookings"]) == places
+          and accepted == len(trip["accepted_bookings"]))
+    return ok, trip["available_places"], accepted
+
+async def run(riders, places):
+    # ASGITransport no lanza el lifespan de la aplicacion: el cliente se abre aqui
+    config.connect()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        trip_id, _riders = await _seed(client, riders, places)
+        start = time.perf_counter()
+        codes = await asyncio.gather(*[_book(client, trip_id, rider) for rider in _riders])
+        elapsed = time.perf_counter() - start
+        ok, free, accepted = await _check(trip_id, places)
+        print(f"{riders} concurrent bookings for {places} places in {elapsed:.3f}s ({riders / elapsed:.0f} req/s)")
+        print(f"  200: {codes.count('200')}  409: {codes.count('409')}  free places: {free}  accepted: {accepted}")
+        # Segunda fase: se cancelan a la vez la mitad de las aceptadas mientras los rechazados reintentan
+        _bookings = [booking async for booking in config.database.get_collection("bookings").find({"trip_id": trip_id})]
+        _cancel = _bookings[:len(_bookings) // 2]
+        _accepted = {booking["user_id"] for booking in _bookings}
+        _retry = [rider for rider in _riders if rider not in _accepted]
+        await asyncio.gather(*[client.delete(f"{PREFIX}/users/{booking['user_id']}/bookings/{booking['_id']}") for booking in _cancel],
+                             *[_book(client, trip_id, rider) for rider in _retry])
+        ok2, free, accepted = await _check(trip_id, places)
+        print(f"  after concurrent cancel/rebook: free places: {free}  accepted: {accepted}")
+        print("OK: no overbooking, no lost updates" if ok and ok2 else "FAILED: seat accounting is inconsistent")
+        return 0 if ok and ok2 else 1
+
+# python benchmarks/seat_reservation.py --riders 500 --places 20
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--riders", type=int, default=500)
+    parser.add_argument("--places", type=int, default=20)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.riders, args.places)))
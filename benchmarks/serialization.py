@@ -0,0 +1,49 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+import uuid
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import Response
+from serialization import orjson, respond
+
+"""
+benchmarks/serialization.py: Compara el camino antiguo (Response.dict + jsonable_encoder + json) con respond()
+sobre listas de viajes tal y como salen de Motor. No necesita base de datos
+"""
+
+def _trips(count):
+    return [{"_id": str(uuid.uuid4()), "driver_id": str(uuid.uuid4()), "start_location": "Madrid",
+             "departure_time": "08:15", "available_places": i % 5, "price": 3 + i % 4, "trip_type": "daily",
+             "day": "2024-03-01", "end_date": "2024-06-30", "arrival_location": "ETSIINF",
+             "accepted_bookings": [str(uuid.uuid4())]} for i in range(count)]
+
+# Lo que hacia cada ruta: el sobre con pydantic y despues la JSONResponse de FastAPI
+def old_path(trips):
+    content = Response(code=200, status="Ok", message="Success retrieving all data", result=trips).dict(exclude_none=True)
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+def new_path(trips):
+    return respond(code=200, status="Ok", message="Success retrieving all data", result=trips).body
+
+def run(count, repeat):
+    trips = _trips(count)
+    assert json.loads(old_path(trips)) == json.loads(new_path(trips))
+    print(f"{count} trips, best of {repeat} (encoder: {'orjson' if orjson else 'json'})")
+    _results = {}
+    for name, path in [("old", old_path), ("new", new_path)]:
+        _results[name] = min(timeit.repeat(lambda: path(trips), number=1, repeat=repeat))
+        print(f"  {name}: {_results[name] * 1000:8.2f} ms")
+    print(f"  speedup: {_results['old'] / _results['new']:.1f}x")
+
+# python benchmarks/serialization.py --count 10000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    run(args.count, args.repeat)
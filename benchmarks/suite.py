@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/suite.py: Genera datos sinteticos y una mezcla de peticiones (una peticion JSON por linea), la reproduce contra
+la aplicacion en el mismo proceso y guarda rendimiento y latencias p50/p95/p99 por ruta en JSON para comparar ejecuciones.
+Funciona contra un mongod (MONGODB_URL, base de datos BENCH_DATABASE) o contra mongomock-motor en memoria (--backend mock)
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import cascade
+import main
+import mockdb
+from dataset import LOCATIONS, CAMPUS, Scale, build, seed
+from indexes import ensureIndexes
+
+PREFIX = "/BlaBlaETSIINF"
+
+# Peso de cada tipo de peticion en la mezcla generada
+MIX = {
+    "GET /trips/search": 30,
+    "GET /trips/{id}": 15,
+    "GET /trips/": 4,
+    "GET /users/{id}": 10,
+    "GET /users/?substring": 8,
+    "GET /users/{user_id}/bookings/": 8,
+    "GET /users/{user_id}/messages/": 6,
+    "GET /users/{user_id}/reviews/": 4,
+    "GET /users/{user_id}/rating": 4,
+    "PUT /users/{user_id}/bookings/": 4,
+    "PUT /users/{user_id}/messages/": 5,
+    "PATCH /trips/{id}": 2,
+}
+
+def _request(endpoint: str, method: str, path: str, query: dict = None, body: dict = None):
+    return {"endpoint": endpoint, "method": method, "path": PREFIX + path + (f"?{urlencode(query)}" if query else ""), "body": body}
+
+# requestFor(endpoint: str, dataset, rng): peticion concreta de un tipo sobre documentos del conjunto de datos
+def requestFor(endpoint: str, dataset, rng):
+    user = rng.choice(dataset.users)
+    trip = rng.choice(dataset.trips)
+    if endpoint == "GET /trips/search":
+        place = rng.choice(LOCATIONS)
+        query = {"start_location": place, "arrival_location": CAMPUS} if rng.random() < 0.7 else {"start_location": CAMPUS, "arrival_location": place}
+        query.update(day=trip["day"].date().isoformat(), limit=20)
+        return _request(endpoint, "GET", "/trips/search", query)
+    if endpoint == "GET /trips/{id}":
+        return _request(endpoint, "GET", f"/trips/{trip['_id']}", {"with_rating": "true"})
+    if endpoint == "GET /trips/":
+        return _request(endpoint, "GET", "/trips/", {"limit": 50})
+    if endpoint == "GET /users/{id}":
+        return _request(endpoint, "GET", f"/users/{user}")
+    if endpoint == "GET /users/?substring":
+        return _request(endpoint, "GET", "/users/", {"substring": rng.choice(dataset.prefixes), "limit": 10})
+    if endpoint == "GET /users/{user_id}/bookings/":
+        return _request(endpoint, "GET", f"/users/{rng.choice(dataset.bookings)[0]}/bookings/")
+    if endpoint == "GET /users/{user_id}/messages/":
+        return _request(endpoint, "GET", f"/users/{rng.choice(dataset.threads)[0]}/messages/", {"limit": 20})
+    if endpoint == "GET /users/{user_id}/reviews/":
+        return _request(endpoint, "GET", f"/users/{rng.choice(dataset.drivers)}/reviews/")
+    if endpoint == "GET /users/{user_id}/rating":
+        return _request(endpoint, "GET", f"/users/{rng.choice(dataset.drivers)}/rating")
+    if endpoint == "PUT /users/{user_id}/bookings/":
+        return _request(endpoint, "PUT", f"/users/{user}/bookings/", body={"user_id": user, "trip_id": trip["_id"], "status": "accepted"})
+    if endpoint == "PUT /users/{user_id}/messages/":
+        sender, recipient = rng.choice(dataset.threads)
+        return _request(endpoint, "PUT", f"/users/{sender}/messages/",
+                        body={"sender_id": sender, "recipient_id": recipient, "content": "bench", "date": "2024-03-04T08:00:00"})
+    if endpoint == "PATCH /trips/{id}":
+        return _request(endpoint, "PATCH", f"/trips/{trip['_id']}", body={"price": rng.randint(1, 6)})
+    raise ValueError(f"Unknown endpoint {endpoint}")
+
+# generate(dataset, count: int, seed: int): mezcla de peticiones segun los pesos de MIX
+def generate(dataset, count: int, seed: int = 1):
+    rng = random.Random(seed)
+    endpoints, weights = list(MIX), list(MIX.values())
+    return [requestFor(endpoint, dataset, rng) for endpoint in rng.choices(endpoints, weights=weights, k=count)]
+
+def _percentile(values: list, fraction: float):
+    # Rango mas cercano sobre valores ordenados
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def _summary(latencies: list, errors: int, elapsed: float):
+    latencies = sorted(latencies)
+    return {"count": len(latencies), "errors": errors, "throughput": round(len(latencies) / elapsed, 1),
+            "mean_ms": round(sum(latencies) / len(latencies), 3), "p50_ms": round(_percentile(latencies, 0.50), 3),
+            "p95_ms": round(_percentile(latencies, 0.95), 3), "p99_ms": round(_percentile(latencies, 0.99), 3),
+            "max_ms": round(latencies[-1], 3)}
+
+# replay(requests: list, concurrency: int): lanza las peticiones con concurrency clientes simultaneos contra la aplicacion
+async def replay(requests: list, concurrency: int):
+    _latencies = {}
+    _errors = {}
+    pending = iter(requests)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker():
+            for request in pending:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(request["method"], request["path"], json=request.get("body"))
+                    # El codigo real va en el sobre; los 5xx y las excepciones cuentan como error (los 404 y 409 no)
+                    failed = response.status_code >= 500 or response.json().get("code", "200").startswith("5")
+                except Exception:
+                    failed = True
+                _latencies.setdefault(request["endpoint"], []).append((time.perf_counter() - start) * 1000)
+                _errors[request["endpoint"]] = _errors.get(request["endpoint"], 0) + failed
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    _all = [latency for latencies in _latencies.values() for latency in latencies]
+    return {"elapsed_s": round(elapsed, 3), "total": _summary(_all, sum(_errors.values()), elapsed),
+            "endpoints": {endpoint: _summary(latencies, _errors[endpoint], elapsed) for endpoint, latencies in sorted(_latencies.items())}}
+
+def _connect(backend: str):
+    if backend == "mock":
+        try:
+            config.client = mockdb.client()
+        except ImportError:
+            sys.exit("--backend mock needs mongomock-motor (pip install mongomock-motor)")
+        # mongomock no admite transacciones ni el comando hello
+        cascade._transactions = False
+    else:
+        config.connect()
+
+def _readRequests(path: str):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def _writeRequests(path: str, requests: list):
+    with open(path, "w") as file:
+        for request in requests:
+            file.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args):
+    _connect(args.backend)
+    scale = Scale(users=args.users)
+    await ensureIndexes(config.database)
+    dataset, counts = await seed(config.database, scale, args.seed)
+    print(f"seeded ({args.backend}): " + ", ".join(f"{collection} {count}" for collection, count in counts.items()), file=sys.stderr)
+    requests = _readRequests(args.requests) if args.requests else generate(dataset, args.count, args.seed)
+    if args.warmup:
+        await replay(requests[:args.warmup], args.concurrency)
+    _result = await replay(requests, args.concurrency)
+    _result["meta"] = {"backend": args.backend, "scale": scale.dict(), "seed": args.seed, "requests": len(requests),
+                       "concurrency": args.concurrency, "commit": _commit(), "python": platform.python_version(),
+                       "started": datetime.utcnow().isoformat()}
+    _print(_result)
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(_result, file, indent=2)
+    return 0 if _result["total"]["errors"] == 0 else 1
+
+def _print(result: dict):
+    total = result["total"]
+    print(f"{total['count']} requests in {result['elapsed_s']}s: {total['throughput']} req/s, "
+          f"p50 {total['p50_ms']} ms, p95 {total['p95_ms']} ms, p99 {total['p99_ms']} ms, errors {total['errors']}")
+    for endpoint, stats in result["endpoints"].items():
+        print(f"  {endpoint:34} {stats['count']:6} {stats['throughput']:8} req/s  p50 {stats['p50_ms']:8.2f}  "
+              f"p95 {stats['p95_ms']:8.2f}  p99 {stats['p99_ms']:8.2f}  errors {stats['errors']}")
+
+def _delta(before: float, after: float):
+    return f"{(after - before) / before * 100:+6.1f}%" if before else "     -"
+
+# compare(before: str, after: str): diferencias de rendimiento y latencia entre dos resultados guardados
+def compare(before: str, after: str):
+    with open(before) as file:
+        _before = json.load(file)
+    with open(after) as file:
+        _after = json.load(file)
+    _rows = [("total", _before["total"], _after["total"])]
+    _rows += [(endpoint, stats, _after["endpoints"][endpoint]) for endpoint, stats in _before["endpoints"].items() if endpoint in _after["endpoints"]]
+    print(f"{'':34} {'req/s':>16} {'p50':>16} {'p95':>16} {'p99':>16}")
+    for name, old, new in _rows:
+        print(f"{name:34} " + " ".join(f"{new[field]:>9} {_delta(old[field], new[field])}" for field in ("throughput", "p50_ms", "p95_ms", "p99_ms")))
+    return 0
+
+# python benchmarks/suite.py generate --users 2000 --count 5000 --out benchmarks/requests.jsonl
+# python benchmarks/suite.py run [--backend mock] [--requests benchmarks/requests.jsonl] --out before.json
+# python benchmarks/suite.py compare before.json after.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("generate", "run"):
+        command = commands.add_parser(name)
+        command.add_argument("--users", type=int, default=2000)
+        command.add_argument("--seed", type=int, default=1)
+        command.add_argument("--count", type=int, default=5000)
+    commands.choices["generate"].add_argument("--out", default="benchmarks/requests.jsonl")
+    commands.choices["run"].add_argument("--backend", choices=("mongod", "mock"), default="mongod")
+    commands.choices["run"].add_argument("--requests", help="request mix to replay (generated from the seed if omitted)")
+    commands.choices["run"].add_argument("--concurrency", type=int, default=32)
+    commands.choices["run"].add_argument("--warmup", type=int, default=200)
+    commands.choices["run"].add_argument("--out", help="JSON file for the results")
+    command = commands.add_parser("compare")
+    command.add_argument("before")
+    command.add_argument("after")
+    args = parser.parse_args()
+    if args.command == "generate":
+        # Los ids dependen solo de la semilla y la escala: la mezcla sirve para cualquier run con los mismos valores
+        _dataset, _ = build(Scale(users=args.users), args.seed)
+        _writeRequests(args.out, generate(_dataset, args.count, args.seed))
+        sys.exit(0)
+    if args.command == "compare":
+        sys.exit(compare(args.before, args.after))
+    sys.exit(asyncio.run(run(args)))
@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/user_search.py: Compara la busqueda antigua por regex sin anclar con UserRepo.getUsersByName (prefijos
+indexados) con 100k y 1M usuarios. Necesita un mongod accesible en MONGODB_URL; usa una base de datos aparte
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+from dataset import LAST_NAMES, NAMES
+from indexes import ensureIndexes
+from model import User
+from repository import UserRepo
+
+# Lo que se teclea en el buscador: prefijos cortos, palabras completas y nombre + apellido
+QUERIES = ["ma", "mar", "gonz", "Muñoz", "inigo", "alvarez", "laura mart", "Jose Garcia", "zzz"]
+
+BATCH_SIZE = 10000
+
+def _user(rng, i):
+    name = rng.choice(NAMES)
+    last_name = f"{rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+    return User(name=name, last_name=last_name, bio="", password="bench", email_address=f"user{i}@bench",
+                municipality="Madrid", zip_code="28660")
+
+async def _seed(count):
+    users = config.database.get_collection("users")
+    if await users.estimated_document_count() == count:
+        return
+    await users.drop()
+    rng = random.Random(count)
+    for start in range(0, count, BATCH_SIZE):
+        await users.insert_many([UserRepo.toDocument(_user(rng, i)) for i in range(start, min(start + BATCH_SIZE, count))],
+                                ordered=False)
+    await ensureIndexes(config.database)
+
+# Implementacion anterior de getUsersByName
+async def _regex(text, limit):
+    cursor = config.database.get_collection("users").find({"name": {"$regex": f".*{text}.*"}}).sort("_id", 1).limit(limit + 1)
+    return await cursor.to_list(None)
+
+async def _search(text, limit):
+    return await UserRepo.getUsersByName(text, limit)
+
+async def _measure(method, text, limit, repeat):
+    _times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _result = await method(text, limit)
+        _times.append((time.perf_counter() - start) * 1000)
+    _times.sort()
+    return len(_result), statistics.median(_times), _times[int(len(_times) * 0.95) - 1]
+
+async def run(counts, limit, repeat):
+    config.connect()
+    for count in counts:
+        await _seed(count)
+        print(f"{count} users, limit {limit}, {repeat} runs per query (p50 / p95 ms)")
+        for text in QUERIES:
+            found_regex, p50_regex, p95_regex = await _measure(_regex, text, limit, repeat)
+            found_search, p50_search, p95_search = await _measure(_search, text, limit, repeat)
+            print(f"  {text!r:14} regex {p50_regex:8.2f} / {p95_regex:8.2f} ({found_regex:3})"
+                  f"   search {p50_search:8.2f} / {p95_search:8.2f} ({found_search:3})")
+
+# python benchmarks/user_search.py --users 100000 1000000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.limit, args.repeat))
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+import httpx
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+"""
+benchmarks/write_batching.py: Rafaga de mensajes con muchos clientes a la vez frente a un pool de Mongo pequeño: inserciones por
+segundo y latencia p50/p99 con un insert_one por peticion y con las inserciones por lotes (WRITE_BATCH_ENABLED) con varios tiempos
+de espera; directamente sobre la coleccion y a traves de PUT /users/{id}/messages/ y PUT /users/{id}/reviews/ (que actualizan
+tambien las bandejas de entrada y las estadisticas del conductor), con los comandos de Mongo por peticion. Necesita un mongod
+accesible en MONGODB_URL (--backend mock solo para probar el script; sin comandos)
+"""
+
+config.settings.mongodb_database = os.environ.get("BENCH_DATABASE", "BlaBlaETSIINF_bench")
+
+import main
+import writebehind
+from dataset import Scale, seed
+from indexes import ensureIndexes
+from metrics import WRITE_BATCH_SIZE
+from read_cache import Commands
+from suite import _connect
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def _batches(collection: str):
+    series = WRITE_BATCH_SIZE._values.get((collection,))
+    return (series[1], series[2]) if series else (0, 0)
+
+async def _burst(send, count: int, clients: int):
+    samples, errors = [], 0
+    pending = iter(range(count))
+    async def worker():
+        nonlocal errors
+        for i in pending:
+            start = time.perf_counter()
+            try:
+                await send(i)
+            except Exception:
+                errors += 1
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(clients)])
+    return samples, errors, time.perf_counter() - start
+
+async def _senders(dataset):
+    users = dataset.users
+    def message(i):
+        return {"sender_id": users[i % len(users)], "recipient_id": users[(i + 1) % len(users)], "content": f"bench {i}",
+                "date": "2024-03-01T08:00:00"}
+    async def insert(i):
+        await writebehind.insertOne("messages", dict(message(i), _id=str(uuid.uuid4())))
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=None)
+    async def put(path, body):
+        response = await client.put(path, json=body)
+        if response.json()["code"] != "200":
+            raise RuntimeError(response.text)
+    async def route(i):
+        _message = message(i)
+        await put(f"/BlaBlaETSIINF/users/{_message['sender_id']}/messages/", _message)
+    async def review(i):
+        driver = users[(i + 1) % len(users)]
+        await put(f"/BlaBlaETSIINF/users/{driver}/reviews/", {"reviewer_id": users[i % len(users)], "driver_id": driver,
+                                                              "rating": i % 5 + 1, "comment": f"bench {i}", "date": "2024-03-01T08:00:00"})
+    # Nivel, envio y coleccion en la que se agrupan sus inserciones
+    return [("insert", insert, "messages"), ("route", route, "messages"), ("review", review, "reviews")], client
+
+async def run(backend, users, pool, count, clients, lingers, max_size, seed_value):
+    # Un pool pequeño para que el numero de comandos sea el cuello de botella
+    config.settings.mongodb_max_pool_size = pool
+    commands = Commands()
+    # Se registra antes de crear el cliente para que lo reciba (mongomock no envia comandos)
+    monitoring.register(commands)
+    _connect(backend)
+    await ensureIndexes(config.database)
+    dataset, _ = await seed(config.database, Scale(users=users), seed_value)
+    senders, client = await _senders(dataset)
+    config.settings.write_batch_max_size = max_size
+    print(f"{count} requests, {clients} clients, pool {pool}, batches of up to {max_size}; latencies in ms")
+    print(f"{'level':>6} {'mode':>14} {'req/s':>9} {'p50':>8} {'p99':>8} {'avg batch':>9} {'cmd/req':>7} {'errors':>6}")
+    modes = [("insert_one", None)] + [(f"batch {linger:g} ms", linger) for linger in lingers]
+    for level, send, collection in senders:
+        for mode, linger in modes:
+            config.settings.write_batch_enabled = linger is not None
+            config.settings.write_batch_linger_ms = linger or 0
+            await writebehind.stop()
+            total, batches = _batches(collection)
+            commands.counts = {}
+            samples, errors, elapsed = await _burst(send, count, clients)
+            await writebehind.stop()
+            total, batches = _batches(collection)[0] - total, _batches(collection)[1] - batches
+            average = f"{total / batches:9.1f}" if batches else f"{'-':>9}"
+            # Inserciones y actualizaciones: las lecturas de la ruta (existencia de los usuarios) no dependen del lote
+            _writes = sum(number for name, number in commands.counts.items() if name in ("insert", "update"))
+            per_request = f"{_writes / count:7.2f}" if commands.counts else f"{'-':>7}"
+            print(f"{level:>6} {mode:>14} {len(samples) / elapsed:9.1f} {_percentile(samples, 0.5):8.2f} "
+                  f"{_percentile(samples, 0.99):8.2f} {average} {per_request} {errors:6}")
+    await client.aclose()
+
+# python benchmarks/write_batching.py --pool 10 --clients 200 --linger 1 2 5
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=("mongod", "mock"), default="mongod")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--pool", type=int, default=10)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--linger", type=float, nargs="+", default=[1, 2, 5])
+    parser.add_argument("--max-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.users, args.pool, args.count, args.clients, args.linger, args.max_size, args.seed))
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import sys
+import cache
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from config import connect, database
+from metrics import labelled
+from model import Booking, Message, Review, Trip, User
+from pagination import ndjson
+from passwords import derived, hashPassword
+from projection import projection
+from repository import BookingRepo, InboxRepo, MessageRepo, RatingRepo, ReviewRepo, TripRepo, UserRepo, VersionRepo
+
+"""
+bulk.py: Importacion y exportacion masiva en NDJSON de todas las colecciones, con insert_many por lotes
+"""
+
+# Modelo con el que se valida cada registro y repositorio que construye su documento
+COLLECTIONS = {
+    "bookings": (Booking, BookingRepo),
+    "messages": (Message, MessageRepo),
+    "reviews": (Review, ReviewRepo),
+    "trips": (Trip, TripRepo),
+    "users": (User, UserRepo),
+}
+
+# Registros por insert_many: limita la memoria usada sin importar el tamaño del fichero
+BATCH_SIZE = 1000
+
+# Errores que se devuelven como maximo; del resto solo se cuenta el numero
+MAX_ERRORS = 1000
+
+class ImportSummary():
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def dict(self):
+        return {"inserted": self.inserted, "failed": self.failed, "errors": self.errors}
+
+# Mismas reglas que aplican las rutas de creacion ademas del modelo
+def _check(collection: str, record):
+    if collection == "bookings" and not record.status in ["accepted", "denied", "pending"]:
+        return "Incorrect status value"
+    if collection == "reviews" and not record.rating in [1, 2, 3, 4, 5]:
+        return "Incorrect rating value"
+    return None
+
+async def _reserveSeats(batch: list, summary: ImportSummary):
+    # Las reservas aceptadas ocupan plaza como en addBooking; las que no la consiguen no se importan
+    _accepted = [(line, document) for line, document in batch if document["status"] == "accepted"]
+    _reserved = await asyncio.gather(*[TripRepo.reserveSeat(document["trip_id"], document["_id"]) for _, document in _accepted])
+    _rejected = {document["_id"] for (line, document), reserved in zip(_accepted, _reserved) if not reserved}
+    # Las que ya ocupan su plaza (la misma exportacion importada dos veces) son reservas repetidas, no viajes llenos
+    _held = set()
+    if _rejected:
+        async for trip in database.get_collection('trips').find({"accepted_bookings": {"$in": list(_rejected)}}, {"accepted_bookings": 1}):
+            _held.update(_rejected.intersection(trip["accepted_bookings"]))
+    for line, document in _accepted:
+        if document["_id"] in _held:
+            summary.error(line, f"Duplicate booking {document['_id']}")
+        elif document["_id"] in _rejected:
+            summary.error(line, "No places available")
+    return [(line, document) for line, document in batch if document["_id"] not in _rejected]
+
+async def _hashPasswords(batch: list):
+    # Como addUser: se guarda la contraseña derivada. Todo el lote a la vez en el pool de passwords.py (AUTH_HASH_WORKERS hilos)
+    _pending = [document for _, document in batch if document["password"] and not derived(document["password"])]
+    _hashes = await asyncio.gather(*[hashPassword(document["password"]) for document in _pending])
+    for document, hashed in zip(_pending, _hashes):
+        document["password"] = hashed
+
+async def _flush(collection: str, batch: list, summary: ImportSummary):
+    if collection == "bookings":
+        batch = await _reserveSeats(batch, summary)
+    if collection == "users":
+        await _hashPasswords(batch)
+    if not batch:
+        return
+    _failed = set()
+    try:
+        # Desordenado: un documento erroneo no impide insertar el resto del lote
+        result = await database.get_collection(collection).insert_many([document for _, document in batch], ordered=False)
+        summary.inserted += len(result.inserted_ids)
+    except BulkWriteError as exc:
+        summary.inserted += exc.details["nInserted"]
+        _failed = {error["index"] for error in exc.details["writeErrors"]}
+        for error in exc.details["writeErrors"]:
+            line, document = batch[error["index"]]
+            summary.error(line, error["errmsg"])
+            if collection == "bookings" and document["status"] == "accepted":
+                await TripRepo.releaseSeat(document["trip_id"], document["_id"])
+    # Las estadisticas de los conductores afectados se recalculan una vez por lote
+    if collection == "reviews":
+        await RatingRepo.rebuild({document["driver_id"] for _, document in batch})
+    # Las conversaciones de los mensajes insertados, en un solo bulk_write por lote
+    if collection == "messages":
+        await InboxRepo.applyMessages([document for index, (_, document) in enumerate(batch) if index not in _failed])
+    # Los ids importados pueden estar en la cache como inexistentes (consultados antes de la importacion)
+    if collection in cache.CACHED:
+        await cache.invalidate(collection, *[document["_id"] for _, document in batch])
+    # Un cambio en el listado de viajes por lote
+    if collection == "trips":
+        await VersionRepo.bump('trips')
+
+# importRecords(collection: str, lines): valida e inserta por lotes las lineas NDJSON de un iterable asincrono
+@labelled("bulk.importRecords")
+async def importRecords(collection: str, lines):
+    model, repo = COLLECTIONS[collection]
+    summary = ImportSummary()
+    _batch = []
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            # Las exportaciones no llevan la contraseña: esos usuarios se importan sin ella y no pueden iniciar sesion hasta fijarla
+            if collection == "users" and isinstance(data, dict) and "password" not in data:
+                data["password"] = ""
+            record = model.parse_obj(data)
+        except (ValueError, ValidationError) as exc:
+            summary.error(number, str(exc))
+            continue
+        message = _check(collection, record)
+        if message:
+            summary.error(number, message)
+            continue
+        document = repo.toDocument(record)
+        # Se conserva el id del registro: una exportacion importada de nuevo mantiene las referencias entre colecciones
+        if isinstance(data.get("_id"), str) and data["_id"]:
+            document["_id"] = data["_id"]
+        if collection == "users" and not document["password"]:
+            document["password"] = None
+        _batch.append((number, document))
+        if len(_batch) >= BATCH_SIZE:
+            await _flush(collection, _batch, summary)
+            _batch = []
+    await _flush(collection, _batch, summary)
+    return summary
+
+# splitLines(chunks): convierte un flujo asincrono de bloques de bytes en lineas
+async def splitLines(chunks):
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+# exportRecords(collection: str): genera las lineas NDJSON de una coleccion leyendo con un cursor de Motor
+# Solo salen los campos del modelo, los mismos que lee la importacion: nunca password ni los campos internos
+# Los viajes salen con todas sus plazas (libres y de reservas aceptadas): al importar sus reservas, las aceptadas las vuelven a ocupar
+def exportRecords(collection: str):
+    if collection == "trips":
+        _fields = dict(projection(collection), available_places={"$add": ["$available_places", {"$size": {"$ifNull": ["$accepted_bookings", []]}}]})
+        cursor = database.get_collection(collection).aggregate([{"$sort": {"_id": 1}}, {"$project": _fields}], batchSize=BATCH_SIZE)
+        return ndjson(cursor)
+    cursor = database.get_collection(collection).find({}, projection(collection)).sort("_id", 1).batch_size(BATCH_SIZE)
+    return ndjson(cursor)
+
+async def _fileLines(path: str):
+    with open(path, "rb") as file:
+        for line in file:
+            yield line
+
+async def _main(argv):
+    connect()
+    if len(argv) < 2 or argv[0] not in ("import", "export") or argv[1] not in COLLECTIONS or (argv[0] == "import" and len(argv) < 3):
+        print("usage: python bulk.py import <collection> <file.ndjson> | export <collection>", file=sys.stderr)
+        return 2
+    if argv[0] == "export":
+        async for line in exportRecords(argv[1]):
+            sys.stdout.buffer.write(line)
+        return 0
+    summary = await importRecords(argv[1], _fileLines(argv[2]))
+    print(f"inserted: {summary.inserted}  failed: {summary.failed}", file=sys.stderr)
+    for error in summary.errors:
+        print(f"  line {error['line']}: {error['error']}", file=sys.stderr)
+    return 1 if summary.failed else 0
+
+# python bulk.py import <coleccion> <fichero.ndjson> | export <coleccion> > fichero.ndjson
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
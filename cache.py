@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from config import settings
+from metrics import CACHE_EVICTIONS, CACHE_HITS, CACHE_MISSES
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+"""
+cache.py: Cache en memoria (LRU con caducidad) de las lecturas por id de usuarios y viajes, invalidada por el repositorio
+en cada escritura y avisada al resto de workers por un bus (local o Redis)
+"""
+
+logger = logging.getLogger(__name__)
+
+# Colecciones con cache; la clave es el _id y el valor el documento completo (o None si no existe)
+CACHED = ("trips", "users")
+
+# Canal de Redis por el que los workers se avisan de las invalidaciones
+CHANNEL = "BlaBlaETSIINF:cache"
+
+# Espera antes de volver a suscribirse al bus tras perder la conexion; se dobla en cada fallo hasta el maximo
+RECONNECT_MIN_SECONDS = 0.5
+RECONNECT_MAX_SECONDS = 30
+
+# Identifica a este proceso en el bus para no procesar sus propios avisos
+ORIGIN = str(uuid.uuid4())
+
+# Valor de get() cuando la clave no esta en la cache (None significa "no existe en la base de datos")
+MISSING = object()
+
+class Cache():
+    # LRU acotada a max_size entradas que caducan a los ttl segundos. Las cargas simultaneas de una misma clave
+    # se agrupan en una sola consulta, y una carga que coincide con una invalidacion no se guarda
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name, self.max_size, self.ttl = name, max_size, ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    # peek(key): valor guardado y vigente de la clave o MISSING, sin consultar la base de datos
+    def peek(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            CACHE_EVICTIONS.inc(self.name)
+
+    # get(key, load): valor de la clave; si no esta, lo obtiene con await load(key) y lo guarda
+    async def get(self, key, load):
+        if self.max_size <= 0:
+            return await load(key)
+        value = self.peek(key)
+        if value is not MISSING:
+            CACHE_HITS.inc(self.name)
+            return value
+        loading = self._loading.get(key)
+        if loading is not None:
+            # Otra peticion ya la esta leyendo: se espera a su resultado sin lanzar otra consulta
+            CACHE_HITS.inc(self.name)
+            return await asyncio.shield(loading)
+        CACHE_MISSES.inc(self.name)
+        loading = self._loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await load(key)
+        except Exception as exc:
+            if self._loading.get(key) is loading:
+                del self._loading[key]
+            loading.set_exception(exc)
+            # Marca la excepcion como recogida aunque nadie mas estuviera esperando
+            loading.exception()
+            raise
+        # Si se ha invalidado mientras se leia, lo leido puede ser anterior a la escritura: se devuelve pero no se guarda
+        if self._loading.get(key) is loading:
+            del self._loading[key]
+            self._store(key, value)
+        loading.set_result(value)
+        return value
+
+    # discard(*keys): borra las claves y descarta las cargas en curso
+    def discard(self, *keys):
+        for key in keys:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class LocalBus():
+    # Un solo proceso: invalidate() ya ha borrado la entrada, no hay nadie mas a quien avisar
+    async def start(self, handler, reset):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, name: str, keys: list):
+        pass
+
+class RedisBus():
+    # Pub/sub de Redis: cada worker publica sus invalidaciones y aplica las de los demas. Si se pierde la conexion se
+    # vuelve a suscribir con esperas crecientes y, al conseguirlo, vacia sus caches: los avisos perdidos no se reciben.
+    # Mientras esta desconectado, las entradas siguen caducando a los CACHE_TTL_SECONDS
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError("CACHE_BUS=redis needs the redis package (pip install redis)")
+        self.url = url
+        self._client = None
+        self._task = None
+
+    # start(handler, reset): se suscribe (falla si Redis no esta disponible al arrancar) y escucha en segundo plano;
+    # handler(name, keys) aplica cada aviso y reset() vacia las caches tras una reconexion
+    async def start(self, handler, reset):
+        self._client = redis.from_url(self.url)
+        pubsub = self._client.pubsub()
+        await pubsub.subscribe(CHANNEL)
+        self._task = asyncio.create_task(self._listen(pubsub, handler, reset))
+
+    async def _listen(self, pubsub, handler, reset):
+        delay = RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._client.pubsub()
+                    await pubsub.subscribe(CHANNEL)
+                    reset()
+                    logger.warning("Cache bus reconnected; local caches cleared")
+                    delay = RECONNECT_MIN_SECONDS
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    event = json.loads(message["data"])
+                    if event["origin"] != ORIGIN:
+                        handler(event["cache"], event["keys"])
+                logger.warning("Cache bus subscription ended, reconnecting in %s s", delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Cache bus connection lost, reconnecting in %s s", delay, exc_info=True)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.close()
+                    except Exception:
+                        pass
+                    pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def publish(self, name: str, keys: list):
+        try:
+            await self._client.publish(CHANNEL, json.dumps({"origin": ORIGIN, "cache": name, "keys": keys}))
+        except Exception:
+            # La escritura ya esta hecha: no falla por el aviso, los demas workers lo veran al caducar
+            logger.exception("Could not publish cache invalidation")
+
+# Caches por coleccion y bus en uso; configure() y start() los sustituyen
+caches = {}
+bus = LocalBus()
+
+# configure(max_size: int, ttl: float): crea las caches vacias con ese tamaño y caducidad (max_size 0 las desactiva)
+def configure(max_size: int = None, ttl: float = None):
+    global caches
+    max_size = settings.cache_max_size if max_size is None else max_size
+    ttl = settings.cache_ttl_seconds if ttl is None else ttl
+    caches = {name: Cache(name, max_size, ttl) for name in CACHED}
+
+configure()
+
+def _discard(name: str, keys: list):
+    caches[name].discard(*keys)
+
+def _reset():
+    for cache in caches.values():
+        cache.clear()
+
+# start(): abre el bus de CACHE_BUS para recibir las invalidaciones de los demas workers
+async def start():
+    global bus
+    configure()
+    bus = RedisBus(settings.cache_redis_url) if settings.cache_bus == "redis" else LocalBus()
+    await bus.start(_discard, _reset)
+
+async def stop():
+    await bus.stop()
+
+# get(name: str, key, load): documento de la cache name o, si no esta, el que devuelve await load(key)
+async def get(name: str, key, load):
+    return await caches[name].get(key, load)
+
+# peek(name: str, key): documento guardado en la cache name o MISSING, sin consultar la base de datos
+def peek(name: str, key):
+    cache = caches[name]
+    if cache.max_size <= 0:
+        return MISSING
+    value = cache.peek(key)
+    if value is MISSING:
+        CACHE_MISSES.inc(name)
+    else:
+        CACHE_HITS.inc(name)
+    return value
+
+# invalidate(name: str, *keys): borra las claves en este proceso antes de volver y avisa a los demas workers
+async def invalidate(name: str, *keys):
+    if not keys:
+        return
+    _discard(name, keys)
+    await bus.publish(name, list(keys))
+
+# select(document: dict, projection: dict): copia del documento con solo los campos de la proyeccion (de inclusion)
+def select(document: dict, projection: dict = None):
+    if document is None:
+        return None
+    if not projection:
+        return dict(document)
+    return {field: value for field, value in document.items() if field in projection}
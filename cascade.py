@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from datetime import datetime
+import cache
+from config import database
+from metrics import labelled
+from repository import ARCHIVES, JobRepo, RatingRepo, VersionRepo
+
+"""
+cascade.py: Borrado en cascada de usuarios y viajes con delete_many, en transaccion si el despliegue lo permite
+"""
+
+logger = logging.getLogger(__name__)
+
+# Se averigua una vez si el despliegue admite transacciones (replica set o mongos)
+_transactions = None
+
+# Tareas en segundo plano en curso; se guarda la referencia para que no las recoja el recolector
+_jobs = set()
+
+# supportsTransactions(): comprueba si el servidor es un replica set o un mongos
+async def supportsTransactions():
+    global _transactions
+    if _transactions is None:
+        hello = await database.client.admin.command("hello")
+        _transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions
+
+async def _deleteTrip(id: str, session=None):
+    _deleted = {}
+    result = await database.get_collection('bookings').delete_many({"trip_id":id}, session=session)
+    _deleted["bookings"] = result.deleted_count
+    result = await database.get_collection('trips').delete_one({"_id":id}, session=session)
+    _deleted["trips"] = result.deleted_count
+    return _deleted
+
+async def _deleteUser(id: str, session=None):
+    _deleted = {}
+    trips = database.get_collection('trips')
+    bookings = database.get_collection('bookings')
+    _tripIds = await trips.distinct("_id", {"driver_id":id}, session=session)
+    # Las reservas aceptadas del usuario en viajes de otros conductores devuelven su plaza, todas en una operacion
+    _accepted = await bookings.distinct("_id", {"user_id":id, "status":"accepted"}, session=session)
+    if _accepted:
+        await trips.update_many({"accepted_bookings":{"$in":_accepted}}, [{"$set":{
+            "available_places":{"$add":["$available_places", {"$size":{"$setIntersection":["$accepted_bookings", _accepted]}}]},
+            "accepted_bookings":{"$setDifference":["$accepted_bookings", _accepted]},
+            "version":{"$add":[{"$ifNull":["$version", 0]}, 1]},
+            "updated_at":datetime.utcnow(),
+        }}], session=session)
+    # Reservas del usuario y reservas de sus viajes
+    result = await bookings.delete_many({"$or":[{"user_id":id}, {"trip_id":{"$in":_tripIds}}]}, session=session)
+    _deleted["bookings"] = result.deleted_count
+    # Historial archivado: viajes terminados del usuario y sus reservas
+    _archivedTripIds = await database.get_collection(ARCHIVES['trips']).distinct("_id", {"driver_id":id}, session=session)
+    result = await database.get_collection(ARCHIVES['bookings']).delete_many(
+        {"$or":[{"user_id":id}, {"trip_id":{"$in":_archivedTripIds}}]}, session=session)
+    _deleted["bookings_archive"] = result.deleted_count
+    result = await database.get_collection(ARCHIVES['trips']).delete_many({"driver_id":id}, session=session)
+    _deleted["trips_archive"] = result.deleted_count
+    # Reseñas recibidas y escritas por el usuario
+    result = await database.get_collection('reviews').delete_many({"$or":[{"driver_id":id}, {"reviewer_id":id}]}, session=session)
+    _deleted["reviews"] = result.deleted_count
+    await database.get_collection('driver_stats').delete_one({"_id":id}, session=session)
+    result = await database.get_collection('messages').delete_many({"$or":[{"sender_id":id}, {"recipient_id":id}]}, session=session)
+    _deleted["messages"] = result.deleted_count
+    # Conversaciones del usuario y las de los demas con el
+    await database.get_collection('inbox').delete_many({"$or":[{"user_id":id}, {"peer_id":id}]}, session=session)
+    result = await trips.delete_many({"driver_id":id}, session=session)
+    _deleted["trips"] = result.deleted_count
+    # El usuario se borra el ultimo: si algo falla se puede repetir el borrado
+    result = await database.get_collection('users').delete_one({"_id":id}, session=session)
+    _deleted["users"] = result.deleted_count
+    return _deleted
+
+async def _run(operation, id: str, transactional: bool = True):
+    if transactional and await supportsTransactions():
+        async with await database.client.start_session() as session:
+            return await session.with_transaction(lambda session: operation(id, session))
+    return await operation(id)
+
+# deleteTrip(id: str): borra el viaje y sus reservas; devuelve el numero de documentos borrados por coleccion
+@labelled("cascade.deleteTrip")
+async def deleteTrip(id: str):
+    _deleted = await _run(_deleteTrip, id)
+    # Despues de confirmar: dentro de la transaccion otra peticion podria volver a cargar el viaje aun sin borrar
+    await cache.invalidate('trips', id)
+    await VersionRepo.bump('trips')
+    return _deleted
+
+# deleteUser(id: str, transactional: bool): borra el usuario y todo lo que depende de el; devuelve el numero de documentos borrados por coleccion
+@labelled("cascade.deleteUser")
+async def deleteUser(id: str, transactional: bool = True):
+    # Conductores valorados por el usuario: al borrar sus reseñas cambian sus estadisticas
+    _drivers = await database.get_collection('reviews').distinct("driver_id", {"reviewer_id":id, "driver_id":{"$ne":id}})
+    # Viajes que cambian: los del usuario (se borran) y aquellos en los que tenia plaza (la devuelve)
+    _trips = set(await database.get_collection('trips').distinct("_id", {"driver_id":id}))
+    _trips.update(await database.get_collection('bookings').distinct("trip_id", {"user_id":id, "status":"accepted"}))
+    _deleted = await _run(_deleteUser, id, transactional)
+    # Despues de confirmar, en este worker y en los demas (bus de la cache)
+    await cache.invalidate('users', id)
+    await cache.invalidate('trips', *_trips)
+    await VersionRepo.bump('trips')
+    # Se recalculan desde reviews una vez confirmado el borrado
+    if _drivers:
+        await RatingRepo.rebuild(_drivers)
+    return _deleted
+
+async def _runJob(job_id: str, operation, id: str):
+    try:
+        # Sin transaccion: un usuario muy grande podria superar los limites de tamaño y tiempo de una transaccion
+        _deleted = await operation(id, transactional=False)
+    except Exception as exc:
+        logger.exception("Background job %s failed", job_id)
+        await JobRepo.finishJob(job_id, "failed", {"error": str(exc)})
+    else:
+        await JobRepo.finishJob(job_id, "done", _deleted)
+
+# deleteUserInBackground(id: str, requested_by: str): lanza el borrado en cascada como trabajo en segundo plano y devuelve el id del trabajo
+async def deleteUserInBackground(id: str, requested_by: str = None):
+    job_id = await JobRepo.addJob("delete_user", id, requested_by)
+    task = asyncio.create_task(_runJob(job_id, deleteUser, id))
+    _jobs.add(task)
+    task.add_done_callback(_jobs.discard)
+    return job_id
@@ -1,8 +1,136 @@
 import motor.motor_asyncio
+from typing import Optional
+from pydantic import BaseSettings
+from pymongo import ReadPreference
+from metrics import CommandMetrics
+from pool import PoolMonitor
 
-MONGODB_URL = 'mongodb://localhost:27017'
+"""
+config.py: Configuracion por variables de entorno y ciclo de vida del cliente de Motor (connect/close desde el lifespan)
+"""
 
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
+class Settings(BaseSettings):
+    # Cada campo se lee de la variable de entorno con el mismo nombre en mayusculas (MONGODB_URL, MONGODB_MAX_POOL_SIZE...)
+    mongodb_url: str = 'mongodb://localhost:27017'
+    mongodb_database: str = "BlaBlaETSIINF"
+    mongodb_app_name: str = "BlaBlaETSIINF"
+    # Conexiones por proceso: con varios workers el total es workers * max_pool_size
+    mongodb_max_pool_size: int = 100
+    mongodb_min_pool_size: int = 0
+    mongodb_max_idle_time_ms: Optional[int] = None
+    # Tiempo maximo esperando una conexion libre del pool (sin limite por defecto)
+    mongodb_wait_queue_timeout_ms: Optional[int] = None
+    mongodb_connect_timeout_ms: int = 20000
+    mongodb_server_selection_timeout_ms: int = 30000
+    mongodb_socket_timeout_ms: Optional[int] = None
+    # Compresion de red separada por comas: "zstd,snappy,zlib" (zstd y snappy necesitan sus paquetes)
+    mongodb_compressors: Optional[str] = None
+    # Preferencia de lectura de los listados y busquedas que toleran datos ligeramente desfasados
+    mongodb_list_read_preference: str = "primary"
+    # Comandos de Mongo que tardan al menos estos milisegundos se registran en el log con la forma de su filtro
+    mongodb_slow_query_ms: Optional[int] = None
+    # Archivado de viajes terminados (archive.py): cada cuantos segundos se lanza (0 lo desactiva), viajes por lote
+    # y pausa entre lotes para no competir con las peticiones
+    archive_interval_seconds: int = 3600
+    archive_batch_size: int = 200
+    archive_pause_ms: int = 200
+    # Aviso de mensajes nuevos (conversations.py): "local" (solo este proceso), "changestream" (todos los workers, necesita
+    # replica set o mongos) o "auto" (change stream si el despliegue lo admite)
+    message_broker: str = "auto"
+    # Cache de usuarios y viajes por id (cache.py): entradas por coleccion (0 la desactiva) y segundos que vale cada una
+    cache_max_size: int = 10000
+    cache_ttl_seconds: float = 30
+    # Aviso de invalidaciones entre workers: "local" (un solo proceso) o "redis" (pub/sub en CACHE_REDIS_URL, paquete redis)
+    cache_bus: str = "local"
+    cache_redis_url: str = "redis://localhost:6379/0"
+    # Control de admision (admission.py): peticiones a la vez por proceso (0 lo desactiva; no mas que MONGODB_MAX_POOL_SIZE), peticiones que
+    # pueden esperar, cuanto como maximo y Retry-After de las respuestas 503. Los grupos de rutas se reparten estos valores
+    admission_max_concurrency: int = 100
+    admission_queue_size: int = 200
+    admission_queue_timeout_ms: int = 2000
+    admission_retry_after_seconds: int = 1
+    # Limite por cliente: peticiones por segundo (0 lo desactiva) y rafaga. Detras de un proxy de confianza el cliente es
+    # la primera direccion de X-Forwarded-For
+    rate_limit_per_second: float = 0
+    rate_limit_burst: int = 20
+    rate_limit_trust_proxy: bool = False
+    # Autenticacion (auth.py): con AUTH_REQUIRED las rutas de cada usuario exigen su token (Authorization: Bearer). AUTH_SECRET firma
+    # los tokens y debe ser el mismo en todos los workers; valen AUTH_TOKEN_TTL_SECONDS y se recuerdan AUTH_TOKEN_CACHE_SIZE verificados
+    auth_required: bool = False
+    auth_secret: str = ""
+    auth_token_ttl_seconds: int = 3600
+    auth_token_cache_size: int = 10000
+    # Credencial de operador para /import y /export con AUTH_REQUIRED (Authorization: Bearer AUTH_OPERATOR_TOKEN); vacia, esas rutas
+    # quedan desactivadas
+    auth_operator_token: str = ""
+    # Contraseñas (passwords.py): hilos que derivan a la vez y coste de scrypt (N, potencia de 2)
+    auth_hash_workers: int = 4
+    auth_scrypt_n: int = 16384
+    # Inserciones por lotes (writebehind.py): las de mensajes, reservas y reseñas que llegan en WRITE_BATCH_LINGER_MS se escriben
+    # juntas en un insert_many de hasta WRITE_BATCH_MAX_SIZE; con WRITE_BATCH_QUEUE_SIZE esperando, las nuevas esperan a que haya sitio
+    write_batch_enabled: bool = False
+    write_batch_max_size: int = 100
+    write_batch_linger_ms: float = 2
+    write_batch_queue_size: int = 1000
 
-#
-database = client["BlaBlaETSIINF"]
\ No newline at end of file
+settings = Settings()
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+# readPreference(name: str): preferencia de lectura de pymongo a partir de su nombre
+def readPreference(name: str):
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference {name}: use one of {', '.join(READ_PREFERENCES)}")
+    return READ_PREFERENCES[name]
+
+# Cliente y monitor del pool abiertos por connect(); None hasta entonces
+client = None
+monitor = None
+
+class Database():
+    # Los modulos importan database antes de que exista el cliente: se resuelve en cada uso contra el de connect()
+    def _current(self):
+        if client is None:
+            raise RuntimeError("Database not connected: call config.connect() first")
+        return client[settings.mongodb_database]
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+    def __getitem__(self, name):
+        return self._current()[name]
+
+database = Database()
+
+# connect(): crea el cliente con las opciones de pool, tiempos y compresion de settings
+def connect():
+    global client, monitor
+    config = settings
+    monitor = PoolMonitor(config.mongodb_max_pool_size)
+    options = {
+        "appname": config.mongodb_app_name,
+        "maxPoolSize": config.mongodb_max_pool_size,
+        "minPoolSize": config.mongodb_min_pool_size,
+        "connectTimeoutMS": config.mongodb_connect_timeout_ms,
+        "serverSelectionTimeoutMS": config.mongodb_server_selection_timeout_ms,
+        "maxIdleTimeMS": config.mongodb_max_idle_time_ms,
+        "waitQueueTimeoutMS": config.mongodb_wait_queue_timeout_ms,
+        "socketTimeoutMS": config.mongodb_socket_timeout_ms,
+        "compressors": config.mongodb_compressors,
+    }
+    client = motor.motor_asyncio.AsyncIOMotorClient(config.mongodb_url, event_listeners=[monitor, CommandMetrics(config.mongodb_slow_query_ms)],
+                                                    **{option: value for option, value in options.items() if value is not None})
+    return client
+
+# close(): cierra las conexiones del pool
+def close():
+    global client
+    if client is not None:
+        client.close()
+        client = None
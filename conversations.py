@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import sys
+from config import connect, database, settings
+from cascade import supportsTransactions
+from dates import present
+from projection import ALLOWED_FIELDS
+from repository import InboxRepo
+from serialization import dumps
+
+"""
+conversations.py: Aviso en tiempo real de los mensajes nuevos (Server-Sent Events) con un broker en el proceso o sobre un
+change stream de Mongo, y reconstruccion de las conversaciones de los mensajes antiguos
+"""
+
+logger = logging.getLogger(__name__)
+
+# Mensajes pendientes por conexion: si un cliente no los lee se descartan (puede recuperarlos con la conversacion)
+QUEUE_SIZE = 100
+
+# Cada cuantos segundos se manda un comentario para que proxies y navegadores no cierren la conexion
+KEEPALIVE_SECONDS = 15
+
+# Espera antes de reabrir un change stream que ha fallado
+RETRY_SECONDS = 5
+
+class LocalBroker():
+    # Suscriptores de este proceso por usuario; publish avisa directamente al emisor y al receptor
+    def __init__(self):
+        self._subscribers = {}
+
+    # subscribe(user_id: str): cola en la que llegan los mensajes enviados y recibidos por el usuario
+    def subscribe(self, user_id: str):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    # unsubscribe(user_id: str, queue): deja de recibir mensajes en la cola
+    def unsubscribe(self, user_id: str, queue):
+        _queues = self._subscribers.get(user_id)
+        if _queues is not None:
+            _queues.discard(queue)
+            if not _queues:
+                del self._subscribers[user_id]
+
+    def _deliver(self, message: dict):
+        for user_id in {message["sender_id"], message["recipient_id"]}:
+            for queue in self._subscribers.get(user_id, ()):
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    pass
+
+    # publish(message: dict): avisa del mensaje recien guardado
+    async def publish(self, message: dict):
+        self._deliver(message)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class ChangeStreamBroker(LocalBroker):
+    # Cada proceso sigue las inserciones en messages con un change stream (replica set o mongos):
+    # los mensajes guardados por cualquier worker llegan a los suscriptores de todos
+    def __init__(self):
+        super().__init__()
+        self._task = None
+
+    async def publish(self, message: dict):
+        # Llega por el change stream
+        pass
+
+    async def _watch(self):
+        resume = None
+        while True:
+            try:
+                async with database.get_collection('messages').watch([{"$match":{"operationType":"insert"}}],
+                                                                     resume_after=resume) as stream:
+                    async for change in stream:
+                        resume = change["_id"]
+                        self._deliver(change["fullDocument"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Message change stream failed, reopening in %d s", RETRY_SECONDS)
+                await asyncio.sleep(RETRY_SECONDS)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# Broker en uso; start() lo sustituye por el de MESSAGE_BROKER
+broker = LocalBroker()
+
+# start(): abre el broker de MESSAGE_BROKER: "local", "changestream" o "auto" (change stream si el despliegue lo admite)
+async def start():
+    global broker
+    kind = settings.message_broker
+    if kind == "auto":
+        kind = "changestream" if await supportsTransactions() else "local"
+    broker = ChangeStreamBroker() if kind == "changestream" else LocalBroker()
+    await broker.start()
+
+# stop(): cierra el broker
+async def stop():
+    await broker.stop()
+
+def _event(message: dict):
+    _message = present('messages', {field: message[field] for field in ("_id",) + ALLOWED_FIELDS['messages'] if field in message})
+    return b"event: message\nid: " + message["_id"].encode() + b"\ndata: " + dumps(_message) + b"\n\n"
+
+# events(user_id: str): flujo Server-Sent Events con los mensajes que envia y recibe el usuario desde que se conecta
+async def events(user_id: str):
+    queue = broker.subscribe(user_id)
+    try:
+        # El navegador reintenta la conexion a los 3 s si se corta
+        yield b"retry: 3000\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            yield _event(message)
+    finally:
+        broker.unsubscribe(user_id, queue)
+
+# backfill(db): añade thread_key a los mensajes antiguos y reconstruye las conversaciones desde messages
+async def backfill(db=database):
+    result = await db.get_collection('messages').update_many({"thread_key":{"$exists":False}}, [{"$set":{"thread_key":{"$cond":[
+        {"$lte":["$sender_id", "$recipient_id"]},
+        {"$concat":["$sender_id", "|", "$recipient_id"]},
+        {"$concat":["$recipient_id", "|", "$sender_id"]},
+    ]}}}])
+    await InboxRepo.rebuild()
+    return result.modified_count
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "backfill":
+        print("usage: python conversations.py backfill", file=sys.stderr)
+        return 2
+    _updated = await backfill()
+    print(f"messages updated: {_updated}", file=sys.stderr)
+    return 0
+
+# python conversations.py backfill: thread_key de los mensajes antiguos y bandeja de entrada recalculada (con la aplicacion parada)
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import sys
+from datetime import date, datetime, time, timezone
+from pymongo import UpdateOne
+from config import connect, database
+
+"""
+dates.py: Fechas guardadas como datetime de BSON: lectura flexible de los formatos antiguos, formato compatible en las
+respuestas y migracion por lotes de los documentos que aun las tienen como texto
+"""
+
+logger = logging.getLogger(__name__)
+
+# Las horas de salida se guardan como datetime del 1 de enero de 1970: se ordenan y filtran por hora del dia
+EPOCH = datetime(1970, 1, 1)
+
+# Tipo de cada campo de fecha por coleccion:
+# "date" -> dia a medianoche ("2024-03-01"), "time" -> hora del dia ("08:00"), "datetime" -> instante ("2024-03-01T08:00:00")
+FIELDS = {
+    "messages": {"date": "datetime"},
+    "reviews": {"date": "datetime"},
+    "trips": {"day": "date", "end_date": "date", "departure_time": "time"},
+    "inbox": {"last_date": "datetime", "read_at": "datetime"},
+}
+
+# Colecciones que pueden tener fechas guardadas como texto de antes de usar datetime
+LEGACY = ("messages", "reviews", "trips")
+
+# Orden cronologico de los listados de mensajes y reseñas; el _id deshace empates para la paginacion
+DATE_SORT = [("date", 1), ("_id", 1)]
+
+# Formatos de texto que se aceptan ademas de ISO 8601
+DAY_FORMATS = ("%d/%m/%Y", "%d-%m-%Y")
+MOMENT_FORMATS = ("%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S")
+TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%H.%M")
+
+BATCH_SIZE = 1000
+
+class InvalidDate(ValueError):
+    pass
+
+def _utc(value: datetime):
+    # Mongo guarda UTC sin zona: las fechas con zona se convierten
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _moment(value):
+    if isinstance(value, datetime):
+        return _utc(value)
+    if isinstance(value, date):
+        return datetime.combine(value, time())
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            return _utc(datetime.fromisoformat(text.replace("Z", "+00:00")))
+        except ValueError:
+            pass
+        for format in DAY_FORMATS + MOMENT_FORMATS:
+            try:
+                return datetime.strptime(text, format)
+            except ValueError:
+                pass
+    raise InvalidDate(f"Invalid date {value!r}")
+
+# parseDay(value): dia a medianoche a partir de "2024-03-01", "01/03/2024", un date o un datetime
+def parseDay(value):
+    if value is None:
+        return None
+    return datetime.combine(_moment(value).date(), time())
+
+# parseTime(value): hora del dia (sobre EPOCH) a partir de "08:00", "08:00:00", un time o un datetime
+def parseTime(value):
+    if value is None:
+        return None
+    if isinstance(value, time):
+        return datetime.combine(EPOCH.date(), value.replace(tzinfo=None))
+    if isinstance(value, str):
+        for format in TIME_FORMATS:
+            try:
+                return datetime.combine(EPOCH.date(), datetime.strptime(value.strip(), format).time())
+            except ValueError:
+                pass
+    try:
+        return datetime.combine(EPOCH.date(), _moment(value).time())
+    except InvalidDate:
+        raise InvalidDate(f"Invalid time {value!r}")
+
+# parseMoment(value): instante a partir de ISO 8601 (con o sin zona), "01/03/2024 08:00", un date o un datetime
+def parseMoment(value):
+    if value is None:
+        return None
+    return _moment(value)
+
+PARSERS = {"date": parseDay, "time": parseTime, "datetime": parseMoment}
+
+def _format(kind: str, value):
+    if not isinstance(value, datetime):
+        # Documentos aun sin migrar
+        return value
+    if kind == "date":
+        return value.date().isoformat()
+    if kind == "time":
+        return value.strftime("%H:%M") if not value.second else value.strftime("%H:%M:%S")
+    return value.isoformat()
+
+# present(collection: str, documents): devuelve las fechas con el formato de texto de siempre (un documento o una lista)
+def present(collection: str, documents):
+    _fields = FIELDS[collection]
+    for document in documents if isinstance(documents, list) else [documents]:
+        for field, kind in _fields.items():
+            if field in document:
+                document[field] = _format(kind, document[field])
+    return documents
+
+# presenter(collection: str): funcion que aplica present a un documento, para las respuestas en streaming
+def presenter(collection: str):
+    return lambda document: present(collection, document)
+
+def _converted(collection: str, document: dict):
+    _set = {}
+    for field, kind in FIELDS[collection].items():
+        if isinstance(document.get(field), str):
+            _set[field] = PARSERS[kind](document[field])
+    return _set
+
+# migrate(collection: str, restart: bool): convierte por lotes los campos de fecha guardados como texto
+# Reanudable: guarda el ultimo _id procesado en la coleccion migrations. Cada documento se actualiza solo si sigue
+# teniendo el texto leido, asi que no pisa escrituras de la aplicacion mientras corre
+async def migrate(collection: str, db=database, restart: bool = False, batch_size: int = BATCH_SIZE):
+    checkpoints = db.get_collection('migrations')
+    key = f"dates.{collection}"
+    checkpoint = None if restart else await checkpoints.find_one({"_id": key})
+    last = checkpoint["last_id"] if checkpoint else None
+    _summary = {"converted": 0, "invalid": 0}
+    query = {"$or": [{field: {"$type": "string"}} for field in FIELDS[collection]]}
+    projection = {field: 1 for field in FIELDS[collection]}
+    while True:
+        _query = {"$and": [query, {"_id": {"$gt": last}}]} if last is not None else query
+        _batch = await db.get_collection(collection).find(_query, projection).sort("_id", 1).limit(batch_size).to_list(None)
+        if not _batch:
+            break
+        _operations = []
+        for document in _batch:
+            try:
+                _set = _converted(collection, document)
+            except InvalidDate as exc:
+                # Se deja como estaba y se informa; se puede corregir a mano y repetir con --restart
+                _summary["invalid"] += 1
+                logger.warning("%s %s: %s", collection, document["_id"], exc)
+                continue
+            _filter = {"_id": document["_id"], **{field: document[field] for field in _set}}
+            _operations.append(UpdateOne(_filter, {"$set": _set}))
+        if _operations:
+            result = await db.get_collection(collection).bulk_write(_operations, ordered=False)
+            _summary["converted"] += result.modified_count
+        last = _batch[-1]["_id"]
+        await checkpoints.update_one({"_id": key}, {"$set": {"last_id": last, "updated_at": datetime.utcnow()}}, upsert=True)
+    return _summary
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "migrate":
+        print("usage: python dates.py migrate [collection ...] [--restart] [--batch-size N]", file=sys.stderr)
+        return 2
+    restart = "--restart" in argv
+    batch_size = int(argv[argv.index("--batch-size") + 1]) if "--batch-size" in argv else BATCH_SIZE
+    _collections = [collection for collection in argv[1:] if collection in LEGACY] or list(LEGACY)
+    for collection in _collections:
+        _summary = await migrate(collection, restart=restart, batch_size=batch_size)
+        print(f"{collection}: converted {_summary['converted']}  invalid {_summary['invalid']}", file=sys.stderr)
+    return 0
+
+# python dates.py migrate [coleccion ...] [--restart] [--batch-size N]: pasa a datetime las fechas guardadas como texto
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
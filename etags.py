@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi.responses import Response as HTTPResponse
+from metrics import setCode
+
+"""
+etags.py: Validadores HTTP (ETag y Last-Modified) de las lecturas a partir de la version y la fecha de modificacion que el
+repositorio guarda en cada documento, y respuesta 304 a las peticiones condicionales cuya copia sigue vigente
+"""
+
+# Campos de version de los documentos; se leen para los validadores pero no salen en la respuesta
+STAMP_FIELDS = ("updated_at", "version")
+
+STAMP_PROJECTION = {field: 1 for field in STAMP_FIELDS}
+
+# stamp(): version y fecha de modificacion de un documento nuevo
+def stamp():
+    return {"version": 1, "updated_at": datetime.utcnow()}
+
+# touch(update: dict): la actualizacion update ademas sube la version del documento y cambia su fecha de modificacion
+# (los documentos anteriores a las versiones no tienen version: $inc la crea con 1)
+def touch(update: dict):
+    _update = dict(update)
+    _update["$set"] = dict(update.get("$set", {}), updated_at=datetime.utcnow())
+    _update["$inc"] = dict(update.get("$inc", {}), version=1)
+    return _update
+
+# split(document: dict): quita del documento sus campos de version y los devuelve
+def split(document: dict):
+    return {field: document.pop(field, None) for field in STAMP_FIELDS}
+
+# validators(key: str, stamp: dict): cabeceras ETag y Last-Modified de la representacion de key en esa version
+def validators(key: str, stamp: dict):
+    _headers = {"ETag": f'"{key}-{stamp.get("version") or 0}"'}
+    if stamp.get("updated_at") is not None:
+        _headers["Last-Modified"] = format_datetime(stamp["updated_at"].replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+    return _headers
+
+# conditional(request): si la peticion trae una copia que validar (If-None-Match o If-Modified-Since)
+def conditional(request):
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+# notModified(request, headers: dict): si la copia del cliente corresponde a los validadores de headers
+# If-None-Match tiene preferencia; If-Modified-Since solo se mira sin el (tiene resolucion de segundos)
+def notModified(request, headers: dict):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Comparacion debil: W/"x" equivale a "x"
+        _tags = {tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")}
+        return "*" in _tags or headers["ETag"] in _tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or "Last-Modified" not in headers:
+        return False
+    try:
+        return parsedate_to_datetime(headers["Last-Modified"]) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+# notModifiedResponse(headers: dict): 304 sin cuerpo con los validadores vigentes
+def notModifiedResponse(headers: dict):
+    setCode("304")
+    return HTTPResponse(status_code=304, headers=headers)
@@ -0,0 +1,122 @@
+import asyncio
+import csv
+import os
+import sys
+from pymongo import UpdateOne
+from config import connect, database
+from search import normalize
+
+"""
+geo.py: Coordenadas GeoJSON de municipios, codigos postales y campus a partir del nomenclator de data/ (sin servicios externos)
+para la busqueda de viajes por cercania
+"""
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.csv")
+
+# Radio de la Tierra en metros que usa Mongo para pasar de metros a radianes en $centerSphere
+EARTH_RADIUS = 6378100
+
+# Radios de busqueda en metros
+DEFAULT_RADIUS = 2000
+MAX_RADIUS = 50000
+
+# Orden de la busqueda por cercania: distancia al origen en metros; el _id deshace empates (varios viajes salen del mismo lugar)
+NEAR_SORT = [("distance", 1), ("_id", 1)]
+
+# Campo de texto del viaje -> campo con su punto GeoJSON
+TRIP_POINTS = {"start_location": "start_point", "arrival_location": "arrival_point"}
+
+BATCH_SIZE = 1000
+
+# Nombre normalizado -> punto; se lee del fichero la primera vez que se usa
+_gazetteer = None
+
+class InvalidLocation(ValueError):
+    pass
+
+# point(lon: float, lat: float): punto GeoJSON (longitud primero, como espera Mongo)
+def point(lon: float, lat: float):
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+# gazetteer(): nomenclator de data/gazetteer.csv indexado por nombre o codigo postal normalizado
+def gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        with open(GAZETTEER_PATH, newline="", encoding="utf-8") as file:
+            _gazetteer = {normalize(row["name"]): point(float(row["lon"]), float(row["lat"])) for row in csv.DictReader(file)}
+    return _gazetteer
+
+# resolve(place: str): punto de un municipio, codigo postal o campus sin distinguir mayusculas ni tildes; None si no esta
+def resolve(place: str):
+    if not place:
+        return None
+    return gazetteer().get(normalize(place))
+
+# location(place: str, lat: float, lon: float): punto de unas coordenadas o de un lugar del nomenclator; None si no se da ninguno
+def location(place: str = None, lat: float = None, lon: float = None):
+    if lat is not None or lon is not None:
+        if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            raise InvalidLocation("Coordinates need both lat (-90..90) and lon (-180..180)")
+        return point(lon, lat)
+    if place is None:
+        return None
+    _point = resolve(place)
+    if _point is None:
+        raise InvalidLocation(f"Unknown place {place}")
+    return _point
+
+# tripPoints(fields: dict): puntos de los lugares presentes en fields (un viaje o los campos que cambian); None si no se conocen
+def tripPoints(fields: dict):
+    return {point_field: resolve(fields[field]) for field, point_field in TRIP_POINTS.items() if field in fields}
+
+# userPoint(municipality: str, zip_code: str): punto de la casa del usuario, por codigo postal y si no por municipio
+def userPoint(municipality: str, zip_code: str):
+    return {"home_point": resolve(zip_code) or resolve(municipality)}
+
+# pointUpdate(fields: dict, points: dict): actualizacion que guarda fields y los puntos; los que no se conocen se quitan
+# (un lugar fuera del nomenclator deja el documento fuera de las busquedas por cercania)
+def pointUpdate(fields: dict, points: dict):
+    update = {}
+    _set = dict(fields, **{field: value for field, value in points.items() if value is not None})
+    _unset = {field: "" for field, value in points.items() if value is None}
+    if _set:
+        update["$set"] = _set
+    if _unset:
+        update["$unset"] = _unset
+    return update
+
+# backfill(db, rebuild: bool): calcula los puntos de los viajes y usuarios guardados antes de existir la busqueda por cercania
+async def backfill(db=database, rebuild: bool = False):
+    _updated = {}
+    sources = {
+        "trips": ({"start_point": {"$exists": False}}, lambda document: tripPoints(document)),
+        "users": ({"home_point": {"$exists": False}}, lambda document: userPoint(document.get("municipality"), document.get("zip_code"))),
+    }
+    for collection, (missing, points) in sources.items():
+        _collection = db.get_collection(collection)
+        _updated[collection] = 0
+        _operations = []
+        _fields = {"start_location": 1, "arrival_location": 1, "municipality": 1, "zip_code": 1}
+        async for document in _collection.find({} if rebuild else missing, _fields).batch_size(BATCH_SIZE):
+            _update = pointUpdate({}, points(document))
+            if _update:
+                _operations.append(UpdateOne({"_id": document["_id"]}, _update))
+            if len(_operations) >= BATCH_SIZE:
+                _updated[collection] += (await _collection.bulk_write(_operations, ordered=False)).modified_count
+                _operations = []
+        if _operations:
+            _updated[collection] += (await _collection.bulk_write(_operations, ordered=False)).modified_count
+    return _updated
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "backfill":
+        print("usage: python geo.py backfill [--rebuild]", file=sys.stderr)
+        return 2
+    _updated = await backfill(rebuild="--rebuild" in argv)
+    print(", ".join(f"{collection} updated: {count}" for collection, count in _updated.items()), file=sys.stderr)
+    return 0
+
+# python geo.py backfill [--rebuild]: rellena start_point/arrival_point y home_point (o los recalcula todos con --rebuild)
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
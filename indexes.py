@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import sys
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+from config import connect, database
+from dates import DATE_SORT, EPOCH
+from geo import resolve
+from pagination import ID_SORT
+
+"""
+indexes.py: Registro declarativo de indices por coleccion, creacion al arrancar y diagnostico de consultas con explain()
+"""
+
+logger = logging.getLogger(__name__)
+
+# Combinaciones de filtros de igualdad admitidas por la busqueda de viajes
+TRIP_SEARCH_EQUALITY = [
+    (),
+    ("day",),
+    ("day", "trip_type"),
+    ("start_location", "day"),
+    ("arrival_location", "day"),
+    ("start_location", "arrival_location"),
+    ("start_location", "arrival_location", "day"),
+    ("start_location", "arrival_location", "day", "trip_type"),
+]
+
+# Ordenaciones de la busqueda de viajes y campos de cada una ("day" es el orden cronologico: dia y hora)
+TRIP_SEARCH_SORTS = {
+    "departure_time": ("departure_time",),
+    "price": ("price",),
+    "day": ("day", "departure_time"),
+}
+
+# tripSearchKeys(equality, sort): campos del indice de una busqueda: igualdades, orden y _id (regla ESR)
+def tripSearchKeys(equality: tuple, sort: str):
+    return equality + tuple(field for field in TRIP_SEARCH_SORTS[sort] if field not in equality) + ("_id",)
+
+# Un indice por combinacion distinta de campos: con igualdad sobre day, ordenar por day o por departure_time es lo mismo
+TRIP_SEARCH_INDEXES = list({tripSearchKeys(equality, sort): None for equality in TRIP_SEARCH_EQUALITY for sort in TRIP_SEARCH_SORTS})
+
+# tripSearchSupported(fields): comprueba si hay un indice para esa combinacion de igualdades
+def tripSearchSupported(fields):
+    return set(fields) in [set(equality) for equality in TRIP_SEARCH_EQUALITY]
+
+# Indices de cada coleccion. Los listados se ordenan por _id (paginacion keyset),
+# por eso el _id va al final de cada indice compuesto: filtro y orden salen del mismo indice
+INDEXES = {
+    "bookings": [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id__id"),
+        IndexModel([("trip_id", ASCENDING), ("_id", ASCENDING)], name="trip_id__id"),
+    ],
+    # Mensajes y reseñas se listan en orden cronologico (dates.DATE_SORT) y se filtran por intervalo de fechas
+    "messages": [
+        IndexModel([("sender_id", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)], name="sender_id_date__id"),
+        IndexModel([("recipient_id", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)], name="recipient_id_date__id"),
+        # Conversacion entre dos usuarios (MessageRepo.getThread)
+        IndexModel([("thread_key", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)], name="thread_key_date__id"),
+    ],
+    # Bandeja de entrada: conversaciones de un usuario, la mas reciente primero (repository.INBOX_SORT)
+    "inbox": [
+        IndexModel([("user_id", ASCENDING), ("last_date", DESCENDING), ("_id", DESCENDING)], name="user_id_last_date__id"),
+        # Borrado en cascada de las conversaciones de los demas con un usuario
+        IndexModel([("peer_id", ASCENDING)], name="peer_id"),
+    ],
+    "reviews": [
+        IndexModel([("driver_id", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)], name="driver_id_date__id"),
+        # Borrado en cascada de las reseñas escritas por un usuario
+        IndexModel([("reviewer_id", ASCENDING)], name="reviewer_id"),
+    ],
+    "trips": [
+        IndexModel([("driver_id", ASCENDING), ("_id", ASCENDING)], name="driver_id__id"),
+        # Viajes terminados que archive.py mueve a trips_archive
+        IndexModel([("end_date", ASCENDING)], name="end_date"),
+        # Busqueda por cercania: $geoNear sobre el origen (con el dia, que casi siempre se filtra) y $geoWithin sobre el destino
+        IndexModel([("start_point", GEOSPHERE), ("day", ASCENDING)], name="start_point_day"),
+        IndexModel([("arrival_point", GEOSPHERE)], name="arrival_point"),
+    ] + [
+        # Un indice por combinacion de busqueda: igualdades, campos de orden y _id (regla ESR)
+        IndexModel([(field, ASCENDING) for field in keys], name="search_" + "_".join(keys[:-1]))
+        for keys in TRIP_SEARCH_INDEXES
+    ],
+    # Historial archivado (include_archived=true): mismos listados que las colecciones activas
+    "trips_archive": [
+        IndexModel([("driver_id", ASCENDING), ("_id", ASCENDING)], name="driver_id__id"),
+    ],
+    "bookings_archive": [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id__id"),
+        IndexModel([("trip_id", ASCENDING), ("_id", ASCENDING)], name="trip_id__id"),
+    ],
+    "users": [
+        # Prefijos normalizados de nombre y apellidos (multikey) para UserRepo.getUsersByName
+        IndexModel([("search_tokens", ASCENDING), ("_id", ASCENDING)], name="search_tokens__id"),
+        # Inicio de sesion por email (UserRepo.getCredentials); no es unico porque los usuarios anteriores pueden repetirlo
+        IndexModel([("email_address", ASCENDING)], name="email_address"),
+    ],
+}
+
+# Consultas que lanza repository.py: (metodo, coleccion, filtro, orden)
+QUERIES = [
+    ("BookingRepo.getBookingsByUser", "bookings", {"user_id": "_"}, ID_SORT),
+    ("BookingRepo.getBookingsByTrip", "bookings", {"trip_id": "_"}, ID_SORT),
+    ("MessageRepo.getMessagesBySender", "messages", {"sender_id": "_", "date": {"$gte": EPOCH}}, DATE_SORT),
+    ("MessageRepo.getMessagesByRecipient", "messages", {"recipient_id": "_"}, DATE_SORT),
+    ("MessageRepo.getMessagesByUser", "messages", {"$or": [{"sender_id": "_"}, {"recipient_id": "_"}]}, DATE_SORT),
+    ("MessageRepo.getThread", "messages", {"thread_key": "_"}, DATE_SORT),
+    ("InboxRepo.getInbox", "inbox", {"user_id": "_"}, [("last_date", DESCENDING), ("_id", DESCENDING)]),
+    ("ReviewRepo.getReviewsByUser", "reviews", {"driver_id": "_"}, DATE_SORT),
+    ("TripRepo.getTrips", "trips", {}, ID_SORT),
+    ("TripRepo.getTripsByUser", "trips", {"driver_id": "_"}, ID_SORT),
+    ("TripRepo.getTripDetail(bookings)", "bookings", {"trip_id": "_"}, None),
+] + [
+    (f"TripRepo.searchTrips({', '.join(equality + ('sort=' + sort,))})", "trips",
+     {field: "_" for field in equality}, [(field, ASCENDING) for field in TRIP_SEARCH_SORTS[sort]] + [("_id", ASCENDING)])
+    for equality in TRIP_SEARCH_EQUALITY for sort in TRIP_SEARCH_SORTS
+] + [
+    # Proximos viajes: intervalo de dias en orden cronologico
+    ("TripRepo.searchTrips(day_from, sort=day)", "trips", {"day": {"$gte": EPOCH}}, [("day", ASCENDING), ("departure_time", ASCENDING), ("_id", ASCENDING)]),
+    ("TripRepo.searchTrips(start_location, arrival_location, day_from, sort=day)", "trips",
+     {"start_location": "_", "arrival_location": "_", "day": {"$gte": EPOCH}},
+     [("day", ASCENDING), ("departure_time", ASCENDING), ("_id", ASCENDING)]),
+] + [
+    ("ArchiveRepo.archiveTrips", "trips", {"end_date": {"$lt": EPOCH}}, None),
+    ("ArchiveRepo.archiveTrips(bookings)", "bookings", {"trip_id": {"$in": ["_"]}}, None),
+    ("TripRepo.getTripsByUser(include_archived)", "trips_archive", {"driver_id": "_"}, ID_SORT),
+    ("BookingRepo.getBookingsByUser(include_archived)", "bookings_archive", {"user_id": "_"}, ID_SORT),
+    ("TripRepo.searchNear", "trips", {"start_point": {"$nearSphere": {"$geometry": resolve("ETSIINF"), "$maxDistance": 2000}}}, None),
+    ("UserRepo.getUsers", "users", {}, ID_SORT),
+    ("UserRepo.getUsersByName", "users", {"search_tokens": {"$all": ["_"]}}, None),
+    ("UserRepo.getCredentials", "users", {"email_address": "_"}, None),
+]
+
+# ensureIndexes(db): crea los indices del registro; si ya existen con la misma definicion no hace nada
+async def ensureIndexes(db=database):
+    for collection, models in INDEXES.items():
+        names = await db.get_collection(collection).create_indexes(models)
+        logger.info("Indexes ready on %s: %s", collection, ", ".join(names))
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+# explainQueries(db): ejecuta explain() sobre cada consulta del repositorio y devuelve (metodo, etapas del plan ganador)
+async def explainQueries(db=database):
+    _report = []
+    for method, collection, query, sort in QUERIES:
+        cursor = db.get_collection(collection).find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.explain()
+        winning = plan.get("queryPlanner", {}).get("winningPlan", {})
+        _report.append((method, sorted(set(_stages(winning)))))
+    return _report
+
+async def _main(argv):
+    connect()
+    if "--explain" in argv:
+        _report = await explainQueries()
+        _scans = [method for method, stages in _report if "COLLSCAN" in stages]
+        for method, stages in _report:
+            print(f"{'COLLSCAN' if method in _scans else 'ok':8} {method}: {', '.join(stages)}")
+        # Codigo de salida distinto de cero para poder usarlo como comprobacion
+        return 1 if _scans else 0
+    await ensureIndexes()
+    return 0
+
+# python indexes.py [--explain]: crea los indices o informa de las consultas que siguen haciendo COLLSCAN
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
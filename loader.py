@@ -0,0 +1,60 @@
+import asyncio
+import cache
+from config import database
+from metrics import operation
+
+"""
+loader.py: Agrupa las comprobaciones de existencia por id de una peticion en una sola consulta $in por coleccion
+"""
+
+class Loader():
+    # Comprobaciones de existencia de una coleccion, agrupadas por ciclo del event loop y memorizadas
+    def __init__(self, collection: str):
+        self.collection = collection
+        self._results = {}
+        self._pending = []
+
+    # exists(id: str): futuro que se resuelve a True si existe un documento con ese id
+    def exists(self, id: str):
+        if id in self._results:
+            return self._results[id]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._results[id] = future
+        # Usuarios y viajes que ya estan en la cache no necesitan consulta
+        if self.collection in cache.CACHED:
+            cached = cache.peek(self.collection, id)
+            if cached is not cache.MISSING:
+                future.set_result(cached is not None)
+                return future
+        self._pending.append(id)
+        # La primera peticion del ciclo programa la consulta; las demas del mismo ciclo se suman a ella
+        if len(self._pending) == 1:
+            loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return future
+
+    async def _dispatch(self):
+        # Se ejecuta en su propia tarea: la etiqueta de metricas no afecta a quien la lanzo
+        operation.set(f"Loader.{self.collection}")
+        ids, self._pending = self._pending, []
+        try:
+            _found = set()
+            collection = database.get_collection(self.collection).find({"_id": {"$in": ids}}, {"_id": 1})
+            async for document in collection:
+                _found.add(document["_id"])
+        except Exception as exc:
+            # Los errores no se memorizan: una comprobacion posterior vuelve a consultar
+            for id in ids:
+                self._results.pop(id).set_exception(exc)
+            return
+        for id in ids:
+            self._results[id].set_result(id in _found)
+
+class Loaders():
+    # Cargadores de una peticion; se inyecta con Depends(Loaders) para que cada peticion tenga los suyos
+    def __init__(self):
+        self.bookings = Loader('bookings')
+        self.messages = Loader('messages')
+        self.reviews = Loader('reviews')
+        self.trips = Loader('trips')
+        self.users = Loader('users')
@@ -1,6 +1,91 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+import archive
+from admission import AdmissionMiddleware
+from auth import Forbidden, InvalidCredentials
+import cache
+import config
+import conversations
+from metrics import MetricsMiddleware
+from indexes import ensureIndexes
+from pagination import InvalidToken
+from repository import BookingContention, TripContention
+from projection import InvalidFields
+from search import InvalidSearch
+from dates import InvalidDate
+from geo import InvalidLocation
+from serialization import respond
 import router
+import writebehind
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El cliente de Motor (y su pool) vive lo mismo que la aplicacion
+    config.connect()
+    # Crea los indices que falten antes de aceptar peticiones
+    await ensureIndexes()
+    # Archivado periodico de los viajes terminados en segundo plano
+    archive.start()
+    # Broker de los mensajes nuevos que se envian por /users/{id}/events
+    await conversations.start()
+    # Cache de usuarios y viajes y bus por el que se avisan las invalidaciones entre workers
+    await cache.start()
+    yield
+    # Las inserciones que esperan en las colas de lotes se escriben antes de cerrar el cliente
+    await writebehind.stop()
+    await cache.stop()
+    await conversations.stop()
+    await archive.stop()
+    config.close()
 
-app.include_router(router.router)
\ No newline at end of file
+app = FastAPI(lifespan=lifespan)
+
+# Limites de concurrencia por grupo de rutas y por cliente: 503/429 con Retry-After en vez de esperar en el pool de Mongo
+app.add_middleware(AdmissionMiddleware)
+
+# Latencia, peticiones en curso y codigos por plantilla de ruta (/metrics). Se añade el ultimo para envolver al control
+# de admision y contar tambien las peticiones rechazadas
+app.add_middleware(MetricsMiddleware)
+
+app.include_router(router.router)
+
+# Un token de paginacion manipulado o caducado se responde como peticion incorrecta
+@app.exception_handler(InvalidToken)
+async def invalid_token_handler(request: Request, exc: InvalidToken):
+    return respond(code=400,status="Bad Request",message=str(exc))
+
+# Campos desconocidos u ocultos en el parametro fields=
+@app.exception_handler(InvalidFields)
+async def invalid_fields_handler(request: Request, exc: InvalidFields):
+    return respond(code=400,status="Bad Request",message=str(exc))
+
+# Texto de busqueda de usuarios sin ninguna palabra utilizable
+@app.exception_handler(InvalidSearch)
+async def invalid_search_handler(request: Request, exc: InvalidSearch):
+    return respond(code=400,status="Bad Request",message=str(exc))
+
+# Fechas u horas ilegibles en los parametros de busqueda (since, until, day, departure_from...)
+@app.exception_handler(InvalidDate)
+async def invalid_date_handler(request: Request, exc: InvalidDate):
+    return respond(code=400,status="Bad Request",message=str(exc))
+
+# Lugar fuera del nomenclator o coordenadas incompletas en la busqueda por cercania
+@app.exception_handler(InvalidLocation)
+async def invalid_location_handler(request: Request, exc: InvalidLocation):
+    return respond(code=400,status="Bad Request",message=str(exc))
+
+# Token de acceso ausente (con AUTH_REQUIRED), mal formado, con otra firma o caducado
+@app.exception_handler(InvalidCredentials)
+async def invalid_credentials_handler(request: Request, exc: InvalidCredentials):
+    return respond(code=401,status="Unauthorized",message=str(exc),headers={"WWW-Authenticate": "Bearer"})
+
+# Token valido de otro usuario
+@app.exception_handler(Forbidden)
+async def forbidden_handler(request: Request, exc: Forbidden):
+    return respond(code=403,status="Forbidden",message=str(exc))
+
+# Reserva o plazas del viaje cambiadas a la vez por otras peticiones en todos los intentos: se puede repetir (no es falta de plazas)
+@app.exception_handler(BookingContention)
+@app.exception_handler(TripContention)
+async def booking_contention_handler(request: Request, exc: ValueError):
+    return respond(code=409,status="Conflict",message=str(exc),headers={"Retry-After": "1"})
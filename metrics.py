@@ -0,0 +1,268 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from pymongo import monitoring
+from starlette.routing import Match
+
+"""
+metrics.py: Metricas en formato de texto de Prometheus para las rutas (middleware) y los comandos de Mongo (listener)
+"""
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Limites de los histogramas en segundos
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter():
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self, kind: str = "counter"):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {kind}"
+        with self._lock:
+            _values = list(self._values.items())
+        for labels, value in _values:
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+class Gauge(Counter):
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        return super().render("gauge")
+
+class Histogram():
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = HTTP_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._lock = threading.Lock()
+        # labels -> [cuentas por cubeta (no acumuladas), suma, numero de observaciones]
+        self._values = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            _values = [(labels, list(series[0]), series[1], series[2]) for labels, series in self._values.items()]
+        for labels, counts, total, count in _values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {count}"
+
+class Registry():
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # render(): todas las metricas en formato de texto de Prometheus
+    def render(self):
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(Counter("http_requests_total", "HTTP requests by route template and response code",
+                                          ("method", "route", "code")))
+HTTP_DURATION = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency by route template",
+                                            ("method", "route")))
+HTTP_IN_FLIGHT = registry.register(Gauge("http_requests_in_flight", "HTTP requests being processed by route template",
+                                         ("method", "route")))
+MONGO_DURATION = registry.register(Histogram("mongodb_command_duration_seconds", "MongoDB command latency",
+                                             ("command", "collection", "operation"), MONGO_BUCKETS))
+MONGO_FAILURES = registry.register(Counter("mongodb_command_failures_total", "Failed MongoDB commands",
+                                           ("command", "collection", "operation")))
+CACHE_HITS = registry.register(Counter("cache_hits_total", "Lookups answered from the in-process cache", ("cache",)))
+CACHE_MISSES = registry.register(Counter("cache_misses_total", "Lookups that went to MongoDB", ("cache",)))
+CACHE_EVICTIONS = registry.register(Counter("cache_evictions_total", "Entries evicted to stay within the size limit", ("cache",)))
+ADMISSION_IN_FLIGHT = registry.register(Gauge("admission_in_flight", "Admitted requests being processed by route group", ("group",)))
+ADMISSION_QUEUE_DEPTH = registry.register(Gauge("admission_queue_depth", "Requests waiting for admission by route group", ("group",)))
+ADMISSION_WAIT = registry.register(Histogram("admission_wait_seconds", "Time spent waiting for admission by route group", ("group",)))
+ADMISSION_REJECTED = registry.register(Counter("admission_rejected_total", "Requests rejected by admission control",
+                                               ("group", "reason")))
+WRITE_QUEUE_DEPTH = registry.register(Gauge("write_batch_queue_depth", "Inserts waiting for the next batch by collection", ("collection",)))
+WRITE_BATCH_SIZE = registry.register(Histogram("write_batch_size", "Documents per batched insert_many by collection", ("collection",),
+                                               BATCH_BUCKETS))
+WRITE_ACK_WAIT = registry.register(Histogram("write_batch_ack_seconds", "Time from enqueueing an insert to its acknowledgement",
+                                             ("collection",), MONGO_BUCKETS))
+
+# Metodo del repositorio que esta ejecutandose; Motor copia el contexto al hilo que lanza el comando
+operation = contextvars.ContextVar("operation", default="")
+
+# Codigo del sobre de la respuesta: las rutas responden 200 con el codigo real en el cuerpo
+_code = contextvars.ContextVar("code", default=None)
+
+# setCode(code): lo llama respond() para que el middleware cuente el codigo del sobre
+def setCode(code):
+    holder = _code.get()
+    if holder is not None:
+        holder[0] = code
+
+# labelled(label: str): decorador que etiqueta con label los comandos de Mongo lanzados por una funcion asincrona
+def labelled(label: str):
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            token = operation.set(label)
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                operation.reset(token)
+        return wrapper
+    return decorator
+
+# instrument(cls): etiqueta los comandos de los metodos asincronos de un repositorio con "Clase.metodo"
+def instrument(cls):
+    for name, member in list(vars(cls).items()):
+        if isinstance(member, staticmethod) and inspect.iscoroutinefunction(member.__func__):
+            setattr(cls, name, staticmethod(labelled(f"{cls.__name__}.{name}")(member.__func__)))
+    return cls
+
+# routeTemplate(scope): plantilla de la ruta de la peticion ("unmatched" si no hay ninguna); se calcula una vez por peticion
+def routeTemplate(scope):
+    if "route_template" not in scope:
+        scope["route_template"] = "unmatched"
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope["route_template"] = route.path
+                break
+    return scope["route_template"]
+
+class MetricsMiddleware():
+    # Middleware ASGI puro: no envuelve la respuesta, solo observa el inicio y el final de cada peticion
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method, route = scope["method"], routeTemplate(scope)
+        status = [500]
+        holder = [None]
+        token = _code.set(holder)
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method, route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            HTTP_DURATION.observe(time.perf_counter() - start, method, route)
+            HTTP_IN_FLIGHT.dec(method, route)
+            HTTP_REQUESTS.inc(method, route, holder[0] or status[0])
+            _code.reset(token)
+
+# Comandos cuyo primer campo es el nombre de la coleccion
+_COLLECTION_COMMANDS = {"find", "insert", "update", "delete", "aggregate", "count", "distinct", "findAndModify", "createIndexes"}
+
+# shape(value): forma de un filtro sin los valores ({"driver_id": "?", "price": {"$gte": "?"}})
+def shape(value):
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [shape(item) for item in value] if value and isinstance(value[0], dict) else "?"
+    return "?"
+
+def _filter(command_name: str, command: dict):
+    if command_name in ("find", "count", "distinct"):
+        return command.get("filter", command.get("query"))
+    if command_name == "findAndModify":
+        return command.get("query")
+    if command_name in ("update", "delete"):
+        _statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        return _statements[0].get("q")
+    if command_name == "aggregate":
+        return command.get("pipeline", [])[:1]
+    return None
+
+class CommandMetrics(monitoring.CommandListener):
+    # Mide cada comando de Mongo; con slow_ms registra en el log la forma del filtro de los que tardan mas
+    def __init__(self, slow_ms: int = None):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._started = {}
+
+    def started(self, event):
+        command = event.command
+        collection = command.get(event.command_name) if event.command_name in _COLLECTION_COMMANDS else command.get("collection", "")
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = (str(collection or ""), operation.get(),
+                                                                     command if self.slow_ms is not None else None)
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, label, command = started
+        seconds = event.duration_micros / 1e6
+        MONGO_DURATION.observe(seconds, event.command_name, collection, label)
+        if failed:
+            MONGO_FAILURES.inc(event.command_name, collection, label)
+        if command is not None and seconds * 1000 >= self.slow_ms:
+            logger.warning("Slow MongoDB command %s on %s from %s: %.1f ms, filter %s", event.command_name, collection,
+                           label or "-", seconds * 1000, shape(_filter(event.command_name, command)))
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+# Estado del pool que se exporta de cada servidor (ver pool.PoolMonitor.stats)
+POOL_FIELDS = ("open", "in_use", "available", "waiting", "wait_timeouts")
+
+# render(monitor): metricas del registro mas las del pool de conexiones en el momento de la consulta
+def render(monitor=None):
+    _lines = [registry.render()]
+    if monitor is not None:
+        _lines.append("# HELP mongodb_pool_connections Connection pool state by server\n# TYPE mongodb_pool_connections gauge\n")
+        for server, stats in monitor.stats().items():
+            for field in POOL_FIELDS:
+                _lines.append(f"mongodb_pool_connections{_labels(('server', 'state'), (server, field))} {stats[field]}\n")
+    return "".join(_lines)
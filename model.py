@@ -1,5 +1,7 @@
+from datetime import datetime
 from typing import TypeVar, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
+from dates import parseDay, parseMoment, parseTime
 
 """
 model.py: Contiene las clases y atributos de las diferentes colecciones de la base de datos y el Response
@@ -11,37 +13,74 @@ class Booking(BaseModel):
     user_id: str
     trip_id: str
     status: str
+
+class BookingUpdate(BaseModel):
+    user_id: Optional[str]
+    trip_id: Optional[str]
+    status: Optional[str]
     
 class Message(BaseModel):
     sender_id: str
     recipient_id: str
     content: str
-    date: str
+    date: datetime
+
+    _date = validator("date", pre=True, allow_reuse=True)(parseMoment)
     
 class Response(BaseModel):
     code: str
     status: str
     message: str
-    result: Optional[T] = None 
+    result: Optional[T] = None
+    next: Optional[str] = None
     
 class Review(BaseModel):
     reviewer_id: str
     driver_id: str
     rating: int
     comment: str
-    date: str
+    date: datetime
+
+    _date = validator("date", pre=True, allow_reuse=True)(parseMoment)
+
+class ReviewUpdate(BaseModel):
+    reviewer_id: Optional[str]
+    driver_id: Optional[str]
+    rating: Optional[int]
+    comment: Optional[str]
+    date: Optional[datetime]
+
+    _date = validator("date", pre=True, allow_reuse=True)(parseMoment)
     
 class Trip(BaseModel):
     driver_id: str
     start_location: str
-    departure_time: str
+    departure_time: datetime
     available_places: int
     price: int
     trip_type: str
-    day: str
-    end_date: str
+    day: datetime
+    end_date: datetime
     arrival_location: str
 
+    # Se aceptan los textos de siempre ("08:00", "2024-03-01") y se guardan como datetime
+    _time = validator("departure_time", pre=True, allow_reuse=True)(parseTime)
+    _days = validator("day", "end_date", pre=True, allow_reuse=True)(parseDay)
+
+class TripUpdate(BaseModel):
+    driver_id: Optional[str]
+    start_location: Optional[str]
+    departure_time: Optional[datetime]
+    available_places: Optional[int]
+    price: Optional[int]
+    trip_type: Optional[str]
+    day: Optional[datetime]
+    end_date: Optional[datetime]
+    arrival_location: Optional[str]
+
+    _time = validator("departure_time", pre=True, allow_reuse=True)(parseTime)
+    _days = validator("day", "end_date", pre=True, allow_reuse=True)(parseDay)
+
 class User(BaseModel):
     name: str
     last_name: str
@@ -49,4 +88,17 @@ class User(BaseModel):
     password: str
     email_address: str
     municipality: str
-    zip_code: str
\ No newline at end of file
+    zip_code: str
+
+class UserUpdate(BaseModel):
+    name: Optional[str]
+    last_name: Optional[str]
+    bio: Optional[str]
+    password: Optional[str]
+    email_address: Optional[str]
+    municipality: Optional[str]
+    zip_code: Optional[str]
+
+class Login(BaseModel):
+    email_address: str
+    password: str
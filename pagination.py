@@ -0,0 +1,92 @@
+import base64
+import binascii
+from typing import Optional
+from bson import json_util
+from bson.errors import InvalidBSON
+from fastapi import Query
+from fastapi.responses import StreamingResponse
+from serialization import dumps
+
+"""
+pagination.py: Paginacion por cursor (keyset) y respuestas NDJSON en streaming para los listados
+"""
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# Orden estable por defecto: el _id es unico, asi que nunca hay empates
+ID_SORT = [("_id", 1)]
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+class InvalidToken(ValueError):
+    pass
+
+class Page():
+    # Parametros de paginacion comunes a todas las rutas de listado
+    def __init__(self,
+                 limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                 after: Optional[str] = None,
+                 stream: bool = False):
+        # En modo streaming no se limita salvo que se pida explicitamente
+        self.limit = limit if limit or stream else DEFAULT_LIMIT
+        self.after = after
+        self.stream = stream
+
+# parseIds(ids: str): identificadores separados por comas de una lectura multiple, en el orden pedido
+def parseIds(ids: str):
+    return [id.strip() for id in ids.split(",") if id.strip()]
+
+# encodeToken(values: list): codifica los valores de ordenacion del ultimo documento como token opaco
+def encodeToken(values: list):
+    raw = json_util.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# decodeToken(token: str): recupera los valores de ordenacion codificados en el token
+def decodeToken(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json_util.loads(raw)
+    except (binascii.Error, ValueError, TypeError, InvalidBSON):
+        raise InvalidToken(f"Invalid pagination token {token}")
+    if not isinstance(values, list):
+        raise InvalidToken(f"Invalid pagination token {token}")
+    return values
+
+# keyset(query: dict, sort: list, after: str): añade a la consulta la condicion para continuar tras el token
+def keyset(query: dict, sort: list = ID_SORT, after: str = None):
+    if not after:
+        return query
+    values = decodeToken(after)
+    if len(values) != len(sort):
+        raise InvalidToken(f"Invalid pagination token {after}")
+    # (a > x) or (a == x and b > y) or ...
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev: values[j] for j, (prev, _) in enumerate(sort[:i])}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    condition = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+    return {"$and": [query, condition]} if query else condition
+
+# page(items: list, limit: int, sort: list): recorta la pagina y genera el token de la siguiente si la hay
+def page(items: list, limit: int = None, sort: list = ID_SORT):
+    if not limit or len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    last = items[-1]
+    return items, encodeToken([last.get(field) for field, _ in sort])
+
+# encodeDocument(document: dict): serializa un documento de Mongo como una linea NDJSON
+def encodeDocument(document: dict):
+    return dumps(document) + b"\n"
+
+# ndjson(cursor, present): genera las lineas NDJSON a medida que llegan del cursor de Motor
+# present, si se indica, da formato a cada documento antes de serializarlo
+async def ndjson(cursor, present=None):
+    async for document in cursor:
+        yield encodeDocument(present(document) if present else document)
+
+# streamResponse(cursor, present, headers): respuesta que envia los documentos del cursor sin acumularlos en memoria
+def streamResponse(cursor, present=None, headers: dict = None):
+    return StreamingResponse(ndjson(cursor, present), media_type=NDJSON_MEDIA_TYPE, headers=headers)
@@ -0,0 +1,65 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from config import settings
+
+"""
+passwords.py: Derivacion de contraseñas con scrypt (lenta y con mucha memoria a proposito) en un pool de hilos acotado,
+fuera del event loop. Las contraseñas guardadas en claro o con otro coste se rehacen al iniciar sesion
+"""
+
+SCHEME = "scrypt"
+
+# Bloques de 8 * 128 bytes y un solo hilo por hash: con N = 2^14 son 16 MiB y unos 50 ms por contraseña
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+# Hilos que derivan contraseñas; hashlib.scrypt suelta el GIL mientras calcula. Se crea al primer uso
+_executor = None
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.auth_hash_workers, thread_name_prefix="scrypt")
+    return _executor
+
+def _b64(value: bytes):
+    return base64.urlsafe_b64encode(value).decode().rstrip("=")
+
+def _unb64(value: str):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+def _derive(password: str, salt: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=KEY_SIZE)
+
+async def _deriveOffLoop(password: str, salt: bytes, n: int, r: int, p: int):
+    return await asyncio.get_running_loop().run_in_executor(_pool(), _derive, password, salt, n, r, p)
+
+# hashPassword(password: str): texto que se guarda en users.password: scrypt$N$r$p$sal$clave
+async def hashPassword(password: str):
+    n = settings.auth_scrypt_n
+    salt = os.urandom(SALT_SIZE)
+    key = await _deriveOffLoop(password, salt, n, SCRYPT_R, SCRYPT_P)
+    return f"{SCHEME}${n}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}"
+
+# derived(stored: str): si el texto guardado ya tiene el formato de hashPassword
+def derived(stored: str):
+    parts = stored.split("$")
+    return len(parts) == 6 and parts[0] == SCHEME
+
+# verifyPassword(password: str, stored: str): (si la contraseña es correcta, si hay que volver a derivarla y guardarla)
+# Lo que no tiene el formato de hashPassword es una contraseña anterior guardada en claro
+async def verifyPassword(password: str, stored: str):
+    if not derived(stored):
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    parts = stored.split("$")
+    n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+    key = await _deriveOffLoop(password, _unb64(parts[4]), n, r, p)
+    valid = hmac.compare_digest(key, _unb64(parts[5]))
+    return valid, valid and (n, r, p) != (settings.auth_scrypt_n, SCRYPT_R, SCRYPT_P)
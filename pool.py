@@ -0,0 +1,65 @@
+import threading
+from pymongo import monitoring
+
+"""
+pool.py: Listener CMAP que lleva la cuenta de conexiones abiertas, en uso y peticiones esperando en el pool de cada servidor
+"""
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    # Los eventos llegan desde los hilos de pymongo, de ahi el cerrojo
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def _update(self, address, **deltas):
+        key = f"{address[0]}:{address[1]}"
+        with self._lock:
+            server = self._servers.setdefault(key, {"open": 0, "in_use": 0, "waiting": 0, "wait_timeouts": 0, "cleared": 0})
+            for field, delta in deltas.items():
+                server[field] += delta
+
+    def pool_created(self, event):
+        self._update(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._servers.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._update(event.address, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event.address, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._update(event.address, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        timeout = 1 if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT else 0
+        self._update(event.address, waiting=-1, wait_timeouts=timeout)
+
+    def connection_checked_out(self, event):
+        self._update(event.address, waiting=-1, in_use=1)
+
+    def connection_checked_in(self, event):
+        self._update(event.address, in_use=-1)
+
+    # stats(): estado del pool de cada servidor; utilization es la fraccion de maxPoolSize en uso
+    def stats(self):
+        with self._lock:
+            _servers = {address: dict(server) for address, server in self._servers.items()}
+        for server in _servers.values():
+            server["available"] = server["open"] - server["in_use"]
+            server["max_pool_size"] = self.max_pool_size
+            server["utilization"] = round(server["in_use"] / self.max_pool_size, 3) if self.max_pool_size else None
+        return _servers
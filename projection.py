@@ -0,0 +1,58 @@
+from model import Booking, Message, Review, Trip, User
+from pagination import ID_SORT
+
+"""
+projection.py: Proyecciones de Mongo para el parametro fields= de las rutas de lectura
+"""
+
+MODELS = {
+    "bookings": Booking,
+    "messages": Message,
+    "reviews": Review,
+    "trips": Trip,
+    "users": User,
+}
+
+# Campos que nunca salen de la base de datos por las rutas de lectura
+HIDDEN_FIELDS = {
+    "users": {"password"},
+}
+
+# Datos de contacto: con AUTH_REQUIRED solo los ve el propio usuario (projection con private=False los quita)
+PRIVATE_FIELDS = {
+    "users": {"email_address"},
+}
+
+# Perfil publico de un usuario, el que se muestra junto a sus viajes (sin datos de contacto)
+PROFILE_FIELDS = {
+    "users": ("name", "last_name", "bio", "municipality"),
+}
+
+# Campos que se pueden pedir: los del modelo salvo los ocultos. Los campos internos
+# (accepted_bookings, indices auxiliares...) no estan en el modelo y por tanto nunca se seleccionan
+ALLOWED_FIELDS = {
+    collection: tuple(field for field in model.__fields__ if field not in HIDDEN_FIELDS.get(collection, ()))
+    for collection, model in MODELS.items()
+}
+
+class InvalidFields(ValueError):
+    pass
+
+# projection(collection: str, fields: str, required: tuple, sort: list, private: bool): proyeccion para una lista de campos
+# separada por comas. Sin fields se devuelven todos los campos permitidos (sin los privados si private es False).
+# Siempre se incluyen _id, los campos requeridos y los de ordenacion
+def projection(collection: str, fields: str = None, required: tuple = (), sort: list = ID_SORT, private: bool = True):
+    allowed = ALLOWED_FIELDS[collection]
+    hidden = () if private else PRIVATE_FIELDS.get(collection, ())
+    if not fields:
+        _selected = set(allowed).difference(hidden)
+    else:
+        _selected = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = _selected.difference(allowed)
+        if unknown:
+            raise InvalidFields(f"Unknown fields for {collection}: {', '.join(sorted(unknown))}")
+        if _selected.intersection(hidden):
+            raise InvalidFields(f"Fields only visible to their owner: {', '.join(sorted(_selected.intersection(hidden)))}")
+    _selected.update(required)
+    _selected.update(field for field, _ in sort)
+    return {field: 1 for field in sorted(_selected)}
@@ -0,0 +1,23 @@
+import asyncio
+import sys
+from config import connect, database
+from repository import RatingRepo
+
+"""
+ratings.py: Reconstruccion de las estadisticas de valoracion de los conductores a partir de la coleccion reviews
+"""
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "rebuild":
+        print("usage: python ratings.py rebuild [driver_id ...]", file=sys.stderr)
+        return 2
+    # Sin conductores se recalcula toda la coleccion driver_stats
+    await RatingRepo.rebuild(argv[1:] or None)
+    _count = await database.get_collection('driver_stats').count_documents({})
+    print(f"driver_stats: {_count} drivers", file=sys.stderr)
+    return 0
+
+# python ratings.py rebuild [driver_id ...]: corrige cualquier desviacion entre driver_stats y reviews
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
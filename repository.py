@@ -1,199 +1,722 @@
 from model import Booking, Message, Review, Trip, User
-from config import database
+from config import database, readPreference, settings
+import cache
+from metrics import instrument
+from pagination import ID_SORT, decodeToken, keyset
+from projection import ALLOWED_FIELDS, PROFILE_FIELDS
+from search import USER_SEARCH_SORT, searchFields, searchPipeline
+from dates import DATE_SORT
+from etags import STAMP_PROJECTION, stamp, touch
+from geo import EARTH_RADIUS, NEAR_SORT, pointUpdate, tripPoints, userPoint
+from passwords import hashPassword
+from writebehind import insertOne
+from pymongo import DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from datetime import datetime
 import uuid
 
 """
 repository.py: Contiene las consultas realizadas sobre la base de datos
 """
 
+# Reintentos de updateBooking cuando otra peticion cambia la reserva a la vez
+BOOKING_UPDATE_ATTEMPTS = 5
+
+# Reintentos de updateTrip cuando otra peticion ocupa o libera plazas del viaje a la vez
+TRIP_UPDATE_ATTEMPTS = 5
+
+# updateBooking ha agotado los reintentos: el viaje podia tener plazas, pero la reserva cambiaba a la vez en otra peticion
+class BookingContention(ValueError):
+    pass
+
+# updateTrip ha agotado los reintentos: las reservas aceptadas del viaje cambiaban a la vez en otras peticiones
+class TripContention(ValueError):
+    pass
+
+# Preferencia de lectura de los listados de viajes, usuarios y reseñas, que pueden ir a secundarios
+# (MONGODB_LIST_READ_PREFERENCE). Las lecturas por id, las reservas y los mensajes van siempre al primario
+LIST_READS = readPreference(settings.mongodb_list_read_preference)
+
+# Orden de la bandeja de entrada: conversaciones con el mensaje mas reciente primero
+INBOX_SORT = [("last_date", -1), ("_id", -1)]
+
+# Coleccion a la que ArchiveRepo mueve los viajes terminados y sus reservas
+ARCHIVES = {"trips": "trips_archive", "bookings": "bookings_archive"}
+
+# _find(collection: str, query: dict, limit: int, after: str, sort: list, projection: dict, read_preference, include_archived): cursor ordenado y paginado por clave (keyset)
+def _find(collection: str, query: dict, limit: int = None, after: str = None, sort: list = ID_SORT, projection: dict = None,
+          read_preference=None, include_archived: bool = False):
+    if include_archived:
+        return _findWithArchive(collection, query, limit, after, sort, projection, read_preference)
+    cursor = database.get_collection(collection, read_preference=read_preference).find(keyset(query, sort, after), projection).sort(sort)
+    # Se pide un documento de mas para saber si existe una pagina siguiente
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    return cursor
+
+def _findWithArchive(collection: str, query: dict, limit: int, after: str, sort: list, projection: dict, read_preference):
+    # Cada rama ordena y recorta con su propio indice; $unionWith junta las dos y solo se reordenan 2 * (limit + 1) documentos
+    _branch = [{"$match": keyset(query, sort, after)}, {"$sort": dict(sort)}] + ([{"$limit": limit + 1}] if limit else [])
+    pipeline = _branch + [{"$unionWith": {"coll": ARCHIVES[collection], "pipeline": _branch}}, {"$sort": dict(sort)}]
+    if limit:
+        pipeline.append({"$limit": limit + 1})
+    if projection:
+        pipeline.append({"$project": projection})
+    return database.get_collection(collection, read_preference=read_preference).aggregate(pipeline)
+
+# _findOne(collection: str, query: dict, projection: dict, include_archived: bool): documento de la coleccion o, si se pide, de su archivo
+async def _findOne(collection: str, query: dict, projection: dict = None, include_archived: bool = False):
+    document = await database.get_collection(collection).find_one(query, projection)
+    if document is None and include_archived:
+        document = await database.get_collection(ARCHIVES[collection]).find_one(query, projection)
+    return document
+
+# _findMany(collection: str, ids: list, projection: dict, include_archived: bool): documentos de los ids en el orden pedido
+# (None los que no existen). Los que tiene la cache no se consultan; el resto se lee con una sola consulta $in
+async def _findMany(collection: str, ids: list, projection: dict = None, include_archived: bool = False):
+    _found = {}
+    _missing = []
+    for id in dict.fromkeys(ids):
+        _cached = cache.peek(collection, id) if collection in cache.CACHED else cache.MISSING
+        if _cached is cache.MISSING:
+            _missing.append(id)
+        elif _cached is not None:
+            _found[id] = _cached
+    if _missing:
+        async for document in database.get_collection(collection).find({"_id":{"$in":_missing}}, projection):
+            _found[document["_id"]] = document
+    _archived = [id for id in dict.fromkeys(ids) if id not in _found]
+    if _archived and include_archived:
+        async for document in database.get_collection(ARCHIVES[collection]).find({"_id":{"$in":_archived}}, projection):
+            _found[document["_id"]] = document
+    return [cache.select(_found.get(id), projection) for id in ids]
+
+# _stamp(collection: str, id: str, include_archived: bool): version y fecha de modificacion del documento sin leerlo entero
+# (de la cache si lo tiene); None si no existe
+async def _stamp(collection: str, id: str, include_archived: bool = False):
+    _cached = cache.peek(collection, id)
+    if _cached is not cache.MISSING and _cached is not None:
+        return cache.select(_cached, STAMP_PROJECTION)
+    return await _findOne(collection, {"_id":id}, STAMP_PROJECTION, include_archived)
+
+# _dateRange(query: dict, since: datetime, until: datetime): añade a la consulta el intervalo de fechas [since, until)
+def _dateRange(query: dict, since: datetime = None, until: datetime = None):
+    bounds = {op: value for op, value in (("$gte", since), ("$lt", until)) if value is not None}
+    return dict(query, date=bounds) if bounds else query
+
+# threadKey(user_id: str, peer_id: str): clave de la conversacion entre dos usuarios, la misma en los dos sentidos
+def threadKey(user_id: str, peer_id: str):
+    return "|".join(sorted((user_id, peer_id)))
+
+@instrument
 class BookingRepo():
     
-    # getBookingsById(id:str): devuelve la reserva correspondiente al identificador
+    # getBookingsById(id:str, include_archived:bool): devuelve la reserva correspondiente al identificador, tambien archivada si se pide
     @staticmethod
-    async def getBookingById(id:str):
-        return await database.get_collection('bookings').find_one({"_id":id})
+    async def getBookingById(id:str, projection:dict=None, include_archived:bool=False):
+        return await _findOne('bookings', {"_id":id}, projection, include_archived)
     
-    # getBookingsByUser(user_id:str): devuelve todas las reservas de un usuario
-    @staticmethod
-    async def getBookingsByUser(user_id:str):
+    # getBookingsByUser(user_id:str, include_archived:bool): devuelve todas las reservas de un usuario, con las archivadas si se pide
+    @staticmethod
+    async def getBookingsByUser(user_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                                include_archived:bool=False):
+        collection = _find('bookings', {"user_id":user_id}, limit, after, projection=projection, include_archived=include_archived)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _bookings = []
-        collection = database.get_collection('bookings').find({"user_id":user_id})
         async for booking in collection:
             _bookings.append(booking)
         return _bookings
     
     # getBookingsByTrip(trip_id:str): devuelve todas las reservas de un viaje
     @staticmethod
-    async def getBookingsByTrip(trip_id:str):
+    async def getBookingsByTrip(trip_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None):
+        collection = _find('bookings', {"trip_id":trip_id}, limit, after, projection=projection)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _bookings = []
-        collection = database.get_collection('bookings').find({"trip_id":trip_id})
         async for booking in collection:
             _bookings.append(booking)
         return _bookings
     
-    # addBooking(booking: Booking): añade una reserva a la base de datos
+    # toDocument(booking: Booking): documento que se guarda en la base de datos para una reserva nueva, con su id
     @staticmethod
-    async def addBooking(booking: Booking):
-        id = str(uuid.uuid4())
-        _booking = {
-            "_id": id,
+    def toDocument(booking: Booking):
+        return {
+            "_id": str(uuid.uuid4()),
             "user_id": booking.user_id,
             "trip_id": booking.trip_id,
             "status": booking.status
         }
-        await database.get_collection('bookings').insert_one(_booking)
+
+    # addBooking(booking: Booking): añade una reserva a la base de datos
+    # Devuelve False si la reserva se crea aceptada y el viaje no tiene plazas libres
+    @staticmethod
+    async def addBooking(booking: Booking):
+        _booking = BookingRepo.toDocument(booking)
+        id = _booking["_id"]
+        # La plaza se ocupa antes de insertar la reserva; si la insercion falla se libera
+        if booking.status == "accepted" and not await TripRepo.reserveSeat(booking.trip_id, id):
+            return False
+        try:
+            await insertOne('bookings', _booking)
+        except Exception:
+            if booking.status == "accepted":
+                await TripRepo.releaseSeat(booking.trip_id, id)
+            raise
+        return True
         
-    # updateBooking(id: str, booking: Booking): modifica la reserva correspondiente al id con nuevos atributos
-    @staticmethod
-    async def updateBooking(id:str, booking: Booking):
-        _booking = await database.get_collection('bookings').find_one({"_id":id})
-        _booking["user_id"] = booking.user_id
-        _booking["trip_id"] = booking.trip_id
-        _booking["status"] = booking.status
-        await database.get_collection('bookings').update_one({"_id":id}, {"$set":_booking})
+    # updateBooking(id: str, fields: dict, user_id: str): modifica solo los atributos indicados de la reserva correspondiente al id
+    # (con user_id, solo si es de ese usuario). Devuelve None si la reserva no existe y False si pasa a aceptada y el viaje no tiene
+    # plazas libres; BookingContention si otras peticiones la cambian en todos los intentos
+    @staticmethod
+    async def updateBooking(id:str, fields: dict, user_id: str = None):
+        _query = BookingRepo._owned(id, user_id)
+        # Sin cambios de estado ni de viaje no hay plazas en juego: basta una actualizacion
+        if "status" not in fields and "trip_id" not in fields:
+            result = await database.get_collection('bookings').update_one(_query, {"$set":fields})
+            return True if result.matched_count else None
+        for _ in range(BOOKING_UPDATE_ATTEMPTS):
+            _booking = await database.get_collection('bookings').find_one(_query)
+            if _booking is None:
+                return None
+            # Viaje cuya plaza ocupa la reserva antes y despues del cambio
+            status, trip_id = fields.get("status", _booking["status"]), fields.get("trip_id", _booking["trip_id"])
+            old_seat = _booking["trip_id"] if _booking["status"] == "accepted" else None
+            new_seat = trip_id if status == "accepted" else None
+            if new_seat and new_seat != old_seat and not await TripRepo.reserveSeat(new_seat, id):
+                return False
+            # Solo se aplica si nadie ha cambiado el estado o el viaje desde la lectura
+            result = await database.get_collection('bookings').update_one(
+                dict(_query, status=_booking["status"], trip_id=_booking["trip_id"]), {"$set":fields})
+            if result.matched_count == 0:
+                if new_seat and new_seat != old_seat:
+                    await TripRepo.releaseSeat(new_seat, id)
+                continue
+            if old_seat and old_seat != new_seat:
+                await TripRepo.releaseSeat(old_seat, id)
+            return True
+        raise BookingContention(f"Booking {id} is being changed by another request, retry")
         
-    # deleteBooking(id: str): elimina la reserva correspondiente al id 
+    # deleteBooking(id: str, user_id: str): elimina la reserva correspondiente al id (con user_id, solo si es de ese usuario)
+    # y libera su plaza si estaba aceptada. Devuelve False si no existe
     @staticmethod
-    async def deleteBooking(id:str):
-        await database.get_collection('bookings').delete_one({"_id":id})
+    async def deleteBooking(id:str, user_id: str = None):
+        _booking = await database.get_collection('bookings').find_one_and_delete(BookingRepo._owned(id, user_id))
+        if _booking and _booking["status"] == "accepted":
+            await TripRepo.releaseSeat(_booking["trip_id"], id)
+        return _booking is not None
         
     # bookingExists(id: str): comprueba si la reserva correspondiente al id existe en la base de datos
     @staticmethod
     async def bookingExists(id: str):
-        _booking = await database.get_collection('bookings').find_one({"_id":id})
+        _booking = await database.get_collection('bookings').find_one({"_id":id}, {"_id":1})
         return _booking is not None
+
+    # _owned(id: str, user_id: str): filtro de la reserva con ese id, y de ese usuario si se indica
+    @staticmethod
+    def _owned(id: str, user_id: str = None):
+        return {"_id":id} if user_id is None else {"_id":id, "user_id":user_id}
     
+@instrument
 class MessageRepo():
     # getMessageById(id: str): devuelve el mensaje correspondiente al identificador
     @staticmethod
-    async def getMessageById(id:str):
-        return await database.get_collection('messages').find_one({"_id":id})
+    async def getMessageById(id:str, projection:dict=None):
+        return await database.get_collection('messages').find_one({"_id":id}, projection)
     
-    # getMessagesBySender(sender_id: str): devuelve todos los mensajes enviados por un usuario
-    @staticmethod
-    async def getMessagesBySender(sender_id:str):
+    # getMessagesBySender(sender_id: str, since, until): devuelve los mensajes enviados por un usuario en orden cronologico
+    @staticmethod
+    async def getMessagesBySender(sender_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                                 since:datetime=None, until:datetime=None):
+        collection = _find('messages', _dateRange({"sender_id":sender_id}, since, until), limit, after, DATE_SORT, projection)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _messages = []
-        collection = database.get_collection('messages').find({"sender_id":sender_id})
         async for message in collection:
             _messages.append(message)
         return _messages
     
-    # getMessagesByRecipient(recipient_id:str): devuelve todos los mensajes recibidos por un usuario
-    @staticmethod
-    async def getMessagesByRecipient(recipient_id:str):
+    # getMessagesByRecipient(recipient_id:str, since, until): devuelve los mensajes recibidos por un usuario en orden cronologico
+    @staticmethod
+    async def getMessagesByRecipient(recipient_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                                     since:datetime=None, until:datetime=None):
+        collection = _find('messages', _dateRange({"recipient_id":recipient_id}, since, until), limit, after, DATE_SORT, projection)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _messages = []
-        collection = database.get_collection('messages').find({"recipient_id":recipient_id})
         async for message in collection:
             _messages.append(message)
         return _messages
-    
-    # addMessage(message: Message): añade un mensaje a la base de datos
+
+    # getMessagesByUser(user_id:str, since, until): devuelve los mensajes enviados y recibidos por un usuario en una sola consulta,
+    # en orden cronologico y opcionalmente solo los del intervalo [since, until)
+    @staticmethod
+    async def getMessagesByUser(user_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                                since:datetime=None, until:datetime=None):
+        query = _dateRange({"$or":[{"sender_id":user_id}, {"recipient_id":user_id}]}, since, until)
+        collection = _find('messages', query, limit, after, DATE_SORT, projection)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
+        _messages = []
+        async for message in collection:
+            _messages.append(message)
+        return _messages
+
+    # getThread(user_id: str, peer_id: str, since, until): devuelve la conversacion entre dos usuarios en orden cronologico,
+    # con una sola consulta sobre el indice (thread_key, date, _id)
+    @staticmethod
+    async def getThread(user_id:str, peer_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                        since:datetime=None, until:datetime=None):
+        query = _dateRange({"thread_key":threadKey(user_id, peer_id)}, since, until)
+        collection = _find('messages', query, limit, after, DATE_SORT, projection)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
+        _messages = []
+        async for message in collection:
+            _messages.append(message)
+        return _messages
+
+    # toDocument(message: Message): documento que se guarda en la base de datos para un mensaje nuevo, con su id
     @staticmethod
-    async def addMessage(message: Message):
-        id = str(uuid.uuid4())
-        _message = {
-            "_id": id,
+    def toDocument(message: Message):
+        return {
+            "_id": str(uuid.uuid4()),
             "sender_id": message.sender_id,
             "recipient_id": message.recipient_id,
             "content": message.content,
-            "date":message.date
+            "date":message.date,
+            "thread_key": threadKey(message.sender_id, message.recipient_id)
         }
-        await database.get_collection('messages').insert_one(_message)
-        
-    # deleteMessage(id:str): elimina un mensaje de la base de datos
+
+    # addMessage(message: Message): añade un mensaje a la base de datos y a la bandeja de entrada de los dos usuarios
+    # (con WRITE_BATCH_ENABLED, las bandejas de todo el lote en un solo bulk_write). Devuelve el documento guardado
     @staticmethod
-    async def deleteMessage(id:str):
-        await database.get_collection('messages').delete_one({"_id":id})
+    async def addMessage(message: Message):
+        _message = MessageRepo.toDocument(message)
+        await insertOne('messages', _message, InboxRepo.applyMessages)
+        return _message
+        
+    # deleteMessage(id:str, sender_id: str): elimina un mensaje (con sender_id, solo si lo envio ese usuario) y actualiza
+    # la bandeja de entrada de los dos usuarios. Devuelve False si no existe
+    @staticmethod
+    async def deleteMessage(id:str, sender_id: str = None):
+        _query = {"_id":id} if sender_id is None else {"_id":id, "sender_id":sender_id}
+        _message = await database.get_collection('messages').find_one_and_delete(_query)
+        if _message is not None:
+            await InboxRepo.removeMessage(_message)
+        return _message is not None
         
     # messageExists(id: str): comprueba si el mensaje correspondiente al id existe en la base de datos
     @staticmethod
     async def messageExists(id: str):
-        _message = await database.get_collection('messages').find_one({"_id":id})
+        _message = await database.get_collection('messages').find_one({"_id":id}, {"_id":1})
         return _message is not None
     
+@instrument
+class InboxRepo():
+    # Un documento por usuario y conversacion (_id "usuario|otro"): ultimo mensaje, su fecha y mensajes sin leer.
+    # Se mantiene al añadir y borrar mensajes, asi la bandeja de entrada es una sola consulta sin recorrer los mensajes
+
+    # getInbox(user_id: str): devuelve las conversaciones de un usuario, la del mensaje mas reciente primero
+    @staticmethod
+    async def getInbox(user_id:str, limit:int=None, after:str=None, stream:bool=False):
+        collection = _find('inbox', {"user_id":user_id}, limit, after, INBOX_SORT)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
+        _entries = []
+        async for entry in collection:
+            _entries.append(entry)
+        return _entries
+
+    @staticmethod
+    def _entry(user_id:str, peer_id:str, message:dict, unread:int):
+        # Solo reemplaza el ultimo mensaje si el nuevo no es anterior (los mensajes traen su propia fecha)
+        newer = {"$gte":[message["date"], {"$ifNull":["$last_date", None]}]}
+        summary = {"_id":message["_id"], "sender_id":message["sender_id"], "content":message["content"]}
+        return UpdateOne({"_id":f"{user_id}|{peer_id}"}, [{"$set":{
+            "user_id":user_id,
+            "peer_id":peer_id,
+            "last_message":{"$cond":[newer, {"$literal":summary}, "$last_message"]},
+            "last_date":{"$cond":[newer, message["date"], "$last_date"]},
+            "unread":{"$add":[{"$ifNull":["$unread", 0]}, unread]},
+        }}], upsert=True)
+
+    # applyMessages(messages: list): añade los mensajes nuevos a las conversaciones del emisor y del receptor en un solo bulk_write
+    @staticmethod
+    async def applyMessages(messages:list):
+        _operations = []
+        for message in messages:
+            _operations.append(InboxRepo._entry(message["sender_id"], message["recipient_id"], message, 0))
+            if message["recipient_id"] != message["sender_id"]:
+                _operations.append(InboxRepo._entry(message["recipient_id"], message["sender_id"], message, 1))
+        if _operations:
+            # Ordenado: dos mensajes de la misma conversacion en el lote se aplican en orden
+            await database.get_collection('inbox').bulk_write(_operations)
+
+    # removeMessage(message: dict): recalcula el ultimo mensaje de la conversacion tras borrar message
+    @staticmethod
+    async def removeMessage(message:dict):
+        inbox = database.get_collection('inbox')
+        sender, recipient = message["sender_id"], message["recipient_id"]
+        _keys = [f"{sender}|{recipient}", f"{recipient}|{sender}"]
+        # Si el receptor no lo habia leido, deja de contar como pendiente
+        await inbox.update_one({"_id":_keys[1], "unread":{"$gt":0},
+                                "$or":[{"read_at":{"$exists":False}}, {"read_at":{"$lt":message["date"]}}]}, {"$inc":{"unread":-1}})
+        _last = await database.get_collection('messages').find_one({"thread_key":threadKey(sender, recipient)},
+                                                                   sort=[(field, -direction) for field, direction in DATE_SORT])
+        if _last is None:
+            await inbox.delete_many({"_id":{"$in":_keys}})
+            return
+        await inbox.update_many({"_id":{"$in":_keys}}, {"$set":{
+            "last_message":{"_id":_last["_id"], "sender_id":_last["sender_id"], "content":_last["content"]},
+            "last_date":_last["date"],
+        }})
+
+    # markRead(user_id: str, peer_id: str): marca como leida la conversacion del usuario con peer_id
+    # Devuelve False si no existe
+    @staticmethod
+    async def markRead(user_id:str, peer_id:str):
+        result = await database.get_collection('inbox').update_one({"_id":f"{user_id}|{peer_id}"},
+                                                                   {"$set":{"unread":0, "read_at":datetime.utcnow()}})
+        return result.matched_count == 1
+
+    # rebuild(): recalcula las conversaciones desde messages (sin mensajes pendientes de leer) y sustituye la coleccion
+    @staticmethod
+    async def rebuild():
+        _sides = [("$sender_id", "$recipient_id"), ("$recipient_id", "$sender_id")]
+        await database.get_collection('messages').aggregate([
+            {"$sort":dict(DATE_SORT)},
+            {"$project":{"date":1, "summary":{"_id":"$_id", "sender_id":"$sender_id", "content":"$content"},
+                         "sides":[{"user_id":user, "peer_id":peer} for user, peer in _sides]}},
+            {"$unwind":"$sides"},
+            {"$group":{"_id":{"$concat":["$sides.user_id", "|", "$sides.peer_id"]},
+                       "user_id":{"$first":"$sides.user_id"}, "peer_id":{"$first":"$sides.peer_id"},
+                       "last_message":{"$last":"$summary"}, "last_date":{"$last":"$date"}}},
+            {"$addFields":{"unread":0}},
+            {"$out":"inbox"},
+        ]).to_list(None)
+
+@instrument
 class ReviewRepo():
 
     # getReviewsById(id:str): devuelve la reseña correspondiente al identificador
     @staticmethod
-    async def getReviewById(id:str):
-        return await database.get_collection('reviews').find_one({"_id":id})
+    async def getReviewById(id:str, projection:dict=None):
+        return await database.get_collection('reviews').find_one({"_id":id}, projection)
     
-    # getReviewsByUser(user_id:str): devuelve todas las reseñas de un usuario
-    @staticmethod
-    async def getReviewsByUser(user_id:str):
+    # getReviewsByUser(user_id:str, since, until): devuelve las reseñas de un usuario en orden cronologico
+    @staticmethod
+    async def getReviewsByUser(user_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                               since:datetime=None, until:datetime=None):
+        collection = _find('reviews', _dateRange({"driver_id":user_id}, since, until), limit, after, DATE_SORT, projection,
+                           read_preference=LIST_READS)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _reviews = []
-        collection = database.get_collection('reviews').find({"driver_id":user_id})
         async for review in collection:
             _reviews.append(review)
         return _reviews
     
-    # addReview(review: Review): añade una reseña a la base de datos
+    # toDocument(review: Review): documento que se guarda en la base de datos para una reseña nueva, con su id
     @staticmethod
-    async def addReview(review: Review):
-        id = str(uuid.uuid4())
-        _review = {
-            "_id": id,
+    def toDocument(review: Review):
+        return {
+            "_id": str(uuid.uuid4()),
             "reviewer_id": review.reviewer_id,
             "driver_id": review.driver_id,
             "rating": review.rating,
             "comment": review.comment,
             "date": review.date
         }
-        await database.get_collection('reviews').insert_one(_review)
+
+    # addReview(review: Review): añade una reseña a la base de datos y suma su puntuacion a las estadisticas del conductor
+    # (con WRITE_BATCH_ENABLED, las de todo el lote en un solo bulk_write)
+    @staticmethod
+    async def addReview(review: Review):
+        _review = ReviewRepo.toDocument(review)
+        await insertOne('reviews', _review, RatingRepo.applyReviews)
         
-    # updateReview(id: str, review: Review): modifica la reseña correspondiente al id con nuevos atributos
-    @staticmethod
-    async def updateReview(id:str, review: Review):
-        _review = await database.get_collection('reviews').find_one({"_id":id})
-        _review["reviewer_id"] = review.reviewer_id
-        _review["driver_id"] = review.driver_id
-        _review["rating"] = review.rating
-        _review["comment"] = review.comment
-        _review["date"] = review.date
-        await database.get_collection('reviews').update_one({"_id":id}, {"$set":_review})
+    # updateReview(id: str, fields: dict, driver_id: str): modifica solo los atributos indicados de la reseña correspondiente al id
+    # (con driver_id, solo si es sobre ese conductor). Devuelve False si la reseña no existe
+    @staticmethod
+    async def updateReview(id:str, fields: dict, driver_id: str = None):
+        # Se recupera la version anterior en la misma operacion para corregir las estadisticas
+        _review = await database.get_collection('reviews').find_one_and_update(
+            ReviewRepo._about(id, driver_id), {"$set":fields}, projection={"driver_id":1, "rating":1}, return_document=ReturnDocument.BEFORE)
+        if _review is None:
+            return False
+        driver_id, rating = fields.get("driver_id", _review["driver_id"]), fields.get("rating", _review["rating"])
+        if (driver_id, rating) != (_review["driver_id"], _review["rating"]):
+            await RatingRepo.applyRating(_review["driver_id"], _review["rating"], -1)
+            await RatingRepo.applyRating(driver_id, rating, 1)
+        return True
         
-    # deleteReview(id: str): elimina la reseña correspondiente al id 
+    # deleteReview(id: str, driver_id: str): elimina la reseña correspondiente al id (con driver_id, solo si es sobre ese conductor)
+    # Devuelve False si no existe
     @staticmethod
-    async def deleteReview(id:str):
-        await database.get_collection('reviews').delete_one({"_id":id})
+    async def deleteReview(id:str, driver_id: str = None):
+        _review = await database.get_collection('reviews').find_one_and_delete(ReviewRepo._about(id, driver_id), projection={"driver_id":1, "rating":1})
+        if _review is not None:
+            await RatingRepo.applyRating(_review["driver_id"], _review["rating"], -1)
+        return _review is not None
         
     # reviewExists(id: str): comprueba si la reseña correspondiente al id existe en la base de datos
     @staticmethod
     async def reviewExists(id: str):
-        _review = await database.get_collection('reviews').find_one({"_id":id})
+        _review = await database.get_collection('reviews').find_one({"_id":id}, {"_id":1})
         return _review is not None
+
+    # _about(id: str, driver_id: str): filtro de la reseña con ese id, y sobre ese conductor si se indica
+    @staticmethod
+    def _about(id: str, driver_id: str = None):
+        return {"_id":id} if driver_id is None else {"_id":id, "driver_id":driver_id}
     
+@instrument
+class RatingRepo():
+    # Estadisticas de valoracion por conductor (coleccion driver_stats, _id = driver_id):
+    # numero de reseñas, suma, media e histograma de puntuaciones 1-5
+
+    # getRating(driver_id: str): devuelve las estadisticas del conductor
+    @staticmethod
+    async def getRating(driver_id:str):
+        return await database.get_collection('driver_stats', read_preference=LIST_READS).find_one({"_id":driver_id})
+
+    # getRatings(driver_ids: list): devuelve un diccionario driver_id -> estadisticas con una sola consulta
+    @staticmethod
+    async def getRatings(driver_ids:list):
+        _ratings = {}
+        collection = database.get_collection('driver_stats', read_preference=LIST_READS).find({"_id":{"$in":list(driver_ids)}})
+        async for rating in collection:
+            _ratings[rating["_id"]] = rating
+        return _ratings
+
+    # emptyRating(driver_id: str): estadisticas de un conductor sin reseñas
+    @staticmethod
+    def emptyRating(driver_id:str):
+        return {"_id":driver_id, "count":0, "sum":0, "average":None, "histogram":{str(rating):0 for rating in range(1, 6)}}
+
+    # embedRatings(trips: list): añade a cada viaje las estadisticas de su conductor (campo driver_rating)
+    @staticmethod
+    async def embedRatings(trips:list):
+        _ratings = await RatingRepo.getRatings({trip["driver_id"] for trip in trips})
+        for trip in trips:
+            trip["driver_rating"] = _ratings.get(trip["driver_id"]) or RatingRepo.emptyRating(trip["driver_id"])
+        return trips
+
+    # _ratingUpdate(deltas: dict): pipeline que suma a las estadisticas deltas[puntuacion] reseñas de cada puntuacion
+    # Una sola actualizacion atomica: contadores, histograma y media quedan siempre coherentes
+    @staticmethod
+    def _ratingUpdate(deltas:dict):
+        return [
+            {"$set":{
+                "count":{"$add":[{"$ifNull":["$count", 0]}, sum(deltas.values())]},
+                "sum":{"$add":[{"$ifNull":["$sum", 0]}, sum(rating * delta for rating, delta in deltas.items())]},
+                "histogram":{str(value):{"$add":[{"$ifNull":[f"$histogram.{value}", 0]}, deltas.get(value, 0)]}
+                             for value in range(1, 6)},
+            }},
+            {"$set":{"average":{"$cond":[{"$gt":["$count", 0]}, {"$divide":["$sum", "$count"]}, None]}}},
+        ]
+
+    # applyRating(driver_id: str, rating: int, delta: int): suma (delta=1) o resta (delta=-1) una puntuacion
+    @staticmethod
+    async def applyRating(driver_id:str, rating:int, delta:int):
+        await database.get_collection('driver_stats').update_one({"_id":driver_id}, RatingRepo._ratingUpdate({rating: delta}), upsert=True)
+
+    # applyReviews(reviews: list): suma las puntuaciones de reseñas nuevas con una actualizacion por conductor en un solo bulk_write
+    @staticmethod
+    async def applyReviews(reviews:list):
+        _deltas = {}
+        for review in reviews:
+            _counts = _deltas.setdefault(review["driver_id"], {})
+            _counts[review["rating"]] = _counts.get(review["rating"], 0) + 1
+        if _deltas:
+            await database.get_collection('driver_stats').bulk_write(
+                [UpdateOne({"_id":driver_id}, RatingRepo._ratingUpdate(deltas), upsert=True) for driver_id, deltas in _deltas.items()],
+                ordered=False)
+
+    # rebuild(driver_ids: list): recalcula las estadisticas desde la coleccion reviews (todas si no se indican conductores)
+    @staticmethod
+    async def rebuild(driver_ids:list = None):
+        _pipeline = [] if driver_ids is None else [{"$match":{"driver_id":{"$in":list(driver_ids)}}}]
+        _pipeline += [
+            {"$group":dict({"_id":"$driver_id", "count":{"$sum":1}, "sum":{"$sum":"$rating"}},
+                           **{f"h{rating}":{"$sum":{"$cond":[{"$eq":["$rating", rating]}, 1, 0]}} for rating in range(1, 6)})},
+            {"$project":{"count":1, "sum":1, "average":{"$divide":["$sum", "$count"]},
+                         "histogram":{str(rating):f"$h{rating}" for rating in range(1, 6)}}},
+        ]
+        stats = database.get_collection('driver_stats')
+        if driver_ids is None:
+            # $out sustituye la coleccion de golpe; las reseñas escritas durante la reconstruccion se pueden perder
+            await database.get_collection('reviews').aggregate(_pipeline + [{"$out":"driver_stats"}]).to_list(None)
+            return
+        _stats = await database.get_collection('reviews').aggregate(_pipeline).to_list(None)
+        _rated = {rating["_id"] for rating in _stats}
+        # Una sola escritura: se sustituyen las estadisticas recalculadas y se borran las de conductores sin reseñas
+        _operations = [ReplaceOne({"_id":rating["_id"]}, rating, upsert=True) for rating in _stats]
+        _operations.append(DeleteMany({"_id":{"$in":[id for id in driver_ids if id not in _rated]}}))
+        await stats.bulk_write(_operations, ordered=False)
+
+@instrument
 class TripRepo():
-    # getTrips(): devuelve todos los viajes en la base de datos
+    # getTrips(include_archived:bool): devuelve todos los viajes en la base de datos, con los archivados si se pide
     @staticmethod
-    async def getTrips():
+    async def getTrips(limit:int=None, after:str=None, stream:bool=False, projection:dict=None, include_archived:bool=False):
+        collection = _find('trips', {}, limit, after, projection=projection, read_preference=LIST_READS, include_archived=include_archived)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _trips = []
-        collection = database.get_collection('trips').find()
         async for trip in collection:
-            print(trip)
             _trips.append(trip)
         return _trips
     
-    # getTripsById(id:str): devuelve el viaje correspondiente al identificador
+    # getTripsById(id:str, include_archived:bool): devuelve el viaje correspondiente al identificador, tambien archivado si se pide
+    # Los viajes activos se leen a traves de la cache (el documento completo, la proyeccion se aplica en memoria)
+    @staticmethod
+    async def getTripById(id:str, projection:dict=None, include_archived:bool=False):
+        _trip = cache.select(await cache.get('trips', id, TripRepo._load), projection)
+        if _trip is None and include_archived:
+            _trip = await database.get_collection(ARCHIVES['trips']).find_one({"_id":id}, projection)
+        return _trip
+
     @staticmethod
-    async def getTripById(id:str):
+    async def _load(id:str):
         return await database.get_collection('trips').find_one({"_id":id})
+
+    # getTripStamp(id:str, include_archived:bool): version y fecha de modificacion del viaje, para las peticiones condicionales
+    @staticmethod
+    async def getTripStamp(id:str, include_archived:bool=False):
+        return await _stamp('trips', id, include_archived)
     
-    # getTripsByUser(trip_id:str): devuelve todos los viajes de un usuario
+    # getTripsByIds(ids:list, include_archived:bool): devuelve los viajes de los identificadores en el mismo orden (None si no existe)
     @staticmethod
-    async def getTripsByUser(user_id:str):
+    async def getTripsByIds(ids:list, projection:dict=None, include_archived:bool=False):
+        return await _findMany('trips', ids, projection, include_archived)
+
+    # getTripDetail(id:str, include_archived:bool): el viaje con el perfil publico y la valoracion de su conductor y sus
+    # reservas, en una sola agregacion con $lookup. None si no existe
+    @staticmethod
+    async def getTripDetail(id:str, include_archived:bool=False):
+        _detail = await TripRepo._detail('trips', 'bookings', id)
+        if _detail is None and include_archived:
+            _detail = await TripRepo._detail(ARCHIVES['trips'], ARCHIVES['bookings'], id)
+        return _detail
+
+    @staticmethod
+    async def _detail(trips:str, bookings:str, id:str):
+        _pipeline = [
+            {"$match":{"_id":id}},
+            {"$lookup":{"from":"users", "localField":"driver_id", "foreignField":"_id", "as":"driver"}},
+            {"$lookup":{"from":"driver_stats", "localField":"driver_id", "foreignField":"_id", "as":"driver_rating"}},
+            {"$lookup":{"from":bookings, "localField":"_id", "foreignField":"trip_id", "as":"bookings"}},
+            # Solo sale de la base de datos lo que se devuelve: campos del viaje, perfil publico y estado de cada reserva
+            {"$project":dict(
+                {field:1 for field in ALLOWED_FIELDS['trips']},
+                **{f"driver.{field}":1 for field in ("_id",) + PROFILE_FIELDS['users']},
+                **{f"bookings.{field}":1 for field in ("_id", "user_id", "status")},
+                driver_rating=1,
+                taken={"$size":{"$ifNull":["$accepted_bookings", []]}},
+            )},
+        ]
+        _trips = await database.get_collection(trips).aggregate(_pipeline).to_list(None)
+        if not _trips:
+            return None
+        _trip = _trips[0]
+        _driver, _rating, _bookings, _taken = (_trip.pop(field) for field in ("driver", "driver_rating", "bookings", "taken"))
+        _statuses = [booking["status"] for booking in _bookings]
+        return {
+            "trip": _trip,
+            "driver": _driver[0] if _driver else None,
+            "driver_rating": _rating[0] if _rating else RatingRepo.emptyRating(_trip["driver_id"]),
+            "seats": {"available": _trip["available_places"], "taken": _taken, "pending": _statuses.count("pending")},
+            "bookings": _bookings,
+        }
+
+    # getTripsByUser(trip_id:str, include_archived:bool): devuelve todos los viajes de un usuario, con los archivados si se pide
+    @staticmethod
+    async def getTripsByUser(user_id:str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                             include_archived:bool=False):
+        collection = _find('trips', {"driver_id":user_id}, limit, after, projection=projection, read_preference=LIST_READS,
+                           include_archived=include_archived)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _trips = []
-        collection = database.get_collection('trips').find({"driver_id":user_id})
         async for trip in collection:
             _trips.append(trip)
         return _trips
-    
-    # addTrip(trip: Trip): añade un viaje a la base de datos
+
+    # searchTrips(equals: dict, ...): busca viajes filtrando y ordenando en la base de datos
+    # equals contiene los filtros de igualdad; el resto son rangos opcionales sobre dia, hora, plazas y precio
+    @staticmethod
+    async def searchTrips(equals:dict, departure_from=None, departure_to=None, min_places:int=None,
+                          min_price:int=None, max_price:int=None, sort:list=ID_SORT,
+                          limit:int=None, after:str=None, stream:bool=False, projection:dict=None,
+                          day_from:datetime=None, day_to:datetime=None):
+        query = dict(equals)
+        ranges = {
+            "day": {"$gte": day_from, "$lte": day_to},
+            "departure_time": {"$gte": departure_from, "$lte": departure_to},
+            "available_places": {"$gte": min_places},
+            "price": {"$gte": min_price, "$lte": max_price},
+        }
+        for field, bounds in ranges.items():
+            bounds = {op: value for op, value in bounds.items() if value is not None}
+            if bounds:
+                query[field] = bounds
+        collection = _find('trips', query, limit, after, sort, projection, read_preference=LIST_READS)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
+        _trips = []
+        async for trip in collection:
+            _trips.append(trip)
+        return _trips
+
+    # searchNear(origin: dict, origin_radius: int, destination: dict, destination_radius: int, query: dict): viajes que salen a
+    # menos de origin_radius metros de origin y, si se da destination, llegan a menos de destination_radius metros de el,
+    # del mas cercano al mas lejano. Cada viaje lleva su distancia al origen en distance
+    @staticmethod
+    async def searchNear(origin:dict, origin_radius:int, destination:dict=None, destination_radius:int=None, query:dict=None,
+                         limit:int=None, after:str=None, stream:bool=False, projection:dict=None):
+        query = dict(query or {})
+        if destination:
+            query["arrival_point"] = {"$geoWithin":{"$centerSphere":[destination["coordinates"], destination_radius / EARTH_RADIUS]}}
+        _geoNear = {"near":origin, "key":"start_point", "distanceField":"distance", "maxDistance":origin_radius,
+                    "spherical":True, "query":query}
+        _pipeline = [{"$geoNear":_geoNear}]
+        if after:
+            # El indice empieza a recorrer desde la distancia del ultimo viaje de la pagina anterior
+            _geoNear["minDistance"] = decodeToken(after)[0]
+            _pipeline.append({"$match":keyset({}, NEAR_SORT, after)})
+        # $geoNear ya ordena por distancia; el _id fija el orden de los viajes que salen del mismo punto
+        _pipeline.append({"$sort":dict(NEAR_SORT)})
+        if limit:
+            _pipeline.append({"$limit":limit + 1})
+        if projection:
+            _pipeline.append({"$project":projection})
+        collection = database.get_collection('trips', read_preference=LIST_READS).aggregate(_pipeline)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
+        _trips = []
+        async for trip in collection:
+            _trips.append(trip)
+        return _trips
+
+    # toDocument(trip: Trip): documento que se guarda en la base de datos para un viaje nuevo, con su id
     @staticmethod
-    async def addTrip(trip: Trip):
-        id = str(uuid.uuid4())
-        _trip = {
-            "_id": id,
+    def toDocument(trip: Trip):
+        return {
+            "_id": str(uuid.uuid4()),
             "driver_id": trip.driver_id,
             "start_location": trip.start_location,
             "departure_time": trip.departure_time,
@@ -203,95 +726,295 @@ class TripRepo():
             "day": trip.day,
             "end_date": trip.end_date,
             "arrival_location": trip.arrival_location,
+            "accepted_bookings": [],
+            **stamp(),
+            **{field: value for field, value in tripPoints(trip.dict()).items() if value is not None}
         }
+
+    # addTrip(trip: Trip): añade un viaje a la base de datos
+    @staticmethod
+    async def addTrip(trip: Trip):
+        _trip = TripRepo.toDocument(trip)
         await database.get_collection('trips').insert_one(_trip)
+        await TripRepo._changed(_trip["_id"])
         
-    # updateTrip(id: str, trip: Trip): modifica el viaje correspondiente al id con nuevos atributos
-    @staticmethod
-    async def updateTrip(id:str, trip: Trip):
-        _trip = await database.get_collection('trips').find_one({"_id":id})
-        _trip["driver_id"] = trip.driver_id
-        _trip["start_location"] = trip.start_location
-        _trip["departure_time"] = trip.departure_time
-        _trip["available_places"] = trip.available_places
-        _trip["price"] = trip.price
-        _trip["trip_type"] = trip.trip_type
-        _trip["day"] = trip.day
-        _trip["end_date"] = trip.end_date
-        _trip["arrival_location"] = trip.arrival_location
-        await database.get_collection('trips').update_one({"_id":id}, {"$set":_trip})
+    # updateTrip(id: str, fields: dict): modifica solo los atributos indicados del viaje correspondiente al id
+    # available_places es la capacidad: se guardan las plazas que quedan libres tras las reservas aceptadas, que junto con
+    # accepted_bookings solo cambian reserveSeat y releaseSeat. Devuelve None si el viaje no existe y False si la capacidad
+    # es menor que las reservas aceptadas; TripContention si las reservas cambian a la vez en todos los intentos
+    @staticmethod
+    async def updateTrip(id:str, fields: dict):
+        # Sin plazas en juego basta una actualizacion
+        if "available_places" not in fields:
+            result = await database.get_collection('trips').update_one({"_id":id}, touch(pointUpdate(fields, tripPoints(fields))))
+            await TripRepo._changed(id)
+            return True if result.matched_count else None
+        for _ in range(TRIP_UPDATE_ATTEMPTS):
+            _trip = await database.get_collection('trips').find_one({"_id":id}, {"accepted_bookings":1})
+            if _trip is None:
+                return None
+            accepted = len(_trip.get("accepted_bookings") or [])
+            if fields["available_places"] < accepted:
+                return False
+            # Solo se aplica si nadie ha ocupado ni liberado plazas desde la lectura: un $set a secas pisaria su $inc
+            _query = {"_id":id, "accepted_bookings":{"$size":accepted} if "accepted_bookings" in _trip else {"$exists":False}}
+            _fields = dict(fields, available_places=fields["available_places"] - accepted)
+            result = await database.get_collection('trips').update_one(_query, touch(pointUpdate(_fields, tripPoints(fields))))
+            if result.matched_count == 1:
+                await TripRepo._changed(id)
+                return True
+        raise TripContention(f"Trip {id} seats are being changed by another request, retry")
+
+    # reserveSeat(id: str, booking_id: str): ocupa una plaza del viaje para la reserva si quedan libres
+    # Una sola actualizacion condicional: descuenta la plaza y registra la reserva aceptada a la vez
+    @staticmethod
+    async def reserveSeat(id:str, booking_id:str):
+        result = await database.get_collection('trips').update_one(
+            {"_id":id, "available_places":{"$gt":0}, "accepted_bookings":{"$ne":booking_id}},
+            touch({"$inc":{"available_places":-1}, "$push":{"accepted_bookings":booking_id}}))
+        if result.modified_count == 1:
+            await TripRepo._changed(id)
+        return result.modified_count == 1
+
+    # releaseSeat(id: str, booking_id: str): devuelve la plaza de la reserva al viaje (solo si la ocupaba)
+    @staticmethod
+    async def releaseSeat(id:str, booking_id:str):
+        result = await database.get_collection('trips').update_one(
+            {"_id":id, "accepted_bookings":booking_id},
+            touch({"$inc":{"available_places":1}, "$pull":{"accepted_bookings":booking_id}}))
+        if result.modified_count == 1:
+            await TripRepo._changed(id)
+        return result.modified_count == 1
         
     # deleteTrip(id: str): elimina el viaje correspondiente al id 
     @staticmethod
     async def deleteTrip(id:str):
         await database.get_collection('trips').delete_one({"_id":id})
-        
+        await TripRepo._changed(id)
+
     # tripExists(id: str): comprueba si el viaje correspondiente al id existe en la base de datos
     @staticmethod
     async def tripExists(id: str):
-        _trip = await database.get_collection('trips').find_one({"_id":id})
-        return _trip is not None
+        return await cache.get('trips', id, TripRepo._load) is not None
+
+    # _changed(*ids): tras escribir viajes, los invalida en la cache y sube la version de la coleccion. Siempre despues de
+    # la escritura: un listado leido entre medias sale con la version anterior y el cliente lo vuelve a pedir, nunca al reves
+    @staticmethod
+    async def _changed(*ids):
+        await cache.invalidate('trips', *ids)
+        await VersionRepo.bump('trips')
+
+@instrument
+class ArchiveRepo():
+    # archiveTrips(before: datetime, limit: int): mueve a los archivos un lote de hasta limit viajes terminados antes de before
+    # y sus reservas. Devuelve cuantos documentos se han movido de cada coleccion
+    @staticmethod
+    async def archiveTrips(before:datetime, limit:int, session=None):
+        trips = database.get_collection('trips')
+        bookings = database.get_collection('bookings')
+        _trips = await trips.find({"end_date":{"$lt":before}}, session=session).limit(limit).to_list(None)
+        if not _trips:
+            return {"trips": 0, "bookings": 0}
+        _tripIds = [trip["_id"] for trip in _trips]
+        _bookings = await bookings.find({"trip_id":{"$in":_tripIds}}, session=session).to_list(None)
+        # Se copia antes de borrar y con upsert: si el proceso se corta a medias, el siguiente lote repite la copia sin duplicar.
+        # Las reservas van primero para que ninguna quede sin su viaje en la coleccion activa
+        if _bookings:
+            await database.get_collection(ARCHIVES['bookings']).bulk_write(
+                [ReplaceOne({"_id":booking["_id"]}, booking, upsert=True) for booking in _bookings], ordered=False, session=session)
+            await bookings.delete_many({"_id":{"$in":[booking["_id"] for booking in _bookings]}}, session=session)
+        await database.get_collection(ARCHIVES['trips']).bulk_write(
+            [ReplaceOne({"_id":trip["_id"]}, trip, upsert=True) for trip in _trips], ordered=False, session=session)
+        await trips.delete_many({"_id":{"$in":_tripIds}}, session=session)
+        await VersionRepo.bump('trips', session)
+        # Son viajes terminados: si otra peticion los vuelve a cargar antes de confirmar la transaccion, caducan a los pocos segundos
+        await cache.invalidate('trips', *_tripIds)
+        return {"trips": len(_trips), "bookings": len(_bookings)}
 
+@instrument
 class UserRepo():
     # getUsers(): devuelve todos los usuarios en la base de datos
     @staticmethod
-    async def getUsers():
+    async def getUsers(limit:int=None, after:str=None, stream:bool=False, projection:dict=None):
+        collection = _find('users', {}, limit, after, projection=projection, read_preference=LIST_READS)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _users = []
-        collection = database.get_collection('users').find()
         async for user in collection:
             _users.append(user)
         return _users
     
-    # getUsersByName(name_substring: str): devuelve los usuarios cuyo nombre contiene el substring
-    @staticmethod
-    async def getUsersByName(name_substring: str):
+    # getUsersByName(name_substring: str): devuelve los usuarios cuyo nombre o apellidos empiezan por las palabras buscadas,
+    # sin distinguir mayusculas ni tildes y ordenados por relevancia (USER_SEARCH_SORT)
+    @staticmethod
+    async def getUsersByName(name_substring: str, limit:int=None, after:str=None, stream:bool=False, projection:dict=None):
+        _pipeline = searchPipeline(name_substring)
+        if after:
+            _pipeline.append({"$match":keyset({}, USER_SEARCH_SORT, after)})
+        _pipeline.append({"$sort":dict(USER_SEARCH_SORT)})
+        if limit:
+            _pipeline.append({"$limit":limit + 1})
+        if projection:
+            _pipeline.append({"$project":projection})
+        # Sin limit (streaming) se ordenan todas las coincidencias de una busqueda general: puede pasar a disco
+        collection = database.get_collection('users', read_preference=LIST_READS).aggregate(_pipeline, allowDiskUse=True)
+        # En modo streaming se devuelve el cursor sin consumir
+        if stream:
+            return collection
         _users = []
-        collection = database.get_collection('users').find({'name': {'$regex': f'.*{name_substring}.*'}})
         async for user in collection:
             _users.append(user)
         return _users
     
     # getUserId(id: str): devuelve el usuario correspondiente al identificador
+    # Se lee a traves de la cache (el documento completo, la proyeccion se aplica en memoria)
+    @staticmethod
+    async def getUserId(id:str, projection:dict=None):
+        return cache.select(await cache.get('users', id, UserRepo._load), projection)
+
     @staticmethod
-    async def getUserId(id: str):
+    async def _load(id:str):
         return await database.get_collection('users').find_one({"_id":id})
 
-    # addUser(user: User): añade un usuario a la base de datos
+    # getUsersByIds(ids:list): devuelve los usuarios de los identificadores en el mismo orden (None si no existe)
     @staticmethod
-    async def addUser(user: User):
-        id = str(uuid.uuid4())
-        _user = {
-            "_id":id,
+    async def getUsersByIds(ids:list, projection:dict=None):
+        return await _findMany('users', ids, projection)
+
+    # getUserStamp(id:str): version y fecha de modificacion del usuario, para las peticiones condicionales
+    @staticmethod
+    async def getUserStamp(id:str):
+        return await _stamp('users', id)
+
+    # toDocument(user: User): documento que se guarda en la base de datos para un usuario nuevo, con su id
+    @staticmethod
+    def toDocument(user: User):
+        return {
+            "_id": str(uuid.uuid4()),
             "name": user.name,
             "last_name": user.last_name,
             "bio": user.bio,
             "password": user.password,
             "email_address": user.email_address,
             "municipality": user.municipality,
-            "zip_code": user.zip_code
+            "zip_code": user.zip_code,
+            **searchFields(user.name, user.last_name),
+            **stamp(),
+            **{field: value for field, value in userPoint(user.municipality, user.zip_code).items() if value is not None}
         }
+
+    # addUser(user: User): añade un usuario a la base de datos con la contraseña derivada
+    @staticmethod
+    async def addUser(user: User):
+        _user = UserRepo.toDocument(user)
+        _user["password"] = await hashPassword(user.password)
         await database.get_collection('users').insert_one(_user)
+        await cache.invalidate('users', _user["_id"])
         
-    # updateUser(id: str, user: User): modifica el usuario correspondiente al id con nuevos atributos
-    @staticmethod
-    async def updateUser(id: str, user: User):
-        _user = await database.get_collection('users').find_one({"_id":id})
-        _user["name"] = user.name
-        _user["last_name"] = user.last_name
-        _user["bio"] = user.bio
-        _user["password"] = user.password
-        _user["email_address"] = user.email_address
-        _user["municipality"] = user.municipality
-        _user["zip_code"] = user.zip_code
-        await database.get_collection('users').update_one({"_id":id}, {"$set":_user})
+    # updateUser(id: str, fields: dict): modifica solo los atributos indicados del usuario correspondiente al id
+    # Devuelve False si el usuario no existe. Una contraseña nueva se guarda derivada
+    @staticmethod
+    async def updateUser(id: str, fields: dict):
+        if "password" in fields:
+            fields = dict(fields, password=await hashPassword(fields["password"]))
+        try:
+            return await UserRepo._updateUser(id, fields)
+        finally:
+            await cache.invalidate('users', id)
+
+    @staticmethod
+    async def _updateUser(id: str, fields: dict):
+        users = database.get_collection('users')
+        _set = dict(fields)
+        _points = {}
+        # Campos derivados de dos atributos: si cambia solo uno de ellos hace falta leer el otro
+        _names = {"name", "last_name"}.intersection(fields)
+        _places = {"municipality", "zip_code"}.intersection(fields)
+        if len(_names) == 2:
+            _set.update(searchFields(fields["name"], fields["last_name"]))
+        if len(_places) == 2:
+            _points = userPoint(fields["municipality"], fields["zip_code"])
+        if len(_names) != 1 and len(_places) != 1:
+            result = await users.update_one({"_id":id}, touch(pointUpdate(_set, _points)))
+            return result.matched_count == 1
+        _user = await users.find_one_and_update({"_id":id}, touch(pointUpdate(_set, _points)),
+                                                projection={"name":1, "last_name":1, "municipality":1, "zip_code":1},
+                                                return_document=ReturnDocument.AFTER)
+        if _user is None:
+            return False
+        # Condicionado a los valores leidos: si otro cambio se adelanta, sus campos derivados son los que quedan
+        if len(_names) == 1:
+            await users.update_one({"_id":id, "name":_user["name"], "last_name":_user["last_name"]},
+                                   {"$set":searchFields(_user["name"], _user["last_name"])})
+        if len(_places) == 1:
+            await users.update_one({"_id":id, "municipality":_user.get("municipality"), "zip_code":_user.get("zip_code")},
+                                   pointUpdate({}, userPoint(_user.get("municipality"), _user.get("zip_code"))))
+        return True
         
     # deleteUser(id: str): elimina el usuario correspondiente al id 
     @staticmethod
     async def deleteUser(id:str):
         await database.get_collection('users').delete_one({"_id":id})
+        await cache.invalidate('users', id)
         
     # userExists(id: str): comprueba si el usuario correspondiente al id existe en la base de datos
     @staticmethod
     async def userExists(id: str):
-        user = await database.get_collection('users').find_one({"_id":id})
-        return user is not None
+        return await cache.get('users', id, UserRepo._load) is not None
+
+    # getCredentials(email_address: str): id y contraseña guardada del usuario con ese email, para iniciar sesion
+    @staticmethod
+    async def getCredentials(email_address: str):
+        return await database.get_collection('users').find_one({"email_address":email_address}, {"password":1})
+
+    # setPassword(id: str, password: str, current: str): guarda la contraseña derivada si sigue siendo current
+    # (no pisa un cambio de contraseña hecho mientras se derivaba)
+    @staticmethod
+    async def setPassword(id: str, password: str, current: str):
+        result = await database.get_collection('users').update_one({"_id":id, "password":current}, {"$set":{"password":password}})
+        await cache.invalidate('users', id)
+        return result.modified_count == 1
+
+@instrument
+class JobRepo():
+    # getJobById(id: str): devuelve el trabajo en segundo plano correspondiente al identificador
+    @staticmethod
+    async def getJobById(id: str):
+        return await database.get_collection('jobs').find_one({"_id":id})
+
+    # addJob(type: str, target: str, requested_by: str): registra un trabajo en segundo plano pendiente y devuelve su id
+    # (requested_by: usuario que lo lanzo, el unico que puede consultarlo con AUTH_REQUIRED)
+    @staticmethod
+    async def addJob(type: str, target: str, requested_by: str = None):
+        id = str(uuid.uuid4())
+        _job = {
+            "_id": id,
+            "type": type,
+            "target": target,
+            "requested_by": requested_by,
+            "status": "running",
+            "created_at": datetime.utcnow()
+        }
+        await database.get_collection('jobs').insert_one(_job)
+        return id
+
+    # finishJob(id: str, status: str, result: dict): marca el trabajo como terminado ("done" o "failed") con su resultado
+    @staticmethod
+    async def finishJob(id: str, status: str, result: dict):
+        await database.get_collection('jobs').update_one({"_id":id}, {"$set":{"status":status, "result":result, "finished_at":datetime.utcnow()}})
+
+@instrument
+class VersionRepo():
+    # Contador de cambios por coleccion para los validadores de los listados: un solo documento pequeño por coleccion
+    # en versions, que sube con cada escritura (una actualizacion mas por escritura a cambio de no releer el listado)
+
+    # getVersion(collection: str): version y fecha del ultimo cambio de la coleccion (version 0 si nunca ha cambiado)
+    @staticmethod
+    async def getVersion(collection: str):
+        return await database.get_collection('versions').find_one({"_id":collection}) or {"_id":collection, "version":0}
+
+    # bump(collection: str): anota un cambio en la coleccion
+    @staticmethod
+    async def bump(collection: str, session=None):
+        await database.get_collection('versions').update_one({"_id":collection}, touch({}), upsert=True, session=session)
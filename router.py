@@ -1,6 +1,24 @@
-from fastapi import APIRouter
-from repository import BookingRepo, MessageRepo, ReviewRepo, TripRepo, UserRepo
-from model import Booking, Message, Review, Trip, User, Response
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from loader import Loaders
+from auth import authenticate, authorize, authorizeReview, authorizeTrip, isOwner, login, operator, owner
+from repository import INBOX_SORT, BookingRepo, InboxRepo, JobRepo, MessageRepo, RatingRepo, ReviewRepo, TripRepo, UserRepo, VersionRepo
+from model import Booking, BookingUpdate, Login, Message, Review, ReviewUpdate, Trip, TripUpdate, User, UserUpdate
+import asyncio
+from typing import Optional
+import bulk
+import cascade
+import config
+import conversations
+import metrics
+from pagination import ID_SORT, MAX_LIMIT, NDJSON_MEDIA_TYPE, Page, page, parseIds, streamResponse
+from projection import projection
+from dates import DATE_SORT, parseDay, parseMoment, parseTime, present, presenter
+from etags import STAMP_FIELDS, conditional, notModified, notModifiedResponse, split, validators
+from geo import DEFAULT_RADIUS, MAX_RADIUS, NEAR_SORT, location
+from search import USER_SEARCH_SORT
+from serialization import respond
+from indexes import TRIP_SEARCH_SORTS, tripSearchSupported
 
 """
 router.py: Contiene los métodos get, create, update y delete
@@ -10,276 +28,606 @@ router = APIRouter(prefix="/BlaBlaETSIINF")
 
 # BOOKING METHODS---------------------------------------------------------------------------------------------------------------
 
-@router.get("/users/{user_id}/bookings/{id}")
-async def get_id_booking(user_id: str, id: str):
-    _booking = await BookingRepo.getBookingById(id)
+@router.get("/users/{user_id}/bookings/{id}", dependencies=[Depends(owner)])
+async def get_id_booking(user_id: str, id: str, fields: str = None, include_archived: bool = False):
+    _booking = await BookingRepo.getBookingById(id, projection('bookings', fields, required=("user_id",)), include_archived)
     if not _booking or _booking["user_id"] != user_id:
-        return Response(code=404, status="Not found", message=f"No booking found with id {id} for user {user_id}").dict(exclude_none=True)
-    return Response(code=200, status="Ok", message="Success retrieving data from booking", result=_booking).dict(exclude_none=True)
+        return respond(code=404, status="Not found", message=f"No booking found with id {id} for user {user_id}")
+    return respond(code=200, status="Ok", message="Success retrieving data from booking", result=_booking)
 
-@router.get("/users/{user_id}/bookings/")
-async def get_user_bookings(user_id: str):
-    _bookingList = await BookingRepo.getBookingsByUser(user_id)
+@router.get("/users/{user_id}/bookings/", dependencies=[Depends(owner)])
+async def get_user_bookings(user_id: str, fields: str = None, include_archived: bool = False, _page: Page = Depends()):
+    # Con include_archived tambien devuelve las reservas de viajes ya terminados y archivados (historial)
+    _bookingList = await BookingRepo.getBookingsByUser(user_id, _page.limit, _page.after, stream=_page.stream,
+                                                       projection=projection('bookings', fields), include_archived=include_archived)
+    if _page.stream:
+        return streamResponse(_bookingList)
+    _bookingList, _next = page(_bookingList, _page.limit)
     if len(_bookingList) == 0:
-        return Response(code=404,status="Not found",message=f"No bookings found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving data from bookings", result=_bookingList).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No bookings found")
+    return respond(code=200,status="Ok",message="Success retrieving data from bookings", result=_bookingList, next=_next)
 
-@router.put("/users/{user_id}/bookings/")
-async def create_booking(user_id: str, booking: Booking):
+@router.put("/users/{user_id}/bookings/", dependencies=[Depends(owner)])
+async def create_booking(user_id: str, booking: Booking, _loaders: Loaders = Depends()):
     # Comprueba que el usuario de la reserva es correcto
     if not user_id == booking.user_id:
-          return Response(code=400,status="Bad Request",message="The users don't match").dict(exclude_none=True)  
-    # Comprueba que existe el usuario
-    user_exists = await UserRepo.userExists(user_id)
-    if not user_exists:
-        return Response(code=400,status="Bad Request",message="Unknown user").dict(exclude_none=True)
-    # Comprueba que existe el viaje
-    trip_exists = await TripRepo.tripExists(booking.trip_id)
-    if not trip_exists:
-        return Response(code=400,status="Bad Request",message="Unknown trip").dict(exclude_none=True)
+          return respond(code=400,status="Bad Request",message="The users don't match")  
     # El estado debe ser ["accepted", "denied" o "pending"]
     if not booking.status in ["accepted", "denied", "pending"]:
-        return Response(code=400,status="Bad Request",message="Incorrect status value").dict(exclude_none=True)
-    await BookingRepo.addBooking(booking)
-    return Response(code=200,status="Ok",message="Success saving data").dict(exclude_none=True)
+        return respond(code=400,status="Bad Request",message="Incorrect status value")
+    # Comprueba a la vez que existen el usuario y el viaje
+    user_exists, trip_exists = await asyncio.gather(_loaders.users.exists(user_id), _loaders.trips.exists(booking.trip_id))
+    if not user_exists:
+        return respond(code=400,status="Bad Request",message="Unknown user")
+    if not trip_exists:
+        return respond(code=400,status="Bad Request",message="Unknown trip")
+    if not await BookingRepo.addBooking(booking):
+        return respond(code=409,status="Conflict",message="No places available")
+    return respond(code=200,status="Ok",message="Success saving data")
 
-@router.put("/users/{user_id}/bookings/{id}")
-async def update_booking(user_id: str, id: str, booking: User):
+@router.put("/users/{user_id}/bookings/{id}", dependencies=[Depends(owner)])
+async def update_booking(user_id: str, id: str, booking: Booking, _loaders: Loaders = Depends()):
     # Comprueba que el usuario de la reserva es correcto
     if not user_id == booking.user_id:
-          return Response(code=400,status="Bad Request",message="The users don't match").dict(exclude_none=True)  
-    # Comprueba que existe la reserva
-    booking_exists = await BookingRepo.bookingExists(id)
-    if not booking_exists:
-        return Response(code=404,status="Not found",message=f"No booking with id {id} found").dict(exclude_none=True)
-    # Comprueba que existe el usuario
-    user_exists = await UserRepo.userExists(user_id)
+          return respond(code=400,status="Bad Request",message="The users don't match")  
+    # El estado debe ser ["accepted", "denied" o "pending"]
+    if not booking.status in ["accepted", "denied", "pending"]:
+        return respond(code=400,status="Bad Request",message="Incorrect status value")
+    # Comprueba a la vez que existen el usuario y el viaje; la existencia de la reserva la da la propia actualizacion
+    user_exists, trip_exists = await asyncio.gather(_loaders.users.exists(user_id), _loaders.trips.exists(booking.trip_id))
     if not user_exists:
-        return Response(code=400,status="Bad Request",message="Unknown user").dict(exclude_none=True)
-    # Comprueba que existe el viaje
-    trip_exists = await TripRepo.tripExists(booking.trip_id)
+        return respond(code=400,status="Bad Request",message="Unknown user")
     if not trip_exists:
-        return Response(code=400,status="Bad Request",message="Unknown trip").dict(exclude_none=True)
+        return respond(code=400,status="Bad Request",message="Unknown trip")
+    # Solo las reservas del propio usuario: las de otro no existen para esta ruta
+    _updated = await BookingRepo.updateBooking(id, booking.dict(), user_id)
+    if _updated is None:
+        return respond(code=404,status="Not found",message=f"No booking found with id {id} for user {user_id}")
+    if not _updated:
+        return respond(code=409,status="Conflict",message="No places available")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.patch("/users/{user_id}/bookings/{id}", dependencies=[Depends(owner)])
+async def patch_booking(user_id: str, id: str, booking: BookingUpdate, _loaders: Loaders = Depends()):
+    _fields = booking.dict(exclude_none=True)
+    if len(_fields) == 0:
+        return respond(code=400,status="Bad Request",message="No fields to update")
+    # Comprueba que el usuario de la reserva es correcto
+    if "user_id" in _fields and not user_id == _fields["user_id"]:
+          return respond(code=400,status="Bad Request",message="The users don't match")  
     # El estado debe ser ["accepted", "denied" o "pending"]
-    if not booking.status in ["accepted", "denied", "pending"]:
-        return Response(code=400,status="Bad Request",message="Incorrect status value").dict(exclude_none=True)
-    await BookingRepo.updateBooking(id, booking)
-    return Response(code=200,status="Ok",message="Success updating data").dict(exclude_none=True)
+    if "status" in _fields and not _fields["status"] in ["accepted", "denied", "pending"]:
+        return respond(code=400,status="Bad Request",message="Incorrect status value")
+    # Solo se comprueba el viaje si cambia
+    if "trip_id" in _fields and not await _loaders.trips.exists(_fields["trip_id"]):
+        return respond(code=400,status="Bad Request",message="Unknown trip")
+    _updated = await BookingRepo.updateBooking(id, _fields, user_id)
+    if _updated is None:
+        return respond(code=404,status="Not found",message=f"No booking found with id {id} for user {user_id}")
+    if not _updated:
+        return respond(code=409,status="Conflict",message="No places available")
+    return respond(code=200,status="Ok",message="Success updating data")
 
-@router.delete("/users/{user_id}/bookings/{id}")
+@router.delete("/users/{user_id}/bookings/{id}", dependencies=[Depends(owner)])
 async def delete_booking(user_id: str, id: str):
-    booking_exists = await BookingRepo.bookingExists(id)
-    if not booking_exists:
-        return Response(code=404,status="Not found",message=f"No booking with id {id} found").dict(exclude_none=True)
-    await BookingRepo.deleteBooking(id)
-    return Response(code=200,status="Ok",message="Success deleting data").dict(exclude_none=True)
+    if not await BookingRepo.deleteBooking(id, user_id):
+        return respond(code=404,status="Not found",message=f"No booking found with id {id} for user {user_id}")
+    return respond(code=200,status="Ok",message="Success deleting data")
 
 # MESSAGE METHODS---------------------------------------------------------------------------------------------------------------
 
-@router.get("/users/{user_id}/messages/{id}")
-async def get_id_message(user_id: str, id: str):
-    _message = await MessageRepo.getMessageById(id)
-    if not _message or _message["user_id"] != user_id:
-        return Response(code=404, status="Not found", message=f"No message found with id {id} for user {user_id}").dict(exclude_none=True)
-    return Response(code=200, status="Ok", message="Success retrieving data from message", result=_message).dict(exclude_none=True)
-
-@router.get("/users/{user_id}/messages/")
-async def get_recipient_messages(user_id: str):
-    _receivedMessages = await MessageRepo.getMessagesByRecipient(user_id)
-    _sentMessages = await MessageRepo.getMessagesBySender(user_id)
-    _messageList = list(_receivedMessages) + _sentMessages
+@router.get("/users/{user_id}/messages/{id}", dependencies=[Depends(owner)])
+async def get_id_message(user_id: str, id: str, fields: str = None):
+    _message = await MessageRepo.getMessageById(id, projection('messages', fields, required=("sender_id", "recipient_id")))
+    if not _message or user_id not in (_message["sender_id"], _message["recipient_id"]):
+        return respond(code=404, status="Not found", message=f"No message found with id {id} for user {user_id}")
+    return respond(code=200, status="Ok", message="Success retrieving data from message", result=present('messages', _message))
+
+@router.get("/users/{user_id}/messages/", dependencies=[Depends(owner)])
+async def get_recipient_messages(user_id: str, since: str = None, until: str = None, fields: str = None, _page: Page = Depends()):
+    # Mensajes recibidos y enviados en una sola consulta paginada, en orden cronologico y opcionalmente desde/hasta una fecha
+    _messageList = await MessageRepo.getMessagesByUser(user_id, _page.limit, _page.after, stream=_page.stream,
+                                                       projection=projection('messages', fields, sort=DATE_SORT),
+                                                       since=parseMoment(since), until=parseMoment(until))
+    if _page.stream:
+        return streamResponse(_messageList, presenter('messages'))
+    _messageList, _next = page(_messageList, _page.limit, DATE_SORT)
     if len(_messageList) == 0:
-        return Response(code=404,status="Not found",message=f"No messages found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving data from messages", result=_messageList).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No messages found")
+    return respond(code=200,status="Ok",message="Success retrieving data from messages", result=present('messages', _messageList), next=_next)
 
-@router.put("/users/{user_id}/messages/")
-async def create_message(user_id: str, message: Message):
-    # Comprueba que el usuario de la reserva es correcto
-    if not user_id == message.user_id:
-          return Response(code=400,status="Bad Request",message="The users don't match").dict(exclude_none=True)  
-    # Comprueba que existe el receptor
-    recipient_exists = await UserRepo.userExists(message.recipient_id)
+@router.put("/users/{user_id}/messages/", dependencies=[Depends(owner)])
+async def create_message(user_id: str, message: Message, _loaders: Loaders = Depends()):
+    # Comprueba que el usuario del mensaje es correcto
+    if not user_id == message.sender_id:
+          return respond(code=400,status="Bad Request",message="The users don't match")  
+    # Comprueba que existen el receptor y el emisor (una sola consulta sobre users)
+    recipient_exists, sender_exists = await asyncio.gather(_loaders.users.exists(message.recipient_id), _loaders.users.exists(message.sender_id))
     if not recipient_exists:
-        return Response(code=400,status="Bad Request",message="Unknown recipient").dict(exclude_none=True)
-    # Comprueba que existe el emisor
-    sender_exists = await TripRepo.tripExists(message.sender_id)
+        return respond(code=400,status="Bad Request",message="Unknown recipient")
     if not sender_exists:
-        return Response(code=400,status="Bad Request",message="Unknown sender").dict(exclude_none=True)
-    await MessageRepo.addMessage(message)
-    return Response(code=200,status="Ok",message="Success saving data").dict(exclude_none=True)
+        return respond(code=400,status="Bad Request",message="Unknown sender")
+    _message = await MessageRepo.addMessage(message)
+    # Aviso inmediato a las conexiones abiertas en /users/{id}/events del emisor y del receptor
+    await conversations.broker.publish(_message)
+    return respond(code=200,status="Ok",message="Success saving data")
 
-@router.delete("/users/{user_id}/messages/{id}")
+@router.delete("/users/{user_id}/messages/{id}", dependencies=[Depends(owner)])
 async def delete_message(user_id: str, id: str):
-    message_exists = await MessageRepo.messageExists(id)
-    if not message_exists:
-        return Response(code=404,status="Not found",message=f"No message with id {id} found").dict(exclude_none=True)
-    await MessageRepo.deleteMessage(id)
-    return Response(code=200,status="Ok",message="Success deleting data").dict(exclude_none=True)
+    # Lo ven el emisor y el receptor, pero solo lo borra quien lo envio
+    _message = await MessageRepo.getMessageById(id, {"sender_id":1, "recipient_id":1})
+    if not _message or user_id not in (_message["sender_id"], _message["recipient_id"]):
+        return respond(code=404,status="Not found",message=f"No message found with id {id} for user {user_id}")
+    if _message["sender_id"] != user_id:
+        return respond(code=403,status="Forbidden",message="Only the sender can delete a message")
+    if not await MessageRepo.deleteMessage(id, user_id):
+        return respond(code=404,status="Not found",message=f"No message found with id {id} for user {user_id}")
+    return respond(code=200,status="Ok",message="Success deleting data")
+
+@router.get("/users/{user_id}/conversations/", dependencies=[Depends(owner)])
+async def get_user_conversations(user_id: str, _page: Page = Depends()):
+    # Bandeja de entrada: una entrada por conversacion con el ultimo mensaje y los pendientes de leer, la mas reciente primero
+    _inbox = await InboxRepo.getInbox(user_id, _page.limit, _page.after, stream=_page.stream)
+    if _page.stream:
+        return streamResponse(_inbox, presenter('inbox'))
+    _inbox, _next = page(_inbox, _page.limit, INBOX_SORT)
+    if len(_inbox) == 0:
+        return respond(code=404,status="Not found",message=f"No conversations found")
+    return respond(code=200,status="Ok",message="Success retrieving data from conversations", result=present('inbox', _inbox), next=_next)
+
+@router.get("/users/{user_id}/conversations/{peer_id}", dependencies=[Depends(owner)])
+async def get_conversation(user_id: str, peer_id: str, since: str = None, until: str = None, fields: str = None, _page: Page = Depends()):
+    # Mensajes entre los dos usuarios en orden cronologico
+    _messageList = await MessageRepo.getThread(user_id, peer_id, _page.limit, _page.after, stream=_page.stream,
+                                               projection=projection('messages', fields, sort=DATE_SORT),
+                                               since=parseMoment(since), until=parseMoment(until))
+    if _page.stream:
+        return streamResponse(_messageList, presenter('messages'))
+    _messageList, _next = page(_messageList, _page.limit, DATE_SORT)
+    if len(_messageList) == 0:
+        return respond(code=404,status="Not found",message=f"No messages found")
+    return respond(code=200,status="Ok",message="Success retrieving data from messages", result=present('messages', _messageList), next=_next)
+
+@router.put("/users/{user_id}/conversations/{peer_id}/read", dependencies=[Depends(owner)])
+async def read_conversation(user_id: str, peer_id: str):
+    if not await InboxRepo.markRead(user_id, peer_id):
+        return respond(code=404,status="Not found",message=f"No conversation with user {peer_id} found")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.get("/users/{user_id}/events", dependencies=[Depends(owner)])
+async def get_user_events(user_id: str):
+    # Server-Sent Events: los mensajes nuevos llegan en cuanto se guardan, sin consultar periodicamente
+    return StreamingResponse(conversations.events(user_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # REVIEW METHODS----------------------------------------------------------------------------------------------------------------
 
 @router.get("/users/{user_id}/reviews/{id}")
-async def get_id_review(user_id: str, id: str):
-    _review = await ReviewRepo.getReviewById(id)
-    if not _review or _review["user_id"] != user_id:
-        return Response(code=404, status="Not found", message=f"No review found with id {id} for user {user_id}").dict(exclude_none=True)
-    return Response(code=200, status="Ok", message="Success retrieving data from review", result=_review).dict(exclude_none=True)
+async def get_id_review(user_id: str, id: str, fields: str = None):
+    _review = await ReviewRepo.getReviewById(id, projection('reviews', fields, required=("driver_id",)))
+    if not _review or _review["driver_id"] != user_id:
+        return respond(code=404, status="Not found", message=f"No review found with id {id} for user {user_id}")
+    return respond(code=200, status="Ok", message="Success retrieving data from review", result=present('reviews', _review))
 
 @router.get("/users/{user_id}/reviews/")
-async def get_user_reviews(user_id: str):
-    _reviewList = await ReviewRepo.getReviewsByUser(user_id)
+async def get_user_reviews(user_id: str, since: str = None, until: str = None, fields: str = None, _page: Page = Depends()):
+    _reviewList = await ReviewRepo.getReviewsByUser(user_id, _page.limit, _page.after, stream=_page.stream,
+                                                    projection=projection('reviews', fields, sort=DATE_SORT),
+                                                    since=parseMoment(since), until=parseMoment(until))
+    if _page.stream:
+        return streamResponse(_reviewList, presenter('reviews'))
+    _reviewList, _next = page(_reviewList, _page.limit, DATE_SORT)
     if len(_reviewList) == 0:
-        return Response(code=404,status="Not found",message=f"No reviews found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving data from reviews", result=_reviewList).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No reviews found")
+    return respond(code=200,status="Ok",message="Success retrieving data from reviews", result=present('reviews', _reviewList), next=_next)
 
 @router.put("/users/{user_id}/reviews/")
-async def create_review(user_id: str, review: Review):
+async def create_review(user_id: str, review: Review, _loaders: Loaders = Depends(), _caller: Optional[str] = Depends(authenticate)):
+    # La reseña la escribe su autor
+    authorize(_caller, review.reviewer_id)
     # Comprueba que el usuario de la reseña es correcto
     if not user_id == review.driver_id:
-          return Response(code=400,status="Bad Request",message="The users don't match").dict(exclude_none=True)  
-    # Comprueba que existe el usuario
-    user_exists = await UserRepo.userExists(user_id)
+          return respond(code=400,status="Bad Request",message="The users don't match")  
+    # La puntuacion debe estar entre 1 y 5
+    if not review.rating in [1, 2, 3, 4, 5]:
+        return respond(code=400,status="Bad Request",message="Incorrect rating value")
+    # Comprueba que existen el conductor y el autor (una sola consulta sobre users)
+    user_exists, reviewer_exists = await asyncio.gather(_loaders.users.exists(user_id), _loaders.users.exists(review.reviewer_id))
     if not user_exists:
-        return Response(code=400,status="Bad Request",message="Unknown user").dict(exclude_none=True)
-    # Comprueba que existe el viaje
-    reviewer_exists = await UserRepo.userExists(review.reviewer_id)
+        return respond(code=400,status="Bad Request",message="Unknown user")
     if not reviewer_exists:
-        return Response(code=400,status="Bad Request",message="Unknown reviewer").dict(exclude_none=True)
-    # El estado debe ser ["accepted", "denied" o "pending"]
-    if not review.rating in [1, 2, 3, 4, 5]:
-        return Response(code=400,status="Bad Request",message="Incorrect rating value").dict(exclude_none=True)
+        return respond(code=400,status="Bad Request",message="Unknown reviewer")
     await ReviewRepo.addReview(review)
-    return Response(code=200,status="Ok",message="Success saving data").dict(exclude_none=True)
+    return respond(code=200,status="Ok",message="Success saving data")
 
 @router.put("/users/{user_id}/reviews/{id}")
-async def update_review(user_id: str, id: str, review: User):
-    # Comprueba que existe la reseña
-    review_exists = await ReviewRepo.reviewExists(id)
-    if not review_exists:
-        return Response(code=400,status="Bad Request",message="Unknown review").dict(exclude_none=True)
+async def update_review(user_id: str, id: str, review: Review, _loaders: Loaders = Depends(),
+                        _caller: Optional[str] = Depends(authenticate)):
+    authorize(_caller, review.reviewer_id)
+    await authorizeReview(_caller, id)
     # Comprueba que el usuario de la reseña es correcto
     if not user_id == review.driver_id:
-          return Response(code=400,status="Bad Request",message="The users don't match").dict(exclude_none=True)  
-    # Comprueba que existe el usuario
-    user_exists = await UserRepo.userExists(user_id)
+          return respond(code=400,status="Bad Request",message="The users don't match")  
+    # La puntuacion debe estar entre 1 y 5
+    if not review.rating in [1, 2, 3, 4, 5]:
+        return respond(code=400,status="Bad Request",message="Incorrect rating value")
+    # Comprueba que existen el conductor y el autor; la existencia de la reseña la da la propia actualizacion
+    user_exists, reviewer_exists = await asyncio.gather(_loaders.users.exists(user_id), _loaders.users.exists(review.reviewer_id))
     if not user_exists:
-        return Response(code=400,status="Bad Request",message="Unknown user").dict(exclude_none=True)
-    # Comprueba que existe el viaje
-    reviewer_exists = await UserRepo.userExists(review.reviewer_id)
+        return respond(code=400,status="Bad Request",message="Unknown user")
     if not reviewer_exists:
-        return Response(code=400,status="Bad Request",message="Unknown reviewer").dict(exclude_none=True)
-    # El estado debe ser ["accepted", "denied" o "pending"]
-    if not review.rating in [1, 2, 3, 4, 5]:
-        return Response(code=400,status="Bad Request",message="Incorrect rating value").dict(exclude_none=True)
-    await ReviewRepo.updateReview(id, review)
-    return Response(code=200,status="Ok",message="Success updating data").dict(exclude_none=True)
+        return respond(code=400,status="Bad Request",message="Unknown reviewer")
+    if not await ReviewRepo.updateReview(id, review.dict(), user_id):
+        return respond(code=404,status="Not found",message=f"No review found with id {id} for user {user_id}")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.patch("/users/{user_id}/reviews/{id}")
+async def patch_review(user_id: str, id: str, review: ReviewUpdate, _loaders: Loaders = Depends(),
+                       _caller: Optional[str] = Depends(authenticate)):
+    _fields = review.dict(exclude_none=True)
+    if len(_fields) == 0:
+        return respond(code=400,status="Bad Request",message="No fields to update")
+    authorize(_caller, _fields.get("reviewer_id"))
+    await authorizeReview(_caller, id)
+    # Comprueba que el usuario de la reseña es correcto
+    if "driver_id" in _fields and not user_id == _fields["driver_id"]:
+          return respond(code=400,status="Bad Request",message="The users don't match")  
+    # La puntuacion debe estar entre 1 y 5
+    if "rating" in _fields and not _fields["rating"] in [1, 2, 3, 4, 5]:
+        return respond(code=400,status="Bad Request",message="Incorrect rating value")
+    # Solo se comprueba el autor si cambia
+    if "reviewer_id" in _fields and not await _loaders.users.exists(_fields["reviewer_id"]):
+        return respond(code=400,status="Bad Request",message="Unknown reviewer")
+    if not await ReviewRepo.updateReview(id, _fields, user_id):
+        return respond(code=404,status="Not found",message=f"No review found with id {id} for user {user_id}")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.get("/users/{user_id}/rating")
+async def get_user_rating(user_id: str):
+    # Estadisticas precalculadas: no se recorren las reseñas del conductor
+    _rating = await RatingRepo.getRating(user_id)
+    if not _rating:
+        if not await UserRepo.userExists(user_id):
+            return respond(code=404,status="Not found",message=f"No user with id {user_id} found")
+        _rating = RatingRepo.emptyRating(user_id)
+    return respond(code=200,status="Ok",message="Success retrieving rating from user", result=_rating)
 
 @router.delete("/users/{user_id}/reviews/{id}")
-async def delete_review(user_id: str, id: str):
-    review_exists = await UserRepo.userExists(id)
-    if not review_exists:
-        return Response(code=404,status="Not found",message=f"No review with id {id} found").dict(exclude_none=True)
-    await ReviewRepo.deleteReview(id)
-    return Response(code=200,status="Ok",message="Success deleting data").dict(exclude_none=True)
+async def delete_review(user_id: str, id: str, _caller: Optional[str] = Depends(authenticate)):
+    await authorizeReview(_caller, id)
+    # Solo las reseñas sobre el usuario de la ruta
+    if not await ReviewRepo.deleteReview(id, user_id):
+        return respond(code=404,status="Not found",message=f"No review found with id {id} for user {user_id}")
+    return respond(code=200,status="Ok",message="Success deleting data")
 
 # TRIP METHODS------------------------------------------------------------------------------------------------------------------
 
 @router.get("/trips/")
-async def get_all_trips(driver_id: str):
-    # Si incluye un substring, debera buscar viajes con conductores que lo incluyan en su nombre
+async def get_all_trips(request: Request, driver_id: str = None, ids: str = None, fields: str = None, with_rating: bool = False,
+                        include_archived: bool = False, _page: Page = Depends()):
+    _projection = projection('trips', fields, required=("driver_id",) if with_rating else ())
+    # Validadores de la version de la coleccion, leida antes que los viajes. Con with_rating no hay: las valoraciones
+    # cambian sin que cambien los viajes
+    _headers = None
+    if not with_rating:
+        _headers = validators('trips', await VersionRepo.getVersion('trips'))
+        if notModified(request, _headers):
+            return notModifiedResponse(_headers)
+    # Lectura multiple (ids=a,b,c): los viajes en el orden pedido con una sola consulta, null los que no existen
+    if ids is not None:
+        _ids = parseIds(ids)
+        if driver_id or not 0 < len(_ids) <= MAX_LIMIT:
+            return respond(code=400,status="Bad Request",message=f"ids takes between 1 and {MAX_LIMIT} ids and no driver_id")
+        _tripList = await TripRepo.getTripsByIds(_ids, _projection, include_archived)
+        if with_rating:
+            await RatingRepo.embedRatings([trip for trip in _tripList if trip is not None])
+        return respond(code=200,status="Ok",message="Success retrieving data from trips",
+                       result=[present('trips', trip) if trip is not None else None for trip in _tripList], headers=_headers)
+    # Si incluye un conductor, devuelve solo sus viajes
     if(driver_id):
-        _tripList = await TripRepo.getTripsByUser(driver_id)
-    # Si no, devuelve todos los usuarios
+        _tripList = await TripRepo.getTripsByUser(driver_id, _page.limit, _page.after, stream=_page.stream, projection=_projection,
+                                                  include_archived=include_archived)
+    # Si no, devuelve todos los viajes (con include_archived, tambien los terminados)
     else:
-        _tripList = await TripRepo.getTrips()
+        _tripList = await TripRepo.getTrips(_page.limit, _page.after, stream=_page.stream, projection=_projection,
+                                            include_archived=include_archived)
+    if _page.stream:
+        return streamResponse(_tripList, presenter('trips'), _headers)
+    _tripList, _next = page(_tripList, _page.limit)
     if len(_tripList)==0:
-        return Response(code=404,status="Not found",message=f"No trips found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving all data", result=_tripList).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No trips found")
+    # Las valoraciones de todos los conductores de la pagina se leen en una sola consulta (no se añaden en streaming)
+    if with_rating:
+        await RatingRepo.embedRatings(_tripList)
+    return respond(code=200,status="Ok",message="Success retrieving all data", result=present('trips', _tripList), next=_next,
+                   headers=_headers)
+
+@router.get("/trips/search")
+async def search_trips(start_location: str = None, arrival_location: str = None, day: str = None,
+                       day_from: str = None, day_to: str = None,
+                       departure_from: str = None, departure_to: str = None, min_places: int = None,
+                       min_price: int = None, max_price: int = None, trip_type: str = None,
+                       sort: str = "departure_time", descending: bool = False, fields: str = None, with_rating: bool = False,
+                       _page: Page = Depends()):
+    _equals = {field: value for field, value in [("start_location", start_location), ("arrival_location", arrival_location),
+                                                 ("day", parseDay(day)), ("trip_type", trip_type)] if value is not None}
+    _dayRange = day_from is not None or day_to is not None
+    # Un intervalo de dias (proximos viajes) usa los mismos indices que la igualdad sobre day, en orden cronologico
+    if _dayRange and "day" in _equals:
+        return respond(code=400,status="Bad Request",message="Use either day or day_from/day_to")
+    if _dayRange and sort != "day":
+        return respond(code=400,status="Bad Request",message="day_from/day_to require sort=day")
+    # Solo se admiten las combinaciones que tienen un indice compuesto detras
+    if not tripSearchSupported(set(_equals) | ({"day"} if _dayRange else set())):
+        return respond(code=400,status="Bad Request",message=f"Unsupported filter combination: {', '.join(sorted(_equals))}")
+    if sort not in TRIP_SEARCH_SORTS:
+        return respond(code=400,status="Bad Request",message=f"Sort must be one of {', '.join(TRIP_SEARCH_SORTS)}")
+    _direction = -1 if descending else 1
+    _sort = [(field, _direction) for field in TRIP_SEARCH_SORTS[sort]] + [("_id", _direction)]
+    _tripList = await TripRepo.searchTrips(_equals, parseTime(departure_from), parseTime(departure_to), min_places, min_price, max_price,
+                                           _sort, _page.limit, _page.after, stream=_page.stream,
+                                           projection=projection('trips', fields, required=("driver_id",) if with_rating else (), sort=_sort),
+                                           day_from=parseDay(day_from), day_to=parseDay(day_to))
+    if _page.stream:
+        return streamResponse(_tripList, presenter('trips'))
+    _tripList, _next = page(_tripList, _page.limit, _sort)
+    if len(_tripList)==0:
+        return respond(code=404,status="Not found",message=f"No trips found")
+    if with_rating:
+        await RatingRepo.embedRatings(_tripList)
+    return respond(code=200,status="Ok",message="Success retrieving all data", result=present('trips', _tripList), next=_next)
+
+@router.get("/trips/near")
+async def search_trips_near(origin: str = None, origin_lat: float = None, origin_lon: float = None,
+                            origin_radius: int = Query(DEFAULT_RADIUS, ge=1, le=MAX_RADIUS),
+                            destination: str = None, destination_lat: float = None, destination_lon: float = None,
+                            destination_radius: int = Query(DEFAULT_RADIUS, ge=1, le=MAX_RADIUS),
+                            day: str = None, day_from: str = None, day_to: str = None, min_places: int = None,
+                            fields: str = None, with_rating: bool = False, _page: Page = Depends()):
+    # Origen y destino como lugar del nomenclator (municipio, codigo postal o campus) o como coordenadas
+    _origin = location(origin, origin_lat, origin_lon)
+    if _origin is None:
+        return respond(code=400,status="Bad Request",message="An origin place or origin_lat/origin_lon is required")
+    _destination = location(destination, destination_lat, destination_lon)
+    if day is not None and (day_from is not None or day_to is not None):
+        return respond(code=400,status="Bad Request",message="Use either day or day_from/day_to")
+    _query = {}
+    _days = {op: value for op, value in (("$gte", parseDay(day_from)), ("$lte", parseDay(day_to))) if value is not None}
+    if day is not None:
+        _query["day"] = parseDay(day)
+    elif _days:
+        _query["day"] = _days
+    if min_places is not None:
+        _query["available_places"] = {"$gte": min_places}
+    _tripList = await TripRepo.searchNear(_origin, origin_radius, _destination, destination_radius, _query,
+                                          _page.limit, _page.after, stream=_page.stream,
+                                          projection=projection('trips', fields, required=("driver_id",) if with_rating else (), sort=NEAR_SORT))
+    if _page.stream:
+        return streamResponse(_tripList, presenter('trips'))
+    _tripList, _next = page(_tripList, _page.limit, NEAR_SORT)
+    if len(_tripList)==0:
+        return respond(code=404,status="Not found",message=f"No trips found")
+    if with_rating:
+        await RatingRepo.embedRatings(_tripList)
+    return respond(code=200,status="Ok",message="Success retrieving all data", result=present('trips', _tripList), next=_next)
 
 @router.get("/trips/{id}") 
-async def get_id_trip(id:str):
-    _trip = await TripRepo.getTripById(id)
+async def get_id_trip(id:str, request: Request, fields: str = None, with_rating: bool = False, include_archived: bool = False):
+    # Peticion condicional: se compara la version sin leer ni serializar el viaje. Con with_rating no hay validadores
+    if not with_rating and conditional(request):
+        _stamp = await TripRepo.getTripStamp(id, include_archived)
+        if _stamp is not None and notModified(request, validators(id, _stamp)):
+            return notModifiedResponse(validators(id, _stamp))
+    _trip = await TripRepo.getTripById(id, projection('trips', fields, required=(("driver_id",) if with_rating else ()) + STAMP_FIELDS),
+                                       include_archived)
     if not _trip:
-        return Response(code=404,status="Not found",message=f"No trips found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving data from trip", result=_trip).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No trips found")
+    _headers = validators(id, split(_trip))
+    if with_rating:
+        await RatingRepo.embedRatings([_trip])
+        _headers = None
+    return respond(code=200,status="Ok",message="Success retrieving data from trip", result=present('trips', _trip), headers=_headers)
+
+@router.get("/trips/{id}/detail")
+async def get_trip_detail(id:str, include_archived: bool = False):
+    # Todo lo que muestra la pagina de un viaje en una sola consulta: viaje, perfil publico y valoracion del conductor y reservas
+    _detail = await TripRepo.getTripDetail(id, include_archived)
+    if not _detail:
+        return respond(code=404,status="Not found",message=f"No trips found")
+    present('trips', _detail["trip"])
+    return respond(code=200,status="Ok",message="Success retrieving data from trip", result=_detail)
 
 @router.put("/trips/")
-async def create_trip(trip: Trip):
+async def create_trip(trip: Trip, _caller: Optional[str] = Depends(authenticate)):
+    # El viaje lo publica su conductor
+    authorize(_caller, trip.driver_id)
     await TripRepo.addTrip(trip)
-    return Response(code=200,status="Ok",message="Success saving data").dict(exclude_none=True)
+    return respond(code=200,status="Ok",message="Success saving data")
 
 @router.put("/trips/{id}")
-async def update_trip(id: str, trip: Trip):
-    trip_exists = await TripRepo.tripExists(id)
-    if not trip_exists:
-        return Response(code=404,status="Not found",message=f"No trip with id {id} found").dict(exclude_none=True)
-    await TripRepo.updateTrip(id, trip)
-    return Response(code=200,status="Ok",message="Success updating data").dict(exclude_none=True)
+async def update_trip(id: str, trip: Trip, _caller: Optional[str] = Depends(authenticate)):
+    authorize(_caller, trip.driver_id)
+    await authorizeTrip(_caller, id)
+    _updated = await TripRepo.updateTrip(id, trip.dict())
+    if _updated is None:
+        return respond(code=404,status="Not found",message=f"No trip with id {id} found")
+    # available_places es la capacidad del viaje: no puede quedar por debajo de las reservas ya aceptadas
+    if not _updated:
+        return respond(code=409,status="Conflict",message="Available places below the accepted bookings")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.patch("/trips/{id}")
+async def patch_trip(id: str, trip: TripUpdate, _caller: Optional[str] = Depends(authenticate)):
+    _fields = trip.dict(exclude_none=True)
+    if len(_fields) == 0:
+        return respond(code=400,status="Bad Request",message="No fields to update")
+    authorize(_caller, _fields.get("driver_id"))
+    await authorizeTrip(_caller, id)
+    _updated = await TripRepo.updateTrip(id, _fields)
+    if _updated is None:
+        return respond(code=404,status="Not found",message=f"No trip with id {id} found")
+    # available_places es la capacidad del viaje: no puede quedar por debajo de las reservas ya aceptadas
+    if not _updated:
+        return respond(code=409,status="Conflict",message="Available places below the accepted bookings")
+    return respond(code=200,status="Ok",message="Success updating data")
 
 @router.delete("/trips/{id}")
-async def delete_trip(id:str):
-    trip_exists = await TripRepo.tripExists(id)
-    if not trip_exists:
-        return Response(code=404,status="Not found",message=f"No trip with id {id} found").dict(exclude_none=True)
-    # Borra las reservas del viaje
-    _bookingList = await BookingRepo.getBookingsByTrip(id)
-    for booking in _bookingList:
-        await BookingRepo.deleteBooking(booking["_id"])
-    # Borra el viaje
-    await TripRepo.deleteTrip(id)
-    return Response(code=200,status="Ok",message="Success deleting data").dict(exclude_none=True)
+async def delete_trip(id:str, _caller: Optional[str] = Depends(authenticate)):
+    await authorizeTrip(_caller, id)
+    # Borra el viaje y sus reservas
+    _deleted = await cascade.deleteTrip(id)
+    if not _deleted["trips"]:
+        return respond(code=404,status="Not found",message=f"No trip with id {id} found")
+    return respond(code=200,status="Ok",message="Success deleting data", result=_deleted)
 
 # USER METHODS------------------------------------------------------------------------------------------------------------------
 
 @router.get("/users/")
-async def get_all_users(substring: str = None):
-    # Si incluye un substring, debera buscar usuarios que lo incluyan en su nombre
+async def get_all_users(substring: str = None, ids: str = None, fields: str = None, _page: Page = Depends(),
+                        _caller: Optional[str] = Depends(authenticate)):
+    # Con AUTH_REQUIRED, solo usuarios identificados y sin datos de contacto: el propio usuario los ve en /users/{id}
+    _private = not config.settings.auth_required
+    # Lectura multiple (ids=a,b,c): los usuarios en el orden pedido con una sola consulta, null los que no existen
+    if ids is not None:
+        _ids = parseIds(ids)
+        if substring or not 0 < len(_ids) <= MAX_LIMIT:
+            return respond(code=400,status="Bad Request",message=f"ids takes between 1 and {MAX_LIMIT} ids and no substring")
+        _userList = await UserRepo.getUsersByIds(_ids, projection('users', fields, private=_private))
+        return respond(code=200,status="Ok",message="Success retrieving data from users", result=_userList)
+    # Si incluye un substring, debera buscar usuarios cuyo nombre o apellidos empiecen por sus palabras (por relevancia)
     if(substring):
-        _userList = await UserRepo.getUsersByName(substring)
+        _sort = USER_SEARCH_SORT
+        _userList = await UserRepo.getUsersByName(substring, _page.limit, _page.after, stream=_page.stream,
+                                                  projection=projection('users', fields, sort=_sort, private=_private))
     # Si no, devuelve todos los usuarios
     else:
-        _userList = await UserRepo.getUsers()
+        _sort = ID_SORT
+        _userList = await UserRepo.getUsers(_page.limit, _page.after, stream=_page.stream,
+                                            projection=projection('users', fields, private=_private))
+    if _page.stream:
+        return streamResponse(_userList)
+    _userList, _next = page(_userList, _page.limit, _sort)
     if len(_userList)==0:
-        return Response(code=404,status="Not found",message=f"No users found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving all data", result=_userList).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No users found")
+    return respond(code=200,status="Ok",message="Success retrieving all data", result=_userList, next=_next)
 
 @router.get("/users/{id}") 
-async def get_id_user(id:str):
-    _user = await UserRepo.getUserId(id)
+async def get_id_user(id:str, request: Request, fields: str = None, _caller: Optional[str] = Depends(authenticate)):
+    # Los datos de contacto solo para el propio usuario; la representacion sin ellos tiene su propio ETag
+    _private = isOwner(_caller, id)
+    _key = id if _private else f"{id}-public"
+    # Peticion condicional: se compara la version sin leer ni serializar el usuario
+    if conditional(request):
+        _stamp = await UserRepo.getUserStamp(id)
+        if _stamp is not None and notModified(request, validators(_key, _stamp)):
+            return notModifiedResponse(validators(_key, _stamp))
+    _user = await UserRepo.getUserId(id, projection('users', fields, required=STAMP_FIELDS, private=_private))
     if not _user:
-        return Response(code=404,status="Not found",message=f"No users found").dict(exclude_none=True)
-    return Response(code=200,status="Ok",message="Success retrieving data from user", result=_user).dict(exclude_none=True)
+        return respond(code=404,status="Not found",message=f"No users found")
+    _headers = validators(_key, split(_user))
+    return respond(code=200,status="Ok",message="Success retrieving data from user", result=_user, headers=_headers)
 
 @router.put("/users/")
 async def create_user(user: User):
     await UserRepo.addUser(user)
-    return Response(code=200,status="Ok",message="Success saving data").dict(exclude_none=True)
+    return respond(code=200,status="Ok",message="Success saving data")
 
-@router.put("/users/{id}")
+@router.put("/users/{id}", dependencies=[Depends(owner)])
 async def update_user(id: str, user: User):
-    user_exists = await UserRepo.userExists(id)
-    if not user_exists:
-        return Response(code=404,status="Not found",message=f"No user with id {id} found").dict(exclude_none=True)
-    await UserRepo.updateUser(id, user)
-    return Response(code=200,status="Ok",message="Success updating data").dict(exclude_none=True)
+    if not await UserRepo.updateUser(id, user.dict()):
+        return respond(code=404,status="Not found",message=f"No user with id {id} found")
+    return respond(code=200,status="Ok",message="Success updating data")
 
-@router.delete("/users/{id}")
-async def delete_user(id:str):
-    user_exists = await UserRepo.userExists(id)
-    if not user_exists:
-        return Response(code=404,status="Not found",message=f"No user with id {id} found").dict(exclude_none=True)
-    # Borra las reservas del usuario
-    _bookingList = await BookingRepo.getBookingsByUser(id)
-    for booking in _bookingList:
-        await BookingRepo.deleteBooking(booking["_id"])
-    # Borra las reseñas del usuario
-    _reviewList = await ReviewRepo.getReviewsByUser(id)
-    for review in _reviewList:
-        await ReviewRepo.deleteReview(booking["_id"])
-    # Borra los viajes del usuario
-    _tripList = await TripRepo.getTripsByUser(id)
-    for trip in _tripList:
-        await TripRepo.deleteTrip(trip["_id"])
-    # Borra el usuario
-    await UserRepo.deleteUser(id)
-    return Response(code=200,status="Ok",message="Success deleting data").dict(exclude_none=True)
\ No newline at end of file
+@router.patch("/users/{id}", dependencies=[Depends(owner)])
+async def patch_user(id: str, user: UserUpdate):
+    _fields = user.dict(exclude_none=True)
+    if len(_fields) == 0:
+        return respond(code=400,status="Bad Request",message="No fields to update")
+    if not await UserRepo.updateUser(id, _fields):
+        return respond(code=404,status="Not found",message=f"No user with id {id} found")
+    return respond(code=200,status="Ok",message="Success updating data")
+
+@router.delete("/users/{id}", dependencies=[Depends(owner)])
+async def delete_user(id:str, background: bool = False, _caller: Optional[str] = Depends(authenticate)):
+    # En segundo plano se responde enseguida con el id del trabajo para consultar su estado
+    if background:
+        user_exists = await UserRepo.userExists(id)
+        if not user_exists:
+            return respond(code=404,status="Not found",message=f"No user with id {id} found")
+        _job = await cascade.deleteUserInBackground(id, _caller)
+        return respond(code=202,status="Accepted",message="Deleting data in background", result={"job_id":_job})
+    # Borra el usuario, sus reservas, reseñas, mensajes, viajes y las reservas de esos viajes
+    _deleted = await cascade.deleteUser(id)
+    if not _deleted["users"]:
+        return respond(code=404,status="Not found",message=f"No user with id {id} found")
+    return respond(code=200,status="Ok",message="Success deleting data", result=_deleted)
+
+# AUTH METHODS------------------------------------------------------------------------------------------------------------------
+
+@router.post("/auth/login")
+async def post_login(credentials: Login):
+    _token = await login(credentials.email_address, credentials.password)
+    if _token is None:
+        return respond(code=401,status="Unauthorized",message="Invalid email or password")
+    return respond(code=200,status="Ok",message="Success logging in", result=_token)
+
+@router.get("/auth/me")
+async def get_me(_caller: Optional[str] = Depends(authenticate)):
+    # Usuario del token (sin consultar la base de datos)
+    if _caller is None:
+        return respond(code=401,status="Unauthorized",message="Missing bearer token",headers={"WWW-Authenticate": "Bearer"})
+    return respond(code=200,status="Ok",message="Success retrieving data", result={"user_id":_caller})
+
+# JOB METHODS-------------------------------------------------------------------------------------------------------------------
+
+@router.get("/jobs/{id}")
+async def get_id_job(id:str, _caller: Optional[str] = Depends(authenticate)):
+    _job = await JobRepo.getJobById(id)
+    if not _job:
+        return respond(code=404,status="Not found",message=f"No job with id {id} found")
+    # Solo lo ve quien lo lanzo; los anteriores a requested_by, el usuario borrado (que es quien podia lanzarlo)
+    authorize(_caller, _job.get("requested_by") or _job["target"])
+    return respond(code=200,status="Ok",message="Success retrieving data from job", result=_job)
+
+# BULK METHODS------------------------------------------------------------------------------------------------------------------
+
+@router.post("/import/{collection}", dependencies=[Depends(operator)])
+async def import_collection(collection: str, request: Request):
+    if collection not in bulk.COLLECTIONS:
+        return respond(code=404,status="Not found",message=f"No collection {collection} found")
+    # El cuerpo se procesa en streaming: nunca se tiene el fichero entero en memoria
+    _summary = await bulk.importRecords(collection, bulk.splitLines(request.stream()))
+    return respond(code=200,status="Ok",message="Success importing data", result=_summary.dict())
+
+@router.get("/export/{collection}", dependencies=[Depends(operator)])
+async def export_collection(collection: str):
+    if collection not in bulk.COLLECTIONS:
+        return respond(code=404,status="Not found",message=f"No collection {collection} found")
+    return StreamingResponse(bulk.exportRecords(collection), media_type=NDJSON_MEDIA_TYPE)
+
+# HEALTH METHODS----------------------------------------------------------------------------------------------------------------
+
+# Estado del pool de conexiones de este proceso (abiertas, en uso, esperando) por servidor
+def _pool():
+    return config.monitor.stats() if config.monitor else {}
+
+@router.get("/health/live")
+async def get_live():
+    # El proceso responde: no consulta la base de datos
+    return respond(code=200,status="Ok",message="Alive", result={"pool":_pool()})
+
+@router.get("/health/ready")
+async def get_ready():
+    # Listo si el servidor responde al ping dentro del tiempo de seleccion de servidor
+    try:
+        await config.database.command("ping")
+    except Exception as exc:
+        return respond(code=503,status="Service Unavailable",message=f"Database unavailable: {exc}", result={"pool":_pool()})
+    return respond(code=200,status="Ok",message="Ready", result={"pool":_pool()})
+
+# METRICS METHODS---------------------------------------------------------------------------------------------------------------
+
+@router.get("/metrics")
+async def get_metrics():
+    # Formato de texto de Prometheus: rutas, comandos de Mongo y pool de conexiones
+    return PlainTextResponse(metrics.render(config.monitor), media_type=metrics.CONTENT_TYPE)
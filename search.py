@@ -0,0 +1,82 @@
+import asyncio
+import re
+import sys
+import unicodedata
+from pymongo import UpdateOne
+from config import connect, database
+
+"""
+search.py: Busqueda de usuarios por nombre y apellidos con prefijos normalizados (sin tildes ni mayusculas) indexados
+"""
+
+# Los prefijos mas cortos devolverian media coleccion; los mas largos se truncan al buscar
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 15
+
+# Orden de los resultados: mejor puntuacion primero y despues por nombre normalizado; el _id deshace empates para la paginacion
+USER_SEARCH_SORT = [("score", -1), ("search_name", 1), ("_id", 1)]
+
+BATCH_SIZE = 1000
+
+class InvalidSearch(ValueError):
+    pass
+
+# normalize(text: str): minusculas y sin tildes ni diéresis ("Íñigo Muñoz" -> "inigo munoz")
+def normalize(text: str):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"[^\w]+", " ", text.lower()).strip()
+
+# words(text: str): palabras normalizadas del texto
+def words(text: str):
+    return normalize(text).split()
+
+# searchFields(name: str, last_name: str): campos auxiliares que se guardan en el documento del usuario
+# search_tokens son los prefijos de cada palabra (indice multikey), search_words las palabras completas para puntuar
+# y search_name el nombre completo normalizado para ordenar
+def searchFields(name: str, last_name: str):
+    _words = sorted(set(words(name) + words(last_name)))
+    _tokens = {word[:length] for word in _words for length in range(MIN_PREFIX_LENGTH, min(len(word), MAX_PREFIX_LENGTH) + 1)}
+    return {"search_tokens": sorted(_tokens), "search_words": _words, "search_name": normalize(f"{name} {last_name}")}
+
+# searchPipeline(text: str): etapas de agregacion que filtran por prefijos y añaden la puntuacion (score)
+# Se puntuan todas las coincidencias: el indice de search_tokens acota las que se leen y el orden por puntuacion es completo
+def searchPipeline(text: str):
+    _words = [word for word in dict.fromkeys(words(text)) if len(word) >= MIN_PREFIX_LENGTH]
+    if not _words:
+        raise InvalidSearch(f"Search text must contain a word of at least {MIN_PREFIX_LENGTH} characters")
+    # La palabra mas larga primero: es la mas selectiva y la que acota el recorrido del indice
+    _words.sort(key=len, reverse=True)
+    return [
+        {"$match": {"search_tokens": {"$all": [word[:MAX_PREFIX_LENGTH] for word in _words]}}},
+        # Cada palabra escrita completa suma un punto frente a las que solo coinciden como prefijo
+        {"$addFields": {"score": {"$add": [{"$cond": [{"$in": [word, "$search_words"]}, 1, 0]} for word in _words]}}},
+    ]
+
+# backfill(db): calcula los campos de busqueda de los usuarios guardados antes de existir el indice
+async def backfill(db=database, rebuild: bool = False):
+    users = db.get_collection('users')
+    query = {} if rebuild else {"search_tokens": {"$exists": False}}
+    _updated = 0
+    _operations = []
+    async for user in users.find(query, {"name": 1, "last_name": 1}).batch_size(BATCH_SIZE):
+        _operations.append(UpdateOne({"_id": user["_id"]}, {"$set": searchFields(user.get("name"), user.get("last_name"))}))
+        if len(_operations) >= BATCH_SIZE:
+            _updated += (await users.bulk_write(_operations, ordered=False)).modified_count
+            _operations = []
+    if _operations:
+        _updated += (await users.bulk_write(_operations, ordered=False)).modified_count
+    return _updated
+
+async def _main(argv):
+    connect()
+    if not argv or argv[0] != "backfill":
+        print("usage: python search.py backfill [--rebuild]", file=sys.stderr)
+        return 2
+    _updated = await backfill(rebuild="--rebuild" in argv)
+    print(f"users updated: {_updated}", file=sys.stderr)
+    return 0
+
+# python search.py backfill [--rebuild]: rellena search_tokens (o los recalcula todos con --rebuild)
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,42 @@
+import json
+from datetime import date, datetime
+from fastapi.responses import Response as HTTPResponse
+from metrics import setCode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+serialization.py: Serializacion en una sola pasada del sobre Response y de los documentos tal y como salen de Motor
+"""
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    # ObjectId, Decimal128, UUID...
+    return str(value)
+
+# dumps(content): codifica a JSON (orjson si esta instalado, si no la libreria estandar)
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastResponse(HTTPResponse):
+    # Respuesta JSON que se codifica una sola vez, sin pasar por pydantic ni por jsonable_encoder
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+# respond(code, status, message, result, next): construye el sobre con los mismos campos que model.Response
+def respond(code, status: str, message: str, result=None, next: str = None, headers: dict = None):
+    content = {"code": str(code), "status": status, "message": message}
+    setCode(content["code"])
+    if result is not None:
+        content["result"] = result
+    if next is not None:
+        content["next"] = next
+    return FastResponse(content, headers=headers)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import pytest
+from fastapi.testclient import TestClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cache
+import cascade
+import config
+import main
+import writebehind
+from benchmarks import mockdb
+
+"""
+tests/conftest.py: Fixtures de las pruebas: base de datos en memoria (benchmarks/mockdb.py) nueva en cada prueba, cliente HTTP
+de la aplicacion y funciones para crear usuarios y viajes por la API
+"""
+
+PREFIX = "/BlaBlaETSIINF"
+
+USER = dict(last_name="Garcia", bio="Estudiante", municipality="Boadilla del Monte", zip_code="28660")
+
+TRIP = dict(start_location="Majadahonda", departure_time="08:00", available_places=2, price=3, trip_type="daily",
+            day="2024-03-01", end_date="2024-03-30", arrival_location="Campus de Montegancedo")
+
+# run(coroutine): ejecuta una corrutina (consultas directas a la base de datos) en el event loop de la prueba
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.run_until_complete(writebehind.stop())
+    loop.close()
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(config, "client", mockdb.client())
+    # mongomock no tiene sesiones: el borrado en cascada va sin transaccion
+    monkeypatch.setattr(cascade, "_transactions", False)
+    # scrypt con el coste por defecto hace lentas las pruebas que crean usuarios
+    monkeypatch.setattr(config.settings, "auth_scrypt_n", 1024)
+    cache.configure()
+    writebehind._batchers.clear()
+    return config.database
+
+# client: sin "with" no se ejecuta el lifespan, que se conectaria a MONGODB_URL
+@pytest.fixture
+def client(db):
+    return TestClient(main.app)
+
+# user(name): crea un usuario por la API (contraseña "pw-" + name) y devuelve su id
+@pytest.fixture
+def user(client, db, run):
+    def create(name: str, **fields):
+        _user = dict(USER, name=name, email_address=f"{name}@alumnos.upm.es", password=f"pw-{name}", **fields)
+        assert client.put(f"{PREFIX}/users/", json=_user).json()["code"] == "200"
+        return run(db.users.find_one({"email_address": _user["email_address"]}))["_id"]
+    return create
+
+# trip(driver_id): crea un viaje por la API y devuelve su id
+@pytest.fixture
+def trip(client, db, run):
+    def create(driver_id: str, **fields):
+        _trip = dict(TRIP, driver_id=driver_id, **fields)
+        _before = set(run(db.trips.distinct("_id")))
+        assert client.put(f"{PREFIX}/trips/", json=_trip).json()["code"] == "200"
+        return set(run(db.trips.distinct("_id"))).difference(_before).pop()
+    return create
+
+# token(name): token de acceso del usuario creado con user(name)
+@pytest.fixture
+def token(client):
+    def login(name: str):
+        response = client.post(f"{PREFIX}/auth/login", json=dict(email_address=f"{name}@alumnos.upm.es", password=f"pw-{name}"))
+        return {"Authorization": "Bearer " + response.json()["result"]["access_token"]}
+    return login
@@ -0,0 +1,21 @@
+import main
+from admission import BULK_ROUTES, LIST_ROUTES, routeGroup
+from conftest import PREFIX
+
+"""
+tests/test_admission.py: Grupo del control de admision de cada plantilla de ruta
+"""
+
+def test_route_templates_are_classified_by_name():
+    assert routeGroup("GET", PREFIX + "/users/{user_id}/conversations/{peer_id}") == "list"
+    assert routeGroup("GET", PREFIX + "/users/{user_id}/bookings/") == "list"
+    assert routeGroup("GET", PREFIX + "/users/{user_id}/bookings/{id}") == "read"
+    assert routeGroup("GET", PREFIX + "/trips/search") == "list"
+    assert routeGroup("PATCH", PREFIX + "/trips/{id}") == "write"
+    assert routeGroup("POST", PREFIX + "/import/{collection}") == "bulk"
+    assert routeGroup("GET", "unmatched") is None
+
+def test_listed_templates_exist():
+    # Una ruta renombrada sin actualizar las listas pasaria en silencio al grupo de lecturas por id
+    templates = {route.path for route in main.app.routes}
+    assert LIST_ROUTES.union(BULK_ROUTES) <= templates
@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+import cascade
+import config
+from conftest import PREFIX, USER, TRIP
+
+"""
+tests/test_auth.py: Inicio de sesion, contraseñas derivadas y permisos de cada ruta con AUTH_REQUIRED
+"""
+
+@pytest.fixture
+def required(monkeypatch):
+    monkeypatch.setattr(config.settings, "auth_required", True)
+
+def test_login_issues_a_token_for_the_right_password(client, user, run, db):
+    ana = user("ana")
+    assert run(db.users.find_one({"_id": ana}))["password"].startswith("scrypt$")
+    response = client.post(f"{PREFIX}/auth/login", json=dict(email_address="ana@alumnos.upm.es", password="pw-ana")).json()
+    assert (response["code"], response["result"]["token_type"]) == ("200", "bearer")
+    headers = {"Authorization": "Bearer " + response["result"]["access_token"]}
+    assert client.get(f"{PREFIX}/auth/me", headers=headers).json()["result"]["user_id"] == ana
+    for email_address, password in (("ana@alumnos.upm.es", "otra"), ("nadie@alumnos.upm.es", "pw-ana")):
+        assert client.post(f"{PREFIX}/auth/login", json=dict(email_address=email_address, password=password)).json()["code"] == "401"
+
+def test_plaintext_passwords_are_rehashed_on_login(client, run, db):
+    run(db.users.insert_one(dict(USER, _id="legacy", name="old", email_address="old@alumnos.upm.es", password="plain")))
+    assert client.post(f"{PREFIX}/auth/login", json=dict(email_address="old@alumnos.upm.es", password="plain")).json()["code"] == "200"
+    assert run(db.users.find_one({"_id": "legacy"}))["password"].startswith("scrypt$")
+    assert client.post(f"{PREFIX}/auth/login", json=dict(email_address="old@alumnos.upm.es", password="plain")).json()["code"] == "200"
+
+def test_user_routes_are_only_for_that_user(client, user, token, required):
+    ana, bea = user("ana"), user("bea")
+    response = client.get(f"{PREFIX}/users/{ana}/bookings/")
+    assert (response.json()["code"], response.headers["www-authenticate"]) == ("401", "Bearer")
+    assert client.get(f"{PREFIX}/users/{ana}").json()["code"] == "401"
+    assert client.get(f"{PREFIX}/users/").json()["code"] == "401"
+    assert client.get(f"{PREFIX}/users/{ana}/bookings/", headers=token("ana")).json()["code"] == "404"
+    assert client.get(f"{PREFIX}/users/{bea}/bookings/", headers=token("ana")).json()["code"] == "403"
+    assert client.patch(f"{PREFIX}/users/{bea}", json=dict(bio="otra"), headers=token("ana")).json()["code"] == "403"
+
+def test_email_address_is_only_visible_to_its_owner(client, user, token, required):
+    ana, bea = user("ana"), user("bea")
+    own = client.get(f"{PREFIX}/users/{ana}", headers=token("ana"))
+    other = client.get(f"{PREFIX}/users/{bea}", headers=token("ana"))
+    assert own.json()["result"]["email_address"] == "ana@alumnos.upm.es"
+    assert "email_address" not in other.json()["result"]
+    # Cada representacion tiene su propio ETag
+    assert own.headers["etag"] != client.get(f"{PREFIX}/users/{ana}", headers=token("bea")).headers["etag"]
+    assert client.get(f"{PREFIX}/users/{bea}", params=dict(fields="email_address"), headers=token("ana")).json()["code"] == "400"
+    assert all("email_address" not in item for item in client.get(f"{PREFIX}/users/", headers=token("ana")).json()["result"])
+
+def test_trips_are_changed_only_by_their_driver(client, user, token, run, db, required):
+    ana, bea = user("ana"), user("bea")
+    assert client.put(f"{PREFIX}/trips/", json=dict(TRIP, driver_id=bea), headers=token("ana")).json()["code"] == "403"
+    assert client.put(f"{PREFIX}/trips/", json=dict(TRIP, driver_id=ana), headers=token("ana")).json()["code"] == "200"
+    id = run(db.trips.find_one({}))["_id"]
+    assert client.patch(f"{PREFIX}/trips/{id}", json=dict(price=5), headers=token("bea")).json()["code"] == "403"
+    assert client.delete(f"{PREFIX}/trips/{id}", headers=token("bea")).json()["code"] == "403"
+    assert client.patch(f"{PREFIX}/trips/{id}", json=dict(price=5), headers=token("ana")).json()["code"] == "200"
+
+def test_reviews_are_written_by_their_author_about_the_path_driver(client, user, token, run, db, required):
+    ana, bea, cris = user("ana"), user("bea"), user("cris")
+    review = dict(driver_id=ana, reviewer_id=bea, rating=4, comment="Puntual", date="2024-03-02")
+    assert client.put(f"{PREFIX}/users/{ana}/reviews/", json=review, headers=token("ana")).json()["code"] == "403"
+    assert client.put(f"{PREFIX}/users/{ana}/reviews/", json=review, headers=token("bea")).json()["code"] == "200"
+    id = run(db.reviews.find_one({}))["_id"]
+    assert client.delete(f"{PREFIX}/users/{ana}/reviews/{id}", headers=token("ana")).json()["code"] == "403"
+    # La reseña es sobre ana: por la ruta de otro conductor no existe
+    assert client.patch(f"{PREFIX}/users/{cris}/reviews/{id}", json=dict(rating=1), headers=token("bea")).json()["code"] == "404"
+    assert client.delete(f"{PREFIX}/users/{cris}/reviews/{id}", headers=token("bea")).json()["code"] == "404"
+    assert run(db.reviews.find_one({"_id": id}))["rating"] == 4
+    assert client.delete(f"{PREFIX}/users/{ana}/reviews/{id}", headers=token("bea")).json()["code"] == "200"
+
+def test_bookings_and_messages_are_scoped_to_the_path_user(client, user, trip, token, run, db, monkeypatch):
+    ana, bea = user("ana"), user("bea")
+    id = trip(ana)
+    client.put(f"{PREFIX}/users/{bea}/bookings/", json=dict(user_id=bea, trip_id=id, status="pending"))
+    client.put(f"{PREFIX}/users/{bea}/messages/", json=dict(sender_id=bea, recipient_id=ana, content="Hola", date="2024-03-01"))
+    booking, message = run(db.bookings.find_one({}))["_id"], run(db.messages.find_one({}))["_id"]
+    monkeypatch.setattr(config.settings, "auth_required", True)
+    # Una reserva de bea no se borra por la ruta de ana, aunque ana sea la conductora del viaje
+    assert client.delete(f"{PREFIX}/users/{ana}/bookings/{booking}", headers=token("ana")).json()["code"] == "404"
+    assert client.delete(f"{PREFIX}/users/{ana}/messages/{message}", headers=token("ana")).json()["code"] == "403"
+    assert client.delete(f"{PREFIX}/users/{bea}/bookings/{booking}", headers=token("bea")).json()["code"] == "200"
+    assert run(db.bookings.count_documents({})) == 0
+
+def test_bulk_routes_need_the_operator_token(client, user, token, monkeypatch, required):
+    user("ana")
+    assert client.get(f"{PREFIX}/export/users", headers=token("ana")).json()["code"] == "403"
+    monkeypatch.setattr(config.settings, "auth_operator_token", "operador")
+    assert client.get(f"{PREFIX}/export/users").json()["code"] == "401"
+    assert client.get(f"{PREFIX}/export/users", headers=token("ana")).json()["code"] == "403"
+    response = client.get(f"{PREFIX}/export/users", headers={"Authorization": "Bearer operador"})
+    assert len(response.text.splitlines()) == 1
+
+def test_jobs_are_visible_to_who_started_them(client, user, token, run, required):
+    ana, bea = user("ana"), user("bea")
+    headers = token("bea")
+    job_id = run(cascade.deleteUserInBackground(bea, bea))
+    run(asyncio.gather(*cascade._jobs))
+    assert client.get(f"{PREFIX}/jobs/{job_id}", headers=token("ana")).json()["code"] == "403"
+    assert client.get(f"{PREFIX}/jobs/{job_id}").json()["code"] == "401"
+    # El token sigue siendo valido hasta caducar aunque el usuario ya no exista
+    assert client.get(f"{PREFIX}/jobs/{job_id}", headers=headers).json()["code"] == "200"
@@ -0,0 +1,77 @@
+from conftest import PREFIX, TRIP
+
+"""
+tests/test_bookings.py: Plazas de los viajes: reservas aceptadas, cambios de estado, capacidad al modificar el viaje y reintentos
+"""
+
+def test_accepted_bookings_take_seats_until_full(client, user, trip, run, db):
+    driver, ana, bea, cris = user("driver"), user("ana"), user("bea"), user("cris")
+    id = trip(driver, available_places=2)
+    for passenger in (ana, bea):
+        response = client.put(f"{PREFIX}/users/{passenger}/bookings/", json=dict(user_id=passenger, trip_id=id, status="accepted"))
+        assert response.json()["code"] == "200"
+    response = client.put(f"{PREFIX}/users/{cris}/bookings/", json=dict(user_id=cris, trip_id=id, status="accepted"))
+    assert response.json() == {"code": "409", "status": "Conflict", "message": "No places available"}
+    _trip = run(db.trips.find_one({"_id": id}))
+    assert _trip["available_places"] == 0
+    assert len(_trip["accepted_bookings"]) == 2
+    assert run(db.bookings.count_documents({"trip_id": id})) == 2
+
+def test_status_changes_release_and_take_the_seat(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver, available_places=1)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="pending"))
+    booking = run(db.bookings.find_one({}))["_id"]
+    assert client.patch(f"{PREFIX}/users/{ana}/bookings/{booking}", json=dict(status="accepted")).json()["code"] == "200"
+    assert run(db.trips.find_one({"_id": id}))["available_places"] == 0
+    # Aceptarla otra vez no ocupa una segunda plaza
+    assert client.patch(f"{PREFIX}/users/{ana}/bookings/{booking}", json=dict(status="accepted")).json()["code"] == "200"
+    assert client.patch(f"{PREFIX}/users/{ana}/bookings/{booking}", json=dict(status="denied")).json()["code"] == "200"
+    assert run(db.trips.find_one({"_id": id}))["available_places"] == 1
+    assert client.delete(f"{PREFIX}/users/{ana}/bookings/{booking}").json()["code"] == "200"
+    assert run(db.trips.find_one({"_id": id}))["available_places"] == 1
+
+def test_deleting_an_accepted_booking_frees_its_seat(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver, available_places=1)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="accepted"))
+    booking = run(db.bookings.find_one({}))["_id"]
+    assert client.delete(f"{PREFIX}/users/{ana}/bookings/{booking}").json()["code"] == "200"
+    _trip = run(db.trips.find_one({"_id": id}))
+    assert _trip["available_places"] == 1
+    assert _trip["accepted_bookings"] == []
+
+def test_trip_update_treats_available_places_as_capacity(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver, available_places=2)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="accepted"))
+    assert client.patch(f"{PREFIX}/trips/{id}", json=dict(available_places=3)).json()["code"] == "200"
+    assert run(db.trips.find_one({"_id": id}))["available_places"] == 2
+    response = client.patch(f"{PREFIX}/trips/{id}", json=dict(available_places=0))
+    assert response.json()["code"] == "409"
+    response = client.put(f"{PREFIX}/trips/{id}", json=dict(TRIP, driver_id=driver, available_places=1, price=5))
+    assert response.json()["code"] == "200"
+    _trip = run(db.trips.find_one({"_id": id}))
+    assert (_trip["available_places"], _trip["price"]) == (0, 5)
+    assert client.patch(f"{PREFIX}/trips/missing", json=dict(available_places=1)).json()["code"] == "404"
+
+def test_booking_contention_is_a_409_with_retry_after(client, user, trip, run, db, monkeypatch):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver, available_places=2)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="pending"))
+    booking = run(db.bookings.find_one({}))["_id"]
+    collection = type(db.bookings)
+    update_one = collection.update_one
+
+    # Otra peticion cambia el estado de la reserva entre la lectura y la escritura en todos los intentos
+    async def changed(self, filter, *args, **kwargs):
+        if self.name == "bookings" and "status" in filter:
+            return await update_one(self, {"_id": None}, *args, **kwargs)
+        return await update_one(self, filter, *args, **kwargs)
+    monkeypatch.setattr(collection, "update_one", changed)
+
+    response = client.patch(f"{PREFIX}/users/{ana}/bookings/{booking}", json=dict(status="accepted"))
+    assert response.json()["code"] == "409"
+    assert response.headers["retry-after"] == "1"
+    # Las plazas reservadas en cada intento se han devuelto
+    assert run(db.trips.find_one({"_id": id}))["available_places"] == 2
@@ -0,0 +1,60 @@
+import json
+import cache
+import config
+from benchmarks import mockdb
+from conftest import PREFIX, USER, TRIP
+
+"""
+tests/test_bulk.py: Importacion y exportacion masivas en NDJSON: ida y vuelta entre bases de datos, errores por linea,
+reservas repetidas y cache de los ids importados
+"""
+
+def _ndjson(*records):
+    return "\n".join(json.dumps(record) for record in records)
+
+def test_export_then_import_keeps_ids_and_seats(client, user, trip, run, db, monkeypatch):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver, available_places=3)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="accepted"))
+    _exported = {collection: client.get(f"{PREFIX}/export/{collection}").text for collection in ("users", "trips", "bookings")}
+    assert "password" not in _exported["users"]
+    # Los viajes salen con todas sus plazas; la reserva aceptada la vuelve a ocupar al importarla
+    assert json.loads(_exported["trips"])["available_places"] == 3
+
+    monkeypatch.setattr(config, "client", mockdb.client())
+    cache.configure()
+    for collection in ("users", "trips", "bookings"):
+        result = client.post(f"{PREFIX}/import/{collection}", content=_exported[collection]).json()["result"]
+        assert result == {"inserted": len(_exported[collection].splitlines()), "failed": 0, "errors": []}
+    _trip = run(db.trips.find_one({"_id": id}))
+    assert (_trip["available_places"], len(_trip["accepted_bookings"])) == (2, 1)
+    assert run(db.users.find_one({"_id": ana}))["password"] is None
+    # Sin contraseña no se puede iniciar sesion hasta fijarla
+    response = client.post(f"{PREFIX}/auth/login", json=dict(email_address="ana@alumnos.upm.es", password="")).json()
+    assert response["code"] == "401"
+
+def test_import_reports_errors_by_line(client, db, run):
+    _lines = _ndjson(dict(USER, _id="u1", name="ana", email_address="ana@alumnos.upm.es", password="secreto"),
+                     {"name": "sin campos"}) + "\nno es json\n" + _ndjson(dict(USER, _id="u1", name="otra", email_address="b@x.es"))
+    result = client.post(f"{PREFIX}/import/users", content=_lines).json()["result"]
+    assert (result["inserted"], result["failed"]) == (1, 3)
+    assert [error["line"] for error in result["errors"]] == [2, 3, 4]
+    # La contraseña se guarda derivada, como al crear el usuario por la API
+    assert run(db.users.find_one({"_id": "u1"}))["password"].startswith("scrypt$")
+
+def test_imported_ids_are_not_served_stale_from_the_cache(client, db):
+    assert client.get(f"{PREFIX}/users/u1").json()["code"] == "404"
+    client.post(f"{PREFIX}/import/users", content=_ndjson(dict(USER, _id="u1", name="ana", email_address="ana@alumnos.upm.es")))
+    assert client.get(f"{PREFIX}/users/u1").json()["code"] == "200"
+    assert client.get(f"{PREFIX}/trips/t1").json()["code"] == "404"
+    client.post(f"{PREFIX}/import/trips", content=_ndjson(dict(TRIP, _id="t1", driver_id="u1")))
+    assert client.get(f"{PREFIX}/trips/t1").json()["code"] == "200"
+
+def test_reimported_accepted_booking_is_a_duplicate(client, db, run):
+    client.post(f"{PREFIX}/import/users", content=_ndjson(dict(USER, _id="u1", name="ana", email_address="ana@alumnos.upm.es")))
+    client.post(f"{PREFIX}/import/trips", content=_ndjson(dict(TRIP, _id="t1", driver_id="u1", available_places=1)))
+    booking = dict(_id="b1", user_id="u1", trip_id="t1", status="accepted")
+    assert client.post(f"{PREFIX}/import/bookings", content=_ndjson(booking)).json()["result"]["inserted"] == 1
+    result = client.post(f"{PREFIX}/import/bookings", content=_ndjson(booking, dict(booking, _id="b2"))).json()["result"]
+    assert result["errors"] == [{"line": 1, "error": "Duplicate booking b1"}, {"line": 2, "error": "No places available"}]
+    assert run(db.trips.find_one({"_id": "t1"}))["available_places"] == 0
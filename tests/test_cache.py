@@ -0,0 +1,82 @@
+import asyncio
+import json
+import cache
+from conftest import PREFIX
+
+"""
+tests/test_cache.py: Cache de usuarios y viajes: invalidacion avisada a los demas workers y reconexion del bus de Redis
+"""
+
+class _PubSub():
+    # Suscripcion falsa: la primera se corta despues de un aviso; las siguientes reciben uno y se quedan esperando
+    def __init__(self, client):
+        self.client = client
+
+    async def subscribe(self, channel):
+        self.client.subscribes += 1
+
+    async def listen(self):
+        self.client.listens += 1
+        yield {"type": "message", "data": json.dumps({"origin": "other", "cache": "users", "keys": [f"u{self.client.listens}"]})}
+        if self.client.listens == 1:
+            raise ConnectionError("connection reset")
+        await asyncio.sleep(3600)
+
+    async def close(self):
+        pass
+
+class _Client():
+    def __init__(self):
+        self.subscribes = self.listens = 0
+        self.published = []
+
+    def pubsub(self):
+        return _PubSub(self)
+
+    async def publish(self, channel, message):
+        self.published.append(json.loads(message))
+
+    async def close(self):
+        pass
+
+class _Redis():
+    @staticmethod
+    def from_url(url):
+        return _Client()
+
+def test_deleting_a_user_invalidates_their_trips_on_every_worker(client, user, trip, monkeypatch):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="pending"))
+    assert client.get(f"{PREFIX}/trips/{id}").json()["code"] == "200"
+    _published = []
+
+    async def publish(name, keys):
+        _published.append((name, keys))
+    monkeypatch.setattr(cache.bus, "publish", publish)
+    client.delete(f"{PREFIX}/users/{driver}")
+    assert ("trips", [id]) in _published and ("users", [driver]) in _published
+    assert client.get(f"{PREFIX}/trips/{id}").json()["code"] == "404"
+
+def test_redis_bus_reconnects_and_clears_the_local_caches(run, monkeypatch):
+    monkeypatch.setattr(cache, "redis", _Redis)
+    monkeypatch.setattr(cache, "RECONNECT_MIN_SECONDS", 0.01)
+    monkeypatch.setattr(cache, "bus", cache.RedisBus("redis://localhost"))
+    cache.configure(100, 60)
+
+    async def reconnect():
+        async def load(key):
+            return {"_id": key}
+        for key in ("u1", "u2", "other"):
+            await cache.get("users", key, load)
+        await cache.bus.start(cache._discard, cache._reset)
+        await asyncio.sleep(0.1)
+        _client = cache.bus._client
+        await cache.invalidate("trips", "t1")
+        await cache.stop()
+        return _client
+    _client = run(reconnect())
+    # Se vuelve a suscribir tras el corte y vacia la cache: los avisos perdidos mientras tanto no llegaran
+    assert (_client.subscribes, _client.listens) == (2, 2)
+    assert len(cache.caches["users"]) == 0
+    assert _client.published[0]["keys"] == ["t1"]
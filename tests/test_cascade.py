@@ -0,0 +1,53 @@
+import asyncio
+import cascade
+from conftest import PREFIX
+
+"""
+tests/test_cascade.py: Borrado en cascada de usuarios y viajes, en la peticion y como trabajo en segundo plano
+"""
+
+def test_deleting_a_user_removes_what_depends_on_them(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="pending"))
+    client.put(f"{PREFIX}/users/{driver}/reviews/", json=dict(driver_id=driver, reviewer_id=ana, rating=5, comment="Puntual", date="2024-03-02"))
+    client.put(f"{PREFIX}/users/{ana}/messages/", json=dict(sender_id=ana, recipient_id=driver, content="Hola", date="2024-03-01"))
+    assert run(db.driver_stats.find_one({"_id": driver}))["count"] == 1
+    response = client.delete(f"{PREFIX}/users/{ana}").json()
+    assert response["code"] == "200"
+    for collection, field in (("bookings", "user_id"), ("reviews", "reviewer_id"), ("messages", "sender_id"), ("inbox", "peer_id")):
+        assert run(db.get_collection(collection).count_documents({field: ana})) == 0
+    assert run(db.users.count_documents({"_id": ana})) == 0
+    # Las estadisticas del conductor valorado se recalculan sin la reseña
+    assert run(db.driver_stats.find_one({"_id": driver})) is None
+    assert run(db.trips.count_documents({"_id": id})) == 1
+
+def test_deleting_a_driver_removes_their_trips_and_bookings(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver)
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="pending"))
+    # Leido antes del borrado: queda en la cache y el borrado debe invalidarlo
+    assert client.get(f"{PREFIX}/trips/{id}").json()["code"] == "200"
+    assert client.delete(f"{PREFIX}/users/{driver}").json()["code"] == "200"
+    assert run(db.trips.count_documents({})) == 0
+    assert run(db.bookings.count_documents({})) == 0
+    assert client.get(f"{PREFIX}/trips/{id}").json()["code"] == "404"
+    assert client.get(f"{PREFIX}/users/{ana}").json()["code"] == "200"
+
+def test_deleting_a_trip_removes_its_bookings(client, user, trip, run, db):
+    driver, ana = user("driver"), user("ana")
+    id, other = trip(driver), trip(driver, day="2024-03-02")
+    for _trip in (id, other):
+        client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=_trip, status="pending"))
+    assert client.delete(f"{PREFIX}/trips/{id}").json()["code"] == "200"
+    assert run(db.bookings.distinct("trip_id")) == [other]
+    assert client.delete(f"{PREFIX}/trips/{id}").json()["code"] == "404"
+
+def test_background_deletion_records_the_job(client, user, run, db):
+    ana = user("ana")
+    job_id = run(cascade.deleteUserInBackground(ana, ana))
+    run(asyncio.gather(*cascade._jobs))
+    job = client.get(f"{PREFIX}/jobs/{job_id}").json()["result"]
+    assert (job["status"], job["target"], job["requested_by"]) == ("done", ana, ana)
+    assert job["result"]["users"] == 1
+    assert run(db.users.count_documents({})) == 0
@@ -0,0 +1,41 @@
+from datetime import datetime
+from dates import migrate
+from conftest import PREFIX
+
+"""
+tests/test_dates.py: Fechas guardadas como fecha: formatos de entrada, filtros por rango y migracion de los textos antiguos
+"""
+
+def test_trips_are_stored_as_dates_and_searched_by_day(client, user, trip, run, db):
+    driver = user("driver")
+    for day, departure in (("2024-03-01", "08:00"), ("02/03/2024", "07:30"), ("2024-03-01", "09:15")):
+        trip(driver, day=day, departure_time=departure)
+    _trip = run(db.trips.find_one({"departure_time": datetime(1970, 1, 1, 7, 30)}))
+    assert _trip["day"] == datetime(2024, 3, 2)
+    query = dict(start_location="Majadahonda", arrival_location="Campus de Montegancedo")
+    result = client.get(f"{PREFIX}/trips/search", params=dict(query, day="2024-03-01")).json()["result"]
+    assert [(item["day"], item["departure_time"]) for item in result] == [("2024-03-01", "08:00"), ("2024-03-01", "09:15")]
+    result = client.get(f"{PREFIX}/trips/search", params=dict(query, day="2024-03-01", departure_from="08:30")).json()["result"]
+    assert [item["departure_time"] for item in result] == ["09:15"]
+    assert client.get(f"{PREFIX}/trips/search", params=dict(day="garbage")).json()["code"] == "400"
+
+def test_messages_are_filtered_by_date(client, user):
+    ana, bea = user("ana"), user("bea")
+    for content, date in (("m0", "2024-03-03T10:00:00"), ("m1", "2024-03-01T09:00:00+01:00"), ("m2", "02/03/2024 12:00")):
+        client.put(f"{PREFIX}/users/{ana}/messages/", json=dict(sender_id=ana, recipient_id=bea, content=content, date=date))
+    result = client.get(f"{PREFIX}/users/{ana}/messages/").json()["result"]
+    assert [message["content"] for message in result] == ["m1", "m2", "m0"]
+    result = client.get(f"{PREFIX}/users/{ana}/messages/", params=dict(since="2024-03-02")).json()["result"]
+    assert [(message["content"], message["date"]) for message in result] == [("m2", "2024-03-02T12:00:00"), ("m0", "2024-03-03T10:00:00")]
+
+def test_migration_converts_text_dates_and_resumes(run, db):
+    _old = [dict(_id=f"old{i}", day=f"2024-04-0{i + 1}", end_date="2024-05-01", departure_time="08:00") for i in range(5)]
+    run(db.trips.insert_many(_old + [dict(_id="wrong", day="nope", end_date="2024-05-01", departure_time="08:00")]))
+    assert run(migrate("trips", batch_size=2)) == {"converted": 5, "invalid": 1}
+    assert run(db.trips.find_one({"_id": "old3"})) == {"_id": "old3", "day": datetime(2024, 4, 4), "end_date": datetime(2024, 5, 1),
+                                                       "departure_time": datetime(1970, 1, 1, 8, 0)}
+    # El documento erroneo se queda como estaba y la siguiente ejecucion continua desde el ultimo id procesado
+    assert run(db.trips.find_one({"_id": "wrong"}))["day"] == "nope"
+    assert run(db.migrations.find_one({"_id": "dates.trips"}))["last_id"] == "wrong"
+    assert run(migrate("trips", batch_size=2)) == {"converted": 0, "invalid": 0}
+    assert run(migrate("trips", restart=True)) == {"converted": 0, "invalid": 1}
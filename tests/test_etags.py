@@ -0,0 +1,58 @@
+import cache
+from conftest import PREFIX
+
+"""
+tests/test_etags.py: Validadores de cache HTTP (ETag y Last-Modified) y peticiones condicionales de viajes y usuarios
+"""
+
+def test_trip_etag_changes_with_every_write(client, user, trip):
+    driver, ana = user("driver"), user("ana")
+    id = trip(driver)
+    response = client.get(f"{PREFIX}/trips/{id}")
+    etag, modified = response.headers["etag"], response.headers["last-modified"]
+    assert etag == f'"{id}-1"'
+    # Los campos de la version no salen en el cuerpo
+    assert "version" not in response.json()["result"] and "updated_at" not in response.json()["result"]
+    unchanged = client.get(f"{PREFIX}/trips/{id}", headers={"If-None-Match": etag})
+    assert (unchanged.status_code, unchanged.content, unchanged.headers["etag"]) == (304, b"", etag)
+    assert client.get(f"{PREFIX}/trips/{id}", headers={"If-None-Match": f'W/{etag}, "other"'}).status_code == 304
+    assert client.get(f"{PREFIX}/trips/{id}", headers={"If-Modified-Since": modified}).status_code == 304
+    client.patch(f"{PREFIX}/trips/{id}", json={"price": 4})
+    changed = client.get(f"{PREFIX}/trips/{id}", headers={"If-None-Match": etag})
+    assert (changed.status_code, changed.headers["etag"], changed.json()["result"]["price"]) == (200, f'"{id}-2"', 4)
+    # Reservar una plaza tambien es una escritura del viaje
+    client.put(f"{PREFIX}/users/{ana}/bookings/", json=dict(user_id=ana, trip_id=id, status="accepted"))
+    assert client.get(f"{PREFIX}/trips/{id}").headers["etag"] == f'"{id}-3"'
+
+def test_conditional_read_without_cache(client, user, trip):
+    id = trip(user("driver"))
+    etag = client.get(f"{PREFIX}/trips/{id}").headers["etag"]
+    cache.configure(0)
+    assert client.get(f"{PREFIX}/trips/{id}", headers={"If-None-Match": etag}).status_code == 304
+
+def test_trip_list_etag_follows_the_collection_version(client, user, trip):
+    driver = user("driver")
+    trip(driver)
+    etag = client.get(f"{PREFIX}/trips/").headers["etag"]
+    assert client.get(f"{PREFIX}/trips/", headers={"If-None-Match": etag}).status_code == 304
+    trip(driver, day="2024-03-02")
+    response = client.get(f"{PREFIX}/trips/", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["etag"] != etag
+    assert len(response.json()["result"]) == 2
+    # Borrar al conductor cambia el listado aunque no pase por las rutas de viajes
+    etag = response.headers["etag"]
+    client.delete(f"{PREFIX}/users/{driver}")
+    assert client.get(f"{PREFIX}/trips/", headers={"If-None-Match": etag}).status_code == 200
+
+def test_user_etag(client, user):
+    ana = user("ana")
+    response = client.get(f"{PREFIX}/users/{ana}")
+    etag = response.headers["etag"]
+    assert "password" not in response.json()["result"]
+    assert client.get(f"{PREFIX}/users/{ana}", headers={"If-None-Match": etag}).status_code == 304
+    client.patch(f"{PREFIX}/users/{ana}", json={"bio": "Conduce los lunes"})
+    assert client.get(f"{PREFIX}/users/{ana}", headers={"If-None-Match": etag}).status_code == 200
+
+def test_missing_trip_is_not_a_304(client, db):
+    response = client.get(f"{PREFIX}/trips/missing", headers={"If-None-Match": "*"})
+    assert response.status_code == 200 and response.json()["code"] == "404"
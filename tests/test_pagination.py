@@ -0,0 +1,32 @@
+import json
+from conftest import PREFIX
+
+"""
+tests/test_pagination.py: Paginacion por cursor (limit y after) y respuestas en streaming NDJSON de los listados
+"""
+
+def test_pages_cover_every_user_once_in_order(client, user):
+    ids = {user(f"ana{i}") for i in range(7)}
+    _seen, after = [], None
+    while True:
+        response = client.get(f"{PREFIX}/users/", params=dict(limit=3, **({"after": after} if after else {}))).json()
+        assert len(response["result"]) <= 3
+        _seen.extend(item["_id"] for item in response["result"])
+        after = response.get("next")
+        if not after:
+            break
+    assert _seen == sorted(ids)
+
+def test_invalid_token_is_a_bad_request(client, user):
+    user("ana")
+    assert client.get(f"{PREFIX}/users/", params=dict(after="zzz")).json() == {
+        "code": "400", "status": "Bad Request", "message": "Invalid pagination token zzz"}
+
+def test_stream_returns_one_document_per_line(client, user):
+    ids = {user(f"ana{i}") for i in range(4)}
+    response = client.get(f"{PREFIX}/users/", params=dict(stream="true"))
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert {json.loads(line)["_id"] for line in response.text.splitlines()} == ids
+
+def test_empty_list_is_not_found(client, db):
+    assert client.get(f"{PREFIX}/trips/").json()["code"] == "404"
@@ -0,0 +1,26 @@
+from search import searchFields
+from conftest import PREFIX, USER
+
+"""
+tests/test_search.py: Busqueda de usuarios por prefijos de nombre y apellidos
+"""
+
+def test_every_prefix_match_is_ranked_and_paginated(client, run, db):
+    # Mas coincidencias que el antiguo tope de candidatos (1000): todas salen y las exactas ("Mar") van primero
+    _names = ["Maria" if i % 7 else "Mar" for i in range(1300)]
+    run(db.users.insert_many([dict(USER, _id=f"u{i:04}", name=name, email_address=f"u{i}@alumnos.upm.es", **searchFields(name, USER["last_name"]))
+                              for i, name in enumerate(_names)]))
+    _seen, after = [], None
+    while True:
+        response = client.get(f"{PREFIX}/users/", params=dict(substring="mar", limit=500, **({"after": after} if after else {}))).json()
+        _seen.extend(response["result"])
+        after = response.get("next")
+        if not after:
+            break
+    assert len({item["_id"] for item in _seen}) == 1300
+    assert [item["name"] for item in _seen[:_names.count("Mar")]] == ["Mar"] * _names.count("Mar")
+
+def test_search_ignores_accents_and_case(client, user):
+    ana = user("Ángela", last_name="Núñez")
+    result = client.get(f"{PREFIX}/users/", params=dict(substring="angela nun")).json()["result"]
+    assert [item["_id"] for item in result] == [ana]
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from pymongo.errors import DuplicateKeyError
+import config
+import writebehind
+from conftest import PREFIX
+
+"""
+tests/test_writebehind.py: Inserciones por lotes: agrupacion, errores por documento, actualizacion una vez por lote,
+cola acotada y vaciado al cerrar
+"""
+
+@pytest.fixture
+def batching(monkeypatch):
+    monkeypatch.setattr(config.settings, "write_batch_enabled", True)
+    monkeypatch.setattr(config.settings, "write_batch_linger_ms", 20)
+    monkeypatch.setattr(config.settings, "write_batch_max_size", 16)
+
+def test_concurrent_inserts_share_batches_and_one_apply_each(run, db, batching):
+    _batches = []
+
+    async def apply(documents):
+        _batches.append(len(documents))
+
+    async def insert():
+        await asyncio.gather(*[writebehind.insertOne("messages", dict(_id=f"m{i}"), apply) for i in range(40)])
+    run(insert())
+    assert run(db.messages.count_documents({})) == 40
+    assert _batches == [16, 16, 8]
+
+def test_a_failed_document_only_fails_its_caller(run, db, batching):
+    run(db.messages.insert_one(dict(_id="taken")))
+
+    async def insert():
+        return await asyncio.gather(*[writebehind.insertOne("messages", dict(_id=id)) for id in ("a", "taken", "b")],
+                                    return_exceptions=True)
+    results = run(insert())
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], DuplicateKeyError)
+    assert run(db.messages.count_documents({})) == 3
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_apply_failure_does_not_fail_stored_documents(run, db, batching, monkeypatch, enabled):
+    # Un error devuelto haria que el cliente reintentase y duplicase el documento ya guardado
+    monkeypatch.setattr(config.settings, "write_batch_enabled", enabled)
+    _calls = []
+
+    async def apply(documents):
+        _calls.append(len(documents))
+        raise RuntimeError("inbox unavailable")
+
+    async def insert():
+        return await asyncio.gather(*[writebehind.insertOne("messages", dict(_id=id), apply) for id in ("a", "b")],
+                                    return_exceptions=True)
+    assert run(insert()) == [None, None]
+    assert run(db.messages.count_documents({})) == 2
+    assert _calls == ([2] if enabled else [1, 1])
+
+def test_full_queue_waits_and_close_writes_everything(run, db, batching, monkeypatch):
+    monkeypatch.setattr(config.settings, "write_batch_queue_size", 2)
+    monkeypatch.setattr(config.settings, "write_batch_max_size", 2)
+
+    async def insert():
+        tasks = [asyncio.ensure_future(writebehind.insertOne("reviews", dict(_id=f"r{i}"))) for i in range(7)]
+        await asyncio.sleep(0)
+        assert writebehind._batchers["reviews"]._queue.qsize() == 2
+        # stop() vuelve cuando se ha escrito lo aceptado, tambien lo que esperaba sitio en la cola
+        await writebehind.stop()
+        _written = await db.reviews.count_documents({})
+        await asyncio.gather(*tasks)
+        return _written
+    assert run(insert()) == 7
+
+def test_messages_and_inbox_through_the_api(client, user, run, db, batching):
+    ana, bea = user("ana"), user("bea")
+    for i in range(3):
+        response = client.put(f"{PREFIX}/users/{ana}/messages/", json=dict(sender_id=ana, recipient_id=bea, content=f"m{i}", date="2024-03-01"))
+        assert response.json()["code"] == "200"
+    assert run(db.messages.count_documents({"sender_id": ana})) == 3
+    assert run(db.inbox.find_one({"user_id": bea, "peer_id": ana}))["unread"] == 3
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from config import database, settings
+from metrics import WRITE_ACK_WAIT, WRITE_BATCH_SIZE, WRITE_QUEUE_DEPTH, operation
+
+"""
+writebehind.py: Inserciones por lotes (WRITE_BATCH_ENABLED): las que llegan a la vez a una coleccion esperan unos milisegundos en
+una cola acotada y se escriben juntas en un insert_many sin orden, seguido de una sola actualizacion de lo que dependa de ellas
+(bandejas de entrada, estadisticas de valoracion); cada peticion sigue esperando a que se guarde su documento
+"""
+
+logger = logging.getLogger(__name__)
+
+class Batcher():
+    # Cola de inserciones de una coleccion y tarea que la vacia por lotes. Un lote sale al llegar a max_size documentos o
+    # linger segundos despues de su primer documento; mientras se escribe, el siguiente se va llenando. La tarea termina
+    # al quedar la cola vacia y la siguiente insercion la vuelve a lanzar
+    def __init__(self, collection: str, max_size: int, linger: float, queue_size: int):
+        self.collection, self.max_size, self.linger = collection, max(1, max_size), linger
+        self.loop = asyncio.get_running_loop()
+        self.closed = False
+        self._queue = asyncio.Queue(max(1, queue_size))
+        self._task = None
+        # Inserciones aceptadas que aun no tienen respuesta, encoladas o esperando sitio en la cola
+        self._unacked = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    # insert(document: dict, apply): encola el documento y espera a que su lote se escriba y se aplique; lanza el error de su
+    # documento si no se guarda. apply(documents) se llama una vez por lote con todos los documentos insertados que la indicaron
+    async def insert(self, document: dict, apply=None):
+        if self.closed:
+            await _insertOne(self.collection, document, apply)
+            return
+        start = time.perf_counter()
+        future = self.loop.create_future()
+        self._unacked += 1
+        self._drained.clear()
+        try:
+            # Con la cola llena se espera aqui a que haya sitio: la peticion no sigue hasta poder encolar
+            await self._queue.put((document, future, apply))
+        except BaseException:
+            self._acked(1)
+            raise
+        WRITE_QUEUE_DEPTH.inc(self.collection)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            # Si la peticion se cancela, el documento se escribe igualmente con su lote
+            await asyncio.shield(future)
+        finally:
+            WRITE_ACK_WAIT.observe(time.perf_counter() - start, self.collection)
+
+    def _acked(self, count: int):
+        self._unacked -= count
+        if self._unacked == 0:
+            self._drained.set()
+
+    async def _run(self):
+        # Se ejecuta en su propia tarea: la etiqueta de metricas no es la de quien encolo el primer documento
+        operation.set(f"WriteBehind.{self.collection}")
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            deadline = self.loop.time() + self.linger
+            while len(batch) < self.max_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = deadline - self.loop.time()
+                # Al cerrar no se espera a que lleguen mas
+                if remaining <= 0 or self.closed:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            WRITE_QUEUE_DEPTH.dec(self.collection, amount=len(batch))
+            await self._write(batch)
+            self._acked(len(batch))
+        self._task = None
+
+    async def _write(self, batch: list):
+        WRITE_BATCH_SIZE.observe(len(batch), self.collection)
+        errors = {}
+        try:
+            await database.get_collection(self.collection).insert_many([document for document, _, _ in batch], ordered=False)
+        except BulkWriteError as exc:
+            # Sin orden, el resto del lote se guarda aunque falle un documento: el error es solo de quien lo envio,
+            # con la misma excepcion que daria insert_one
+            for error in exc.details.get("writeErrors", []):
+                error_type = DuplicateKeyError if error.get("code") == 11000 else WriteError
+                errors[error["index"]] = error_type(error.get("errmsg"), error.get("code"), error)
+            if exc.details.get("writeConcernErrors"):
+                errors = {index: errors.get(index, exc) for index in range(len(batch))}
+        except Exception as exc:
+            errors = {index: exc for index in range(len(batch))}
+        # Lo que depende de los documentos insertados, una vez por lote
+        _applies = {}
+        for index, (_, _, apply) in enumerate(batch):
+            if apply is not None and index not in errors:
+                _applies.setdefault(apply, []).append(index)
+        for apply, indexes in _applies.items():
+            await _apply(self.collection, apply, [batch[index][0] for index in indexes])
+        for index, (_, future, _) in enumerate(batch):
+            if future.done():
+                continue
+            if index in errors:
+                future.set_exception(errors[index])
+            else:
+                future.set_result(None)
+
+    # close(): deja de encolar (las inserciones nuevas van directas) y espera a que se escriba lo aceptado hasta ahora,
+    # tambien lo que esperaba sitio en la cola
+    async def close(self):
+        self.closed = True
+        await self._drained.wait()
+
+# Cola de cada coleccion; se crean al primer uso
+_batchers = {}
+
+def _batcher(collection: str):
+    batcher = _batchers.get(collection)
+    # Otro event loop (pruebas y scripts que crean uno por ejecucion): la cola anterior ya no se puede usar
+    if batcher is None or batcher.loop is not asyncio.get_running_loop():
+        batcher = _batchers[collection] = Batcher(collection, settings.write_batch_max_size, settings.write_batch_linger_ms / 1000,
+                                                  settings.write_batch_queue_size)
+    return batcher
+
+# Los documentos ya estan guardados: si la actualizacion falla no se devuelve error (el cliente reintentaria y los duplicaria),
+# se registra y se corrige recalculando (python conversations.py backfill, python ratings.py rebuild)
+async def _apply(collection: str, apply, documents: list):
+    try:
+        await apply(documents)
+    except Exception:
+        logger.exception("Could not apply %d inserted %s, rebuild them from the collection", len(documents), collection)
+
+async def _insertOne(collection: str, document: dict, apply=None):
+    # Sin lotes: su insert_one y su propia actualizacion
+    await database.get_collection(collection).insert_one(document)
+    if apply is not None:
+        await _apply(collection, apply, [document])
+
+# insertOne(collection: str, document: dict, apply): inserta el documento y llama a apply([document]); con WRITE_BATCH_ENABLED,
+# en el siguiente lote de su coleccion, y apply una vez con todos los del lote
+async def insertOne(collection: str, document: dict, apply=None):
+    if not settings.write_batch_enabled:
+        await _insertOne(collection, document, apply)
+        return
+    await _batcher(collection).insert(document, apply)
+
+# stop(): escribe los lotes pendientes antes de cerrar el cliente de Mongo
+async def stop():
+    for batcher in list(_batchers.values()):
+        if batcher.loop is asyncio.get_running_loop():
+            await batcher.close()
+    _batchers.clear()